@@ -0,0 +1,121 @@
+"""
+Markdown rendering throughput: the MarkdownRenderer ANSI fallback vs. the previous line-by-line
+render_markdown implementation (kept below verbatim as the baseline).
+
+Usage: python benchmarks/bench_markdown.py [lines]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from termai_pkg import MarkdownRenderer
+
+
+def legacy_render(text):
+    """The ANSI fallback of render_markdown before MarkdownRenderer."""
+    lines = text.split("\n")
+    rendered_lines = []
+    in_code_block = False
+    code_lang = ""
+
+    for line in lines:
+        if line.strip().startswith("```"):
+            if not in_code_block:
+                in_code_block = True
+                code_lang = line.strip()[3:].strip()
+                lang_str = f" {code_lang.upper()} " if code_lang else " CODE "
+                border = f"\033[96m┌──────────────────{lang_str}──────────────────\033[0m"
+                rendered_lines.append(border)
+            else:
+                in_code_block = False
+                border = "\033[96m└───────────────────────────────────────────────\033[0m"
+                rendered_lines.append(border)
+            continue
+
+        if in_code_block:
+            rendered_lines.append(f"\033[93m{line}\033[0m")
+            continue
+
+        if line.strip().startswith("#"):
+            stripped = line.strip()
+            header_text = stripped.lstrip("#").strip()
+            rendered_lines.append(f"\033[1;96m✦ {header_text}\033[0m")
+            continue
+
+        stripped_line = line.lstrip()
+        indent = line[:len(line) - len(stripped_line)]
+        if stripped_line.startswith("* ") or stripped_line.startswith("- ") or stripped_line.startswith("+ "):
+            bullet_text = stripped_line[2:]
+            rendered_lines.append(f"{indent}\033[92m•\033[0m {bullet_text}")
+            continue
+
+        formatted_line = line
+        import re
+        formatted_line = re.sub(r'`([^`]+)`', r'\033[96m\1\033[0m', formatted_line)
+        formatted_line = re.sub(r'\*\*([^*]+)\*\*', r'\033[1m\1\033[22m', formatted_line)
+        formatted_line = re.sub(r'\*([^*]+)\*', r'\033[3m\1\033[23m', formatted_line)
+
+        rendered_lines.append(formatted_line)
+
+    return "\n".join(rendered_lines)
+
+
+def sample_document(target_lines, tables=True):
+    """A typical long answer: prose with inline formatting, lists, a table and code blocks, repeated."""
+    block = [
+        "## Step {n}: configure the service",
+        "The **worker** reads `config.yaml` on start and retries *three* times before giving up.",
+        "Plain prose without any formatting at all, which is the most common kind of line in an answer.",
+        "- Set `retries` to a **higher** value",
+        "- Check the *network* policy",
+        "1. Restart the service",
+        "2. Watch the logs with `journalctl -fu worker`",
+        "| Option | Default | Meaning |",
+        "|--------|--------:|---------|",
+        "| retries | 3 | attempts before failing |",
+        "| timeout | 30 | seconds per attempt |",
+        "```python",
+        "def handler(event):",
+        "    return {'status': 200, 'body': event['body']}",
+        "```",
+        "",
+    ]
+    if not tables:
+        # The legacy renderer has no table support; compare on the features both handle
+        block = [line for line in block if not line.startswith("|")]
+    lines = []
+    n = 0
+    while len(lines) < target_lines:
+        n += 1
+        lines.extend(line.replace("{n}", str(n)) for line in block)
+    return "\n".join(lines[:target_lines])
+
+
+def measure(render, text, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    target_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    renderers = [
+        ("legacy render_markdown", legacy_render),
+        ("MarkdownRenderer", MarkdownRenderer(highlight=False).render),
+        # Not comparable with the legacy renderer, which painted code blocks in a single color
+        ("  + code highlighting", MarkdownRenderer().render),
+    ]
+    for label, tables in [("with tables", True), ("without tables", False)]:
+        text = sample_document(target_lines, tables)
+        print(f"{target_lines:,} lines, {label}:")
+        for name, render in renderers:
+            seconds = measure(render, text)
+            print(f"  {name:<24} {seconds * 1000:8.1f} ms  {target_lines / seconds:12,.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,16 @@
 import os
 import sys
 import json
+import re
 import requests
 import subprocess
 from pathlib import Path
 import copy # Import copy for deepcopy
 import shutil # Import shutil to check for editor availability
+try:
+    import orjson # Optional: faster JSON encoding/decoding of large payloads
+except ImportError:
+    orjson = None
 
 # --- Configuration Paths (XDG Base Directory Specification) ---
 # https://specifications.freedesktop.org/basedir-spec/basedir-spec-latest.html
@@ -18,10 +23,92 @@ CONFIG_DIR = _xdg_config_home / APP_NAME
 CONFIG_FILE = CONFIG_DIR / "config.json"
 
 # XDG_DATA_HOME: user-specific data files (default: ~/.local/share)
-# Reserved for future use (e.g. chat history, caches).
+# Holds caches such as the per-provider model catalog.
 _xdg_data_home = Path(os.environ.get("XDG_DATA_HOME", Path.home() / ".local" / "share"))
 DATA_DIR = _xdg_data_home / APP_NAME
 
+# Model catalog cache: one JSON file per provider endpoint, revalidated after the TTL expires
+MODEL_CACHE_DIR = DATA_DIR / "models"
+MODEL_CACHE_TTL = 24 * 60 * 60 # seconds (override with "model_cache_ttl" in config.json)
+MODEL_CACHE_RETRY = 5 * 60 # minimum seconds between background refresh attempts
+MODEL_CATALOG_MAX_PAGES = 50 # safety cap when following paginated /models responses
+MODEL_PICK_LIMIT = 25 # models shown at once in the interactive --model picker
+
+# Request bodies at least this large are gzip-compressed for endpoints that accept it
+GZIP_MIN_BYTES = 1024
+
+# Pipeline mode: stage results cached by content hash so reruns skip unchanged stages
+PIPE_CACHE_DIR = DATA_DIR / "pipe_cache"
+
+# Single-flight: identical concurrent single-shot requests (e.g. a CI fan-out) share one API call
+SINGLE_FLIGHT_DIR = DATA_DIR / "inflight"
+SINGLE_FLIGHT_WAIT = 600 # seconds to wait for an identical in-flight request before calling the API anyway
+SINGLE_FLIGHT_TTL = 60 * 60 # leftover lock and answer files older than this are removed
+
+# Request scheduler: per-profile "max_inflight", "rpm" and "tpm" limits shared by all ai processes
+SCHEDULER_DIR = DATA_DIR / "scheduler"
+SCHEDULER_POLL = 0.05 # seconds between admission checks while waiting for a slot
+SCHEDULER_MAX_WAIT = 600 # seconds a request waits for a slot before giving up
+
+# Mock provider server (ai mock-server): a local stand-in for the Gemini and OpenAI APIs
+MOCK_SERVER_PORT = 8765
+MOCK_SERVER_HANG = 60 # seconds an injected "timeout" holds the connection before dropping it
+MOCK_EMBEDDING_DIM = 64
+
+# Load testing (ai loadtest)
+LOADTEST_CONCURRENCY = 100 # default cap on requests in flight at once
+LOADTEST_TIMEOUT = 60 # seconds to connect or wait for the next chunk before a request counts as timed out
+
+# Semantic cache: embeddings of past prompts (float32 rows, memory-mapped) and their answers
+SEMANTIC_CACHE_DIR = DATA_DIR / "semantic_cache"
+SEMANTIC_EMBED_MAX_CHARS = 8000 # head + tail of very long prompts are embedded
+DEFAULT_EMBEDDING_MODELS = {"gemini": "text-embedding-004", "openai": "text-embedding-3-small"}
+
+# File context (--context): discovery, chunking and packing limits
+CONTEXT_TOKEN_BUDGET = 16000 # default estimated tokens of file context packed into a prompt
+CONTEXT_CHUNK_LINES = 40
+CONTEXT_MAX_FILE_BYTES = 16 * 1024 * 1024
+CONTEXT_SKIP_DIRS = {".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv", ".tox", ".mypy_cache"}
+
+# USD per 1M (input, output) tokens by model-name prefix, used for --dry-run cost estimates.
+# Profiles can override with "pricing": {"input": ..., "output": ...}.
+MODEL_PRICING = {
+    "gemini-2.5-pro": (1.25, 10.00),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+}
+
+# Chat prefetch: smallest history (estimated tokens) worth priming on providers with prompt caching
+PREFETCH_MIN_CACHE_TOKENS = 1024
+
+# Tool calling (--tools): limits for the local tool registry
+TOOL_MAX_ROUNDS = 10 # model turns per request before giving up
+TOOL_MAX_WORKERS = 8 # tool calls of one turn run in parallel
+TOOL_COMMAND_TIMEOUT = 30 # seconds
+TOOL_OUTPUT_MAX_CHARS = 20000 # longer tool output is truncated in the middle
+# Programs (optionally with a subcommand) run_command may execute; override with "tool_allowlist" in config.json
+DEFAULT_TOOL_ALLOWLIST = [
+    "ls", "cat", "head", "tail", "grep", "find", "wc", "stat", "file", "du", "df", "free", "uptime", "uname", "ps",
+    "journalctl", "systemctl status", "docker ps", "docker logs", "git status", "git log", "git diff", "git show"
+]
+# Arguments that turn an allowlisted reader into a writer or launcher (matched from the start of each argument);
+# refused whatever the allowlist says, since the model chooses the arguments
+TOOL_DENIED_ARGS = {
+    "find": r"-(exec|execdir|ok|okdir|delete|fprint|fprint0|fprintf|fls)$",
+    "git": r"--(output|ext-diff|textconv)(=|$)|-o",
+    "file": r"-[^-]*C|--compile",
+    "journalctl": r"--(vacuum-|rotate|flush|sync|relinquish-var|smart-relinquish-var|setup-keys|update-catalog)",
+}
+
+# Default model per provider, used when a profile has no model_name
+DEFAULT_MODELS = {"gemini": "gemini-2.5-flash", "openai": "gpt-4o", "local": "llama3.2"}
+
 # Legacy paths — used only for one-time migration
 _LEGACY_DATA_DIR = Path.home() / ".local" / "share" / APP_NAME
 _LEGACY_CONFIG_FILE = _LEGACY_DATA_DIR / "config.json"
@@ -72,9 +159,27 @@ DEFAULT_CONFIG = {
             "system_instruction": "You are a CLI assistant for command-line users. Answer concisely and use clear formatting. Use standard Markdown for headers, bolding, bullet points, and code blocks.",
             "temperature": 0.7,
             "max_tokens": 1024
+        },
+        "local-default": {
+            "provider": "local",
+            "base_url": "http://127.0.0.1:11434/v1",
+            "socket_path": "",
+            "api_key": "",
+            "model_name": "llama3.2",
+            "system_instruction": "You are a CLI assistant for command-line users. Answer concisely and use clear formatting. Use standard Markdown for headers, bolding, bullet points, and code blocks.",
+            "temperature": 0.7,
+            "max_tokens": 1024,
+            "server_command": "",
+            "keep_alive": "30m",
+            "startup_timeout": 60
         }
     },
-    "proxy": ""
+    "proxy": "",
+    "semantic_cache": {
+        "enabled": False,
+        "threshold": 0.95,
+        "max_entries": 5000
+    }
 }
 
 def load_config():
@@ -153,6 +258,9 @@ def load_config():
                 if p_config.get("provider") == "openai" and "base_url" not in p_config:
                     p_config["base_url"] = "https://api.openai.com/v1"
                     updated = True
+                if p_config.get("provider") == "local" and "base_url" not in p_config and not p_config.get("socket_path"):
+                    p_config["base_url"] = DEFAULT_CONFIG["profiles"]["local-default"]["base_url"]
+                    updated = True
                 
                 # Check for restrictive legacy system instruction
                 sys_instr = p_config.get("system_instruction", "")
@@ -184,8 +292,8 @@ def load_config():
     if sys.stdin.isatty() and "--complete" not in sys.argv:
         print(f"[{APP_NAME}] First run! Choose your primary AI provider.")
         provider = ""
-        while provider not in ["1", "2"]:
-            provider = input("Enter 1 for Gemini or 2 for OpenAI: ").strip()
+        while provider not in ["1", "2", "3"]:
+            provider = input("Enter 1 for Gemini, 2 for OpenAI or 3 for a Local server (offline): ").strip()
 
         if provider == "1":
             new_config["active_profile"] = "gemini-default"
@@ -215,6 +323,10 @@ def load_config():
             model_name = input("Model Name: ").strip()
             if model_name:
                 new_config["profiles"]["openai-default"]["model_name"] = model_name
+
+        elif provider == "3":
+            new_config["active_profile"] = "local-default"
+            prompt_local_profile(new_config["profiles"]["local-default"])
     else:
         # Default to Gemini if non-interactive and no config exists
         if not gemini_api_key:
@@ -233,6 +345,25 @@ def load_config():
 
     return new_config
 
+def prompt_local_profile(profile):
+    """Interactively fills in the endpoint, model and optional auto-start command of a local provider profile."""
+    print(f"[{APP_NAME}] Enter the local server URL (Press Enter for default: {profile['base_url']})")
+    print("  (Use unix:/path/to/server.sock to connect over a Unix socket)")
+    base_url = input("Server URL: ").strip()
+    if base_url.startswith("unix:"):
+        profile["socket_path"] = base_url[len("unix:"):]
+    elif base_url:
+        profile["base_url"] = base_url
+
+    print(f"[{APP_NAME}] Enter Model Name (Press Enter for default: {profile['model_name']})")
+    model_name = input("Model Name: ").strip()
+    if model_name:
+        profile["model_name"] = model_name
+
+    print(f"[{APP_NAME}] Command to auto-start the server when it is down (e.g. 'ollama serve'; Enter to skip)")
+    profile["server_command"] = input("Server Command: ").strip()
+    return profile
+
 def open_editor():
     """Opens config.json in the user's terminal editor."""
     # 1. Prioritize the user's explicit choice
@@ -266,11 +397,27 @@ A lightweight CLI tool for AI integration in your terminal.
 
 ## Options
 * `-i`, `--chat`, `chat` : Start an interactive chat session
+* `--prefetch` : In chat, warm the connection and prompt cache while you type (reports latency saved)
+* `--type-ahead` : In chat, keep typing while an answer streams; messages queue up and are sent in order
+* `--context <path>` : Add relevant excerpts from files or directories (repeatable; `--context-budget <tokens>` limits size)
+* `--compact-input` : Shrink piped logs first: strip ANSI codes, normalize timestamps/IDs, collapse repeated lines and stack traces
+* In chat: `/profile <name>` and `/model <name>` switch the profile or model mid-session, keeping the conversation
+* `--tools` : Let the model run local tools (allowlisted commands, file reads, grep) to investigate before answering
+* `--dry-run` : Show the payload size, estimated tokens and cost without sending (`--count-tokens` also asks Gemini for an exact count)
+* `--semantic-cache` : Answer near-duplicate prompts from the local semantic cache (`--no-semantic-cache` to skip it)
+* `--no-single-flight` : Always call the API, instead of sharing the answer of an identical request already running in another process
 * `-p`, `--profile [name]` : Run query using or switching temporarily to a profile
-* `-m`, `--model [name]` : List available Gemini models or set a specific one
+* `-m`, `--model [name]` : List, filter and pick available models or set a specific one (add `--refresh` to bypass the model cache)
 * `profile [action]` : Profile management: `list`, `use`, `add`, `remove` (or `rm`)
+* `pipe <file.yaml>` : Run a multi-stage prompt chain (add `--no-cache` to rerun every stage)
 * `completion [shell]` : Generate shell auto-completion script (`bash` or `zsh`)
+* `loadtest [options]` : Send requests at a fixed rate through a profile and report p50/p95/p99 latency, time to first token, errors and throughput (`-p`, `--rps`, `--duration`, `--prompt-file`, `--concurrency`, `--output json`)
+* `mock-server [options]` : Serve a local stand-in for the Gemini and OpenAI APIs with configurable latency, token rate and injected errors (`--port`, `--latency`, `--token-rate`, `--errors 429=0.05,timeout=0.01`, `--concurrency`)
 * `-o`, `--save <file>` : Save the response or chat session to a file
+* `--no-pager` : Print long answers directly instead of opening the built-in pager
+* `--output json|ndjson` : Print machine-readable results (text, finish reason, usage, latency, profile) instead of rendered text; `ndjson` streams one object per chunk
+* `--record <dir>` / `--replay <dir>` : Record provider responses (with streaming timing) to a directory, or answer from a recording without network or API keys (`--replay-speed N` plays back N times faster, 0 without delays)
+* `--priority interactive|batch` : Scheduling class for profiles with `max_inflight`/`rpm`/`tpm` limits (default: interactive on a terminal, batch otherwise)
 * `--config` : Open configuration file
 * `--debug` : Enable debug mode
 * `--debug-config` : Print the loaded configuration (redacts keys)
@@ -291,6 +438,7 @@ A lightweight CLI tool for AI integration in your terminal.
 * `ai -p local-ollama "What is Python?"`
 * `ai --model`
 * `cat error.log | ai "Explain this error briefly"`
+* `cat error.log | ai pipe triage.yaml`
 """
     print(render_markdown(help_markdown.strip()))
     return 0 # Return 0 for success
@@ -315,8 +463,8 @@ def handle_completion(config):
     # Case 1: First argument completion (ai [tab] or ai ch[tab])
     if cword == 1:
         suggestions = [
-            "chat", "profile", "completion", "help",
-            "-i", "--chat", "-p", "--profile", "-m", "--model",
+            "chat", "profile", "pipe", "completion", "mock-server", "loadtest", "help",
+            "-i", "--chat", "--prefetch", "--type-ahead", "--semantic-cache", "--no-semantic-cache", "--no-single-flight", "--compact-input", "--context", "--context-budget", "--dry-run", "--count-tokens", "--output", "--priority", "--record", "--replay", "--replay-speed", "--tools", "--no-pager", "-p", "--profile", "-m", "--model",
             "--profiles", "--use", "--profile-add", "--profile-remove",
             "--config", "--debug", "--debug-config", "--help", "-h", "--reinstall"
         ]
@@ -335,29 +483,71 @@ def handle_completion(config):
         if config:
             suggestions = list(config.get("profiles", {}).keys())
 
-    # Case 5: Model names for --model/-m
+    # Case 5: Model names for --model/-m (served from the model catalog cache, never the network)
     elif cword >= 2 and words[cword - 1] in ["--model", "-m"]:
         suggestions = ["gemini-2.5-flash", "gemini-2.5-pro", "gpt-4o", "gpt-4o-mini"]
+        if config:
+            profile_name = config.get("active_profile", "")
+            for i, word in enumerate(words[:-1]):
+                if word in ["--profile", "-p"] and words[i + 1] in config.get("profiles", {}):
+                    profile_name = words[i + 1]
+            profile_config = config.get("profiles", {}).get(profile_name)
+            if profile_config:
+                models, is_stale = get_cached_models(profile_config, _model_cache_ttl(config))
+                if models:
+                    suggestions = [m["name"] for m in models]
+                if is_stale and can_refresh_models(profile_config):
+                    refresh_models_in_background(profile_name)
 
-    # Case 6: Shell options for 'completion'
+    # Case 6: Pipeline definition files for 'pipe'
+    elif cword == 2 and words[1] == "pipe":
+        suggestions = sorted(str(f) for pattern in ["*.yaml", "*.yml", "*.json"] for f in Path(".").glob(pattern))
+
+    # Case 7: Shell options for 'completion'
     elif cword == 2 and words[1] == "completion":
         suggestions = ["bash", "zsh"]
 
+    # Case 8: Structured output formats
+    elif cword >= 2 and words[cword - 1] == "--output":
+        suggestions = ["json", "ndjson"]
+
+    # Case 9: Scheduler priority classes
+    elif cword >= 2 and words[cword - 1] == "--priority":
+        suggestions = list(RequestScheduler.PRIORITIES)
+
+    # Case 10: Options of 'loadtest' and 'mock-server'
+    elif cword >= 2 and words[1] == "loadtest":
+        suggestions = ["--profile", "-p", "--model", "-m", "--rps", "--duration", "--prompt-file", "--concurrency", "--timeout", "--priority", "--output"]
+    elif cword >= 2 and words[1] == "mock-server":
+        suggestions = ["--host", "--port", "--latency", "--token-rate", "--reply-tokens", "--errors", "--concurrency", "--hang", "--debug"]
+
     # Filter and print matching suggestions
     matches = [s for s in suggestions if s.startswith(cur)]
     for m in matches:
         print(m)
     return 0
 
+_CHAR_WIDTHS = {}
+
+def char_width(char):
+    """Terminal columns of one character: 2 for East Asian wide/fullwidth characters and emoji, 0 for combining and zero-width characters, else 1."""
+    width = _CHAR_WIDTHS.get(char)
+    if width is None:
+        import unicodedata
+        if unicodedata.combining(char) or unicodedata.category(char) in ("Mn", "Me", "Cf"):
+            width = 0
+        elif unicodedata.east_asian_width(char) in ("W", "F"):
+            width = 2
+        else:
+            width = 1
+        _CHAR_WIDTHS[char] = width
+    return width
+
 def visual_len(s):
     """Calculates the visual column width of a string in the terminal, accounting for double-width wide characters/emojis."""
-    length = 0
-    for char in s:
-        if ord(char) > 0x2000:
-            length += 2
-        else:
-            length += 1
-    return length
+    if s.isascii():
+        return len(s)
+    return sum(char_width(char) for char in s)
 
 def visual_ljust(s, width):
     """Pads a string with spaces to a visual width, rather than character count width."""
@@ -367,6 +557,152 @@ def visual_ljust(s, width):
         return s + (" " * needed)
     return s
 
+class Verbatim(str):
+    """A rendered line that is already laid out and must not be wrapped (code block lines, tables, rich output)."""
+    __slots__ = ()
+
+class TerminalLayout:
+    """
+    Terminal size cache and width-aware wrapping of rendered lines. The size is read once and refreshed
+    by a SIGWINCH handler instead of being queried for every message, and `generation` counts resizes
+    so views holding wrapped rows (the Pager) know when to reflow. Wrapping measures display width
+    (ANSI codes excluded, wide characters count double), carries styles across breaks, hangs
+    continuation rows under bullet and list text, and leaves Verbatim lines alone.
+    """
+    ANSI = re.compile(r"\033\[[0-9;]*m")
+    TOKEN = re.compile(r"\033\[[0-9;]*m|\s+|\033|[^\s\033]+")
+    HANGING_INDENT = re.compile(r"\s*(?:(?:[•✦]|\d+\.) )?")
+    STYLE_OFF = re.compile(r"\033\[(?:(?:2[2-9]|39|49);?)+m")
+    RESET = "\033[0m"
+
+    def __init__(self):
+        self._size = None
+        self.generation = 0
+        self.listening = False
+
+    def listen(self):
+        """Keeps the cached size current by handling SIGWINCH (Unix only, and only from the main thread)."""
+        import signal
+        if self.listening or not hasattr(signal, "SIGWINCH"):
+            return
+        previous = signal.getsignal(signal.SIGWINCH)
+
+        def resized(signum, frame):
+            self._size = None
+            self.generation += 1
+            if callable(previous):
+                previous(signum, frame)
+        try:
+            signal.signal(signal.SIGWINCH, resized)
+        except ValueError:
+            return # not the main thread: sizes are read on every call instead
+        self.listening = True
+
+    @property
+    def size(self):
+        size = self._size
+        if size is None:
+            size = shutil.get_terminal_size()
+            if self.listening:
+                self._size = size
+        return size
+
+    @property
+    def columns(self):
+        return self.size.columns
+
+    @property
+    def lines(self):
+        return self.size.lines
+
+    @property
+    def width(self):
+        """Wrap width: one column short of the terminal, so a full row never triggers the terminal's own wrap."""
+        return max(self.size.columns - 1, 1)
+
+    def wrap(self, line, width=None, indent=None):
+        """
+        Wraps one rendered line to `width` display columns (default: the terminal) and returns its rows.
+        `indent` prefixes continuation rows; by default they hang under the text of an indented,
+        bulleted or numbered line. Words longer than a row are split.
+        """
+        width = width or self.width
+        # Code points equal columns only for ASCII; wide text (CJK, emoji) is measured below
+        if isinstance(line, Verbatim) or (line.isascii() and len(line) <= width):
+            return [line]
+        plain = self.ANSI.sub("", line) if "\033" in line else line
+        if visual_len(plain) <= width:
+            return [line]
+        if indent is None:
+            indent = " " * visual_len(self.HANGING_INDENT.match(plain).group())
+        indent = indent[:width // 2]
+        rows = []
+        styles = [] # open styles, reopened after each break
+        row, used = "", 0
+        gap, gap_width = "", 0 # pending space before the next word, plus any style codes that follow it
+
+        def break_row():
+            nonlocal row, used
+            rows.append(row + self.RESET if styles else row)
+            row, used = indent + "".join(styles), len(indent)
+
+        for token in self.TOKEN.findall(line):
+            first = token[0]
+            if first == "\033":
+                if gap_width:
+                    gap += token
+                else:
+                    row += token
+                if token == self.RESET:
+                    styles = []
+                elif self.STYLE_OFF.match(token):
+                    # The renderer nests styles, so a closing code ends the innermost open one
+                    if styles:
+                        styles.pop()
+                else:
+                    styles.append(token)
+            elif first.isspace():
+                if not rows and not used:
+                    row += token # leading indentation of the source line
+                    used += len(token)
+                else:
+                    gap_width = len(token) if token == " " * len(token) else 1
+                    gap = " " * gap_width
+            else:
+                token_width = len(token) if token.isascii() else visual_len(token)
+                if used + gap_width + token_width <= width:
+                    row += gap + token
+                    used += gap_width + token_width
+                elif token_width <= width - len(indent):
+                    break_row() # styles in the gap are already part of `styles`
+                    row += token
+                    used += token_width
+                else:
+                    row += gap
+                    used += gap_width
+                    for char in token:
+                        char_columns = char_width(char)
+                        if used + char_columns > width and used > len(indent):
+                            break_row()
+                        row += char
+                        used += char_columns
+                gap, gap_width = "", 0
+        rows.append(row + gap)
+        return rows
+
+    def wrap_lines(self, lines, width=None):
+        """Wraps a list of rendered lines (see wrap) into terminal rows."""
+        width = width or self.width
+        rows = []
+        for line in lines:
+            if isinstance(line, Verbatim) or (line.isascii() and len(line) <= width):
+                rows.append(line)
+            else:
+                rows.extend(self.wrap(line, width))
+        return rows
+
+TERMINAL = TerminalLayout()
+
 def save_chat_history(history, filename, provider, target_profile, model_name):
     """Saves the chat history to a file in a clean Markdown format."""
     from datetime import datetime
@@ -381,14 +717,8 @@ def save_chat_history(history, filename, provider, target_profile, model_name):
             f.write(f"---\n\n")
             
             for msg in history:
-                if provider == "gemini":
-                    role = "You" if msg.get("role") == "user" else "AI"
-                    text = msg.get("parts", [{}])[0].get("text", "")
-                else: # openai
-                    role = "You" if msg.get("role") == "user" else "AI"
-                    text = msg.get("content", "")
-                
-                f.write(f"### {role}\n{text}\n\n")
+                role = "You" if msg.role == "user" else "AI"
+                f.write(f"### {role}\n{msg.text}\n\n")
                 
         print(f"{GREEN}[✓] Chat history saved successfully to: {filepath}{RESET}")
         return True
@@ -413,17 +743,8 @@ def print_user_message(prompt_text, message_text):
         print(f"{prompt_text}{message_text}")
         return
 
-    import shutil
-    import textwrap
-
-    try:
-        cols = shutil.get_terminal_size().columns
-    except Exception:
-        cols = 80
-
-    width = cols - 1 if cols > 1 else 1
-
-    lines = textwrap.wrap(message_text, width=width, initial_indent=prompt_text, subsequent_indent=" " * len(prompt_text))
+    width = TERMINAL.width
+    lines = TERMINAL.wrap(f"{prompt_text}{message_text}", width, indent=" " * visual_len(prompt_text))
     for line in lines:
         padded = visual_ljust(line, width)
         print(f"{BG_USER}{padded}{RESET}")
@@ -436,23 +757,14 @@ def print_header_block(target_profile, provider, model_name):
         print(f"Type exit or quit (or Ctrl+D) to end the chat.\n")
         return
 
-    import shutil
-    import textwrap
-
-    try:
-        cols = shutil.get_terminal_size().columns
-    except Exception:
-        cols = 80
-
-    width = cols - 1 if cols > 1 else 1
-
+    width = TERMINAL.width
     title = "💬 Termai Interactive Chat Session"
     details = f"Using Profile: {target_profile} | Provider: {provider.capitalize()} | Model: {model_name}"
     info = "Type exit or quit (or Ctrl+D) to end the chat."
 
     lines = []
     for text in [title, details, info]:
-        wrapped = textwrap.wrap(text, width=width - 4)
+        wrapped = TERMINAL.wrap(text, max(width - 4, 1), indent="")
         for w in wrapped:
             lines.append(f"  {w}")
 
@@ -475,7 +787,9 @@ def list_profiles(config):
         p_config = profiles[p_name]
         prov = p_config.get("provider", "gemini")
         model = p_config.get("model_name", "")
-        extra = f" ({p_config['base_url']})" if prov == "openai" and "base_url" in p_config else ""
+        extra = f" ({p_config['base_url']})" if prov in ["openai", "local"] and "base_url" in p_config else ""
+        if prov == "local" and p_config.get("socket_path"):
+            extra = f" (unix:{p_config['socket_path']})"
         print(f"  {CYAN}{idx}. {p_name}{RESET} [{YELLOW}{prov}{RESET}] -> {model}{extra}{is_active}")
     print()
     return 0
@@ -536,11 +850,12 @@ def add_profile(config, profile_name):
     print("Choose profile provider type:")
     print("  1. Gemini")
     print("  2. OpenAI (or OpenAI-compatible custom endpoint)")
+    print("  3. Local (llama.cpp / Ollama server, works offline)")
     
     provider_type = ""
-    while provider_type not in ["1", "2"]:
+    while provider_type not in ["1", "2", "3"]:
         try:
-            provider_type = input("Choice [1-2]: ").strip()
+            provider_type = input("Choice [1-3]: ").strip()
         except (KeyboardInterrupt, EOFError):
             print("\nCancelled.")
             return 0
@@ -557,6 +872,9 @@ def add_profile(config, profile_name):
         new_profile["model_name"] = "gemini-2.5-flash"
         new_profile["system_instruction"] = DEFAULT_CONFIG["profiles"]["gemini-default"]["system_instruction"]
         new_profile["generation_config"] = DEFAULT_CONFIG["profiles"]["gemini-default"]["generation_config"]
+    elif provider_type == "3":
+        new_profile = copy.deepcopy(DEFAULT_CONFIG["profiles"]["local-default"])
+        prompt_local_profile(new_profile)
     else:
         new_profile["provider"] = "openai"
         print(f"[{APP_NAME}] Enter OpenAI/Custom Base URL (Press Enter for default: https://api.openai.com/v1)")
@@ -602,19 +920,567 @@ def remove_profile(config, profile_name):
     print(f"{GREEN}[✓] Profile '{profile_name}' deleted successfully.{RESET}")
     return 0
 
+_HTTP_SESSION = None
+
+def _unix_socket_adapter():
+    """
+    Builds a requests adapter that speaks HTTP over Unix domain sockets for http+unix:// URLs
+    (the socket path is the percent-encoded host). Uses only urllib3, which requests already ships with.
+    """
+    import socket
+    from urllib.parse import urlparse, unquote
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection
+    from urllib3.connectionpool import HTTPConnectionPool
+
+    class UnixHTTPConnection(HTTPConnection):
+        def __init__(self, socket_path, **kwargs):
+            super().__init__("localhost", **kwargs)
+            self.socket_path = socket_path
+
+        def _new_conn(self):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            if isinstance(self.timeout, (int, float)):
+                sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            return sock
+
+    class UnixHTTPConnectionPool(HTTPConnectionPool):
+        def __init__(self, socket_path, **kwargs):
+            super().__init__("localhost", **kwargs)
+            self.socket_path = socket_path
+
+        def _new_conn(self):
+            return UnixHTTPConnection(self.socket_path, timeout=self.timeout.connect_timeout)
+
+    class UnixSocketAdapter(HTTPAdapter):
+        def __init__(self):
+            super().__init__()
+            self._unix_pools = {}
+
+        def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+            return self.get_connection(request.url, proxies)
+
+        def get_connection(self, url, proxies=None):
+            socket_path = unquote(urlparse(url).netloc)
+            if socket_path not in self._unix_pools:
+                self._unix_pools[socket_path] = UnixHTTPConnectionPool(socket_path, maxsize=self._pool_maxsize)
+            return self._unix_pools[socket_path]
+
+        def request_url(self, request, proxies):
+            return request.path_url
+
+        def close(self):
+            for pool in self._unix_pools.values():
+                pool.close()
+            super().close()
+
+    return UnixSocketAdapter()
+
+def get_http_session():
+    """
+    Returns the process-wide requests.Session. Reusing one session keeps TCP/TLS connections
+    warm between chat turns and lets local profiles connect over Unix sockets.
+    """
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None:
+        _HTTP_SESSION = requests.Session()
+        _HTTP_SESSION.mount("http+unix://", _unix_socket_adapter())
+    return _HTTP_SESSION
+
+class TrafficStore:
+    """
+    Recorded HTTP exchanges for --record/--replay. Response bodies are appended zlib-compressed to
+    bodies.bin; index.jsonl holds one line per exchange with the request key, status, headers, body
+    offset, the time to response headers and the arrival time and size of every streamed chunk.
+    Requests are keyed on method, URL without the `key` parameter and body (credential headers are
+    never stored), so recordings made with one API key replay with any other, or none.
+    """
+    KEEP_HEADERS = ("content-type", "etag")
+
+    def __init__(self, directory):
+        import threading
+        self.dir = Path(directory).expanduser()
+        self.index_file = self.dir / "index.jsonl"
+        self.body_file = self.dir / "bodies.bin"
+        self.lock = threading.Lock()
+        self.entries = None
+        self.served = {}
+
+    @staticmethod
+    def key(request):
+        """Returns (key, url) for a prepared request; the URL has credentials removed."""
+        import gzip
+        import hashlib
+        from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+        parts = urlsplit(request.url)
+        url = urlunsplit(parts._replace(query=urlencode([(k, v) for k, v in parse_qsl(parts.query) if k != "key"])))
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if request.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body) # the gzip header carries a timestamp
+        digest = hashlib.sha256(b"\0".join([request.method.encode("utf-8"), url.encode("utf-8"), body])).hexdigest()
+        return digest, url
+
+    def save(self, request, response, head_ms, chunks, complete=True):
+        """
+        Appends one exchange; chunks are (ms since the request was sent, bytes) pairs. An incomplete
+        exchange is one the client closed early (e.g. after an SSE [DONE] event, or a cancelled reply).
+        """
+        import zlib
+        key, url = self.key(request)
+        body = zlib.compress(b"".join(data for _, data in chunks))
+        entry = {"key": key, "method": request.method, "url": url, "status": response.status_code,
+                 "headers": {k: v for k, v in response.headers.items() if k.lower() in self.KEEP_HEADERS},
+                 "head_ms": round(head_ms, 1), "chunks": [[round(ms, 1), len(data)] for ms, data in chunks], "complete": complete}
+        with self.lock:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            with open(self.index_file, "ab") as index:
+                try:
+                    import fcntl
+                    fcntl.flock(index, fcntl.LOCK_EX) # other processes recording into the same directory
+                except ImportError:
+                    pass
+                with open(self.body_file, "ab") as bodies:
+                    entry["offset"] = bodies.seek(0, os.SEEK_END)
+                    entry["length"] = len(body)
+                    bodies.write(body)
+                index.write(encode_json(entry) + b"\n")
+
+    def load(self):
+        """Reads the index; returns the number of recorded exchanges."""
+        self.entries = {}
+        with open(self.index_file, "rb") as index:
+            for line in index:
+                if line.strip():
+                    entry = decode_json(line)
+                    self.entries.setdefault(entry["key"], []).append(entry)
+        return sum(len(entries) for entries in self.entries.values())
+
+    def lookup(self, request):
+        """Returns (entry, [(ms, bytes), ...]) for a request, or (None, url). Repeated requests cycle through their recordings."""
+        import zlib
+        key, url = self.key(request)
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                return None, url
+            entry = entries[self.served.get(key, 0) % len(entries)]
+            self.served[key] = self.served.get(key, 0) + 1
+        with open(self.body_file, "rb") as bodies:
+            bodies.seek(entry["offset"])
+            body = zlib.decompress(bodies.read(entry["length"]))
+        chunks, position = [], 0
+        for at_ms, size in entry["chunks"]:
+            chunks.append((at_ms, body[position:position + size]))
+            position += size
+        return entry, chunks
+
+def enable_traffic_capture(record_dir=None, replay_dir=None, speed=1.0):
+    """
+    Mounts record or replay adapters on the shared session, below every provider call. Recording passes
+    requests through and stores each response as far as the client read it, with its chunk timing.
+    Replay never touches the network: it serves recorded responses with the original timing divided
+    by `speed` (0 = no delays) and raises ConnectionError for unrecorded requests.
+    """
+    import time
+    from requests.adapters import BaseAdapter
+    from requests.structures import CaseInsensitiveDict
+    from requests.utils import get_encoding_from_headers
+
+    class RecordedBody:
+        """Wraps a live urllib3 response body, noting when each chunk arrives."""
+        def __init__(self, raw, start, on_complete):
+            self._raw, self._start, self._on_complete = raw, start, on_complete
+            self._chunks = []
+
+        def stream(self, amt=None, decode_content=None):
+            for data in self._raw.stream(amt, decode_content=True):
+                self._chunks.append(((time.time() - self._start) * 1000, data))
+                yield data
+            self._complete(True)
+
+        def read(self, amt=None, decode_content=None, **kwargs):
+            data = self._raw.read(amt, decode_content=True)
+            if data:
+                self._chunks.append(((time.time() - self._start) * 1000, data))
+            if not data or amt is None:
+                self._complete(True)
+            return data
+
+        def close(self):
+            self._complete(False)
+            self._raw.close()
+
+        def _complete(self, complete):
+            if self._on_complete:
+                self._on_complete(self._chunks, complete)
+                self._on_complete = None
+
+        def __getattr__(self, name):
+            return getattr(self._raw, name)
+
+    class RecordingAdapter(BaseAdapter):
+        def __init__(self, inner, store):
+            super().__init__()
+            self.inner, self.store = inner, store
+
+        def send(self, request, stream=False, **kwargs):
+            start = time.time()
+            response = self.inner.send(request, stream=True, **kwargs)
+            head_ms = (time.time() - start) * 1000
+            response.raw = RecordedBody(response.raw, start, lambda chunks, complete: self.store.save(request, response, head_ms, chunks, complete))
+            return response
+
+        def close(self):
+            self.inner.close()
+
+    class ReplayedBody:
+        """Plays recorded chunks back on their original schedule (scaled by speed)."""
+        def __init__(self, chunks, start):
+            self._chunks, self._start = iter(chunks), start
+
+        def stream(self, amt=None, decode_content=None):
+            for at_ms, data in self._chunks:
+                if speed:
+                    delay = self._start + at_ms / 1000 / speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                yield data
+
+        def read(self, amt=None, decode_content=None, **kwargs):
+            return b"".join(self.stream())
+
+        def close(self):
+            pass
+
+        def release_conn(self):
+            pass
+
+    class ReplayAdapter(BaseAdapter):
+        def __init__(self, store):
+            super().__init__()
+            self.store = store
+
+        def send(self, request, stream=False, **kwargs):
+            start = time.time()
+            entry, chunks = self.store.lookup(request)
+            if entry is None:
+                raise requests.ConnectionError(f"No recorded response for {request.method} {chunks} in {self.store.dir}", request=request)
+            if speed and entry["head_ms"] > 0:
+                time.sleep(entry["head_ms"] / 1000 / speed)
+            response = requests.Response()
+            response.status_code = entry["status"]
+            response.headers = CaseInsensitiveDict(entry["headers"])
+            response.encoding = get_encoding_from_headers(response.headers)
+            response.raw = ReplayedBody(chunks, start)
+            response.url = request.url
+            response.request = request
+            response.connection = self
+            return response
+
+    session = get_http_session()
+    if replay_dir:
+        store = TrafficStore(replay_dir)
+        store.load()
+        adapter = ReplayAdapter(store)
+        for prefix in list(session.adapters):
+            session.mount(prefix, adapter)
+    elif record_dir:
+        store = TrafficStore(record_dir)
+        for prefix, inner in list(session.adapters.items()):
+            session.mount(prefix, RecordingAdapter(inner, store))
+    return store
+
+def encode_json(obj):
+    """Serializes obj to compact UTF-8 JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def decode_json(data):
+    """Parses JSON from bytes or str, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _accepts_gzip(profile_config):
+    """
+    Whether a profile's endpoint accepts gzip request bodies. Google APIs do; OpenAI and most local
+    servers don't document it, so they stay uncompressed unless "compress_requests" is set in the profile.
+    """
+    setting = profile_config.get("compress_requests")
+    if setting is not None:
+        return bool(setting)
+    return profile_config.get("provider", "gemini") == "gemini"
+
+def post_json(profile_config, url, payload, headers=None, proxies=None, **kwargs):
+    """POSTs payload as compact JSON over the shared session, gzip-compressing large bodies where the endpoint accepts it."""
+    import gzip
+    body = encode_json(payload)
+    headers = dict(headers or {})
+    headers["Content-Type"] = "application/json"
+    if len(body) >= GZIP_MIN_BYTES and _accepts_gzip(profile_config):
+        body = gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return get_http_session().post(url, data=body, headers=headers, proxies=proxies, **kwargs)
+
+def _openai_api_root(base_url):
+    """Normalizes an OpenAI-compatible base URL to its API root (without a trailing /chat/completions)."""
+    base_url = (base_url or "https://api.openai.com/v1").rstrip("/")
+    if base_url.endswith("/chat/completions"):
+        base_url = base_url[:-len("/chat/completions")]
+    return base_url
+
+def _local_api_root(profile_config):
+    """Returns the API root of a local provider profile, as an http+unix:// URL when socket_path is set."""
+    from urllib.parse import urlparse, quote
+    base_url = profile_config.get("base_url") or DEFAULT_CONFIG["profiles"]["local-default"]["base_url"]
+    socket_path = profile_config.get("socket_path")
+    if socket_path:
+        path = urlparse(base_url).path.rstrip("/") or "/v1"
+        return f"http+unix://{quote(socket_path, safe='')}{path}"
+    return _openai_api_root(base_url)
+
+def _provider_api_root(profile_config):
+    """Returns the API root for OpenAI-compatible profiles (openai and local providers)."""
+    if profile_config.get("provider") == "local":
+        return _local_api_root(profile_config)
+    return _openai_api_root(profile_config.get("base_url"))
+
+def _gemini_api_root(profile_config):
+    """Returns the Gemini API root; a profile's base_url overrides it (e.g. a gateway or `ai mock-server`)."""
+    return (profile_config.get("base_url") or "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+
+def _model_cache_file(profile_config):
+    """Returns the catalog cache file for a profile's provider endpoint (one file per endpoint and key)."""
+    import hashlib
+    provider = profile_config.get("provider", "gemini")
+    base_url = _provider_api_root(profile_config) if provider != "gemini" else _gemini_api_root(profile_config)
+    ident = f"{provider}|{base_url}|{profile_config.get('api_key', '')}"
+    digest = hashlib.sha256(ident.encode("utf-8")).hexdigest()[:16]
+    return MODEL_CACHE_DIR / f"{provider}-{digest}.json"
+
+def _read_model_cache(profile_config):
+    """Reads the cached model catalog for a profile. Returns None if there is no usable cache."""
+    cache_file = _model_cache_file(profile_config)
+    try:
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or not isinstance(cache.get("models"), list):
+        return None
+    return cache
+
+def _write_model_cache(profile_config, cache):
+    """Atomically writes the model catalog cache so concurrent readers never see a partial file."""
+    cache_file = _model_cache_file(profile_config)
+    try:
+        MODEL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+
+def _model_cache_ttl(config):
+    """Returns the model catalog TTL in seconds (config key: model_cache_ttl)."""
+    try:
+        return int((config or {}).get("model_cache_ttl", MODEL_CACHE_TTL))
+    except (TypeError, ValueError):
+        return MODEL_CACHE_TTL
+
+def fetch_model_catalog(profile_config, proxy="", etag=None):
+    """
+    Fetches the list of text generation models from the provider, following pagination.
+    Gemini pages with nextPageToken; OpenAI-compatible servers page with has_more/last_id
+    (the `after` cursor) or a `next` URL. Sends If-None-Match when an ETag is known so
+    unchanged catalogs revalidate with a cheap 304.
+    Returns (status_code, models, etag); models is None on 304 or error.
+    """
+    provider = profile_config.get("provider", "gemini")
+    api_key = profile_config.get("api_key", "")
+    headers = {"If-None-Match": etag} if etag else {}
+    proxies = {"http": proxy, "https": proxy} if proxy and provider != "local" else None
+
+    if provider == "gemini":
+        api_url = f"{_gemini_api_root(profile_config)}/models"
+        params = {"key": api_key, "pageSize": 1000}
+    else:
+        api_url = f"{_provider_api_root(profile_config)}/models"
+        params = {}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+
+    models = []
+    new_etag = etag
+    for page in range(MODEL_CATALOG_MAX_PAGES):
+        response = get_http_session().get(api_url, headers=headers, params=params, proxies=proxies, timeout=15)
+        if page == 0:
+            new_etag = response.headers.get("ETag", etag)
+            # Later pages are never conditional
+            headers.pop("If-None-Match", None)
+        if response.status_code != 200:
+            return response.status_code, None, new_etag
+
+        data = decode_json(response.content)
+        if provider == "gemini":
+            for m in data.get("models", []):
+                if "generateContent" in m.get("supportedGenerationMethods", []):
+                    short_name = m.get("name", "").replace("models/", "")
+                    models.append({
+                        "name": short_name,
+                        "displayName": m.get("displayName", short_name),
+                        "description": m.get("description", "No description available.")
+                    })
+            if not data.get("nextPageToken"):
+                break
+            params["pageToken"] = data["nextPageToken"]
+        else:
+            entries = data.get("data", []) if isinstance(data, dict) else data
+            for m in entries:
+                model_id = m.get("id", "")
+                if model_id:
+                    owner = m.get("owned_by", "")
+                    models.append({
+                        "name": model_id,
+                        "displayName": m.get("name", model_id),
+                        "description": f"Owned by: {owner}" if owner else ""
+                    })
+            if not isinstance(data, dict):
+                break
+            if data.get("has_more") and (data.get("last_id") or entries):
+                params["after"] = data.get("last_id") or entries[-1].get("id")
+            elif data.get("next"):
+                api_url, params = data["next"], {}
+            else:
+                break
+    return 200, models, new_etag
+
+def load_model_catalog(profile_config, proxy="", ttl=MODEL_CACHE_TTL, force_refresh=False):
+    """
+    Returns (models, error) for a profile, serving from the DATA_DIR catalog cache while it is fresh.
+    Stale or forced entries are revalidated with the stored ETag; on network failure the stale
+    catalog is returned together with the error so callers can still show something useful.
+    """
+    import time
+    cache = _read_model_cache(profile_config)
+    now = time.time()
+    if cache and not force_refresh and now - cache.get("fetched_at", 0) < ttl:
+        return cache["models"], None
+
+    cache = cache or {"fetched_at": 0, "etag": None, "models": []}
+    cache["checked_at"] = now
+    try:
+        status, models, etag = fetch_model_catalog(profile_config, proxy=proxy, etag=cache.get("etag"))
+    except Exception as e:
+        _write_model_cache(profile_config, cache)
+        return cache["models"] or None, f"Connection Error: {e}"
+
+    if status == 304 and cache["models"]:
+        cache["fetched_at"] = now
+        _write_model_cache(profile_config, cache)
+        return cache["models"], None
+    if status != 200:
+        _write_model_cache(profile_config, cache)
+        return cache["models"] or None, f"Error {status}"
+
+    _write_model_cache(profile_config, {"fetched_at": now, "checked_at": now, "etag": etag, "models": models})
+    return models, None
+
+def get_cached_models(profile_config, ttl=MODEL_CACHE_TTL):
+    """
+    Returns (models, is_stale) from the catalog cache without touching the network.
+    A catalog only counts as stale once the last refresh attempt is older than MODEL_CACHE_RETRY,
+    so an offline machine doesn't spawn a refresh on every tab press.
+    """
+    import time
+    cache = _read_model_cache(profile_config)
+    if not cache:
+        return None, True
+    now = time.time()
+    is_stale = now - cache.get("fetched_at", 0) >= ttl and now - cache.get("checked_at", 0) >= MODEL_CACHE_RETRY
+    return cache["models"] or None, is_stale
+
+_MODEL_REFRESHES_STARTED = set() # profiles whose catalog refresh this process already started
+
+def can_refresh_models(profile_config):
+    """True if a profile's model catalog can be fetched at all: it has an API key or talks to a local server."""
+    return bool(profile_config.get("api_key")) or profile_config.get("provider") == "local"
+
+def refresh_models_in_background(profile_name):
+    """
+    Spawns a detached process that refreshes a profile's model catalog (used for stale-while-revalidate).
+    At most one refresh per profile is started per process, so a long chat session doesn't start one per command.
+    """
+    if profile_name in _MODEL_REFRESHES_STARTED:
+        return
+    _MODEL_REFRESHES_STARTED.add(profile_name)
+    try:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--refresh-models", profile_name],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True
+        )
+    except OSError:
+        pass
+
+def fuzzy_filter_models(models, query, limit=MODEL_PICK_LIMIT):
+    """
+    Ranks models against a fuzzy query (characters in order, not necessarily adjacent).
+    Substring and prefix matches rank first, then tighter subsequence matches.
+    Returns at most `limit` models so the picker stays responsive with huge local catalogs.
+    """
+    import heapq
+    query = query.lower().replace(" ", "")
+    if not query:
+        return models[:limit]
+
+    def match(target):
+        pos = target.find(query)
+        if pos != -1:
+            return 1000 - pos * 2 - (len(target) - len(query))
+        # Subsequence match: penalize the gaps between matched characters
+        last, gaps = -1, 0
+        for ch in query:
+            nxt = target.find(ch, last + 1)
+            if nxt == -1:
+                return None
+            gaps += nxt - last - 1
+            last = nxt
+        return 500 - gaps
+
+    def score(model):
+        scores = [sc for sc in (match(model["name"].lower()), match(model.get("displayName", "").lower())) if sc is not None]
+        return max(scores) if scores else None
+
+    scored = ((score(m), -idx, m) for idx, m in enumerate(models))
+    top = heapq.nlargest(limit, (item for item in scored if item[0] is not None), key=lambda item: item[:2])
+    return [m for _, _, m in top]
+
 def handle_model_option(config):
-    """Fetches and displays available Gemini models interactively, or directly sets the model if specified."""
-    active_profile = config.get("active_profile", "")
+    """
+    Displays available models from the catalog cache with fuzzy filtering, or directly sets the model if specified.
+    Works on the profile given with -p/--profile (as shell completion does), else on the active profile.
+    """
     profiles = config.get("profiles", {})
-    profile_config = profiles.get(active_profile, {})
-    
-    provider = profile_config.get("provider", "gemini")
-    if provider != "gemini":
-        print(f"{YELLOW}[*] Model listing/switching is currently supported for profiles using the Gemini provider.{RESET}")
-        return 0
+    profile_name = config.get("active_profile", "")
+    for i, arg in enumerate(sys.argv[:-1]):
+        if arg in ["--profile", "-p"] and not sys.argv[i + 1].startswith("-"):
+            profile_name = sys.argv[i + 1].strip()
+            if profile_name not in profiles:
+                print(f"{RED}[Error] Profile '{profile_name}' not found in configuration.{RESET}")
+                return 1
+            break
+    profile_config = profiles.get(profile_name, {})
 
+    provider = profile_config.get("provider", "gemini")
+    provider_label = {"gemini": "Gemini", "local": "Local"}.get(provider, "OpenAI-compatible")
     api_key = profile_config.get("api_key")
-    current_model = profile_config.get("model_name", "gemini-2.5-flash")
+    current_model = profile_config.get("model_name", DEFAULT_MODELS.get(provider, "gpt-4o"))
 
     # Check if a model argument is provided after the flag
     model_arg = ""
@@ -627,268 +1493,3286 @@ def handle_model_option(config):
                 break
 
     if model_arg:
-        clean_model = model_arg.replace("models/", "")
-        config["profiles"][active_profile]["model_name"] = clean_model
+        clean_model = model_arg.replace("models/", "") if provider == "gemini" else model_arg
+        config["profiles"][profile_name]["model_name"] = clean_model
         with open(CONFIG_FILE, "w") as f:
             json.dump(config, f, indent=4)
-        print(f"{GREEN}[✓] Model for profile '{active_profile}' updated successfully to: {clean_model}{RESET}")
+        print(f"{GREEN}[✓] Model for profile '{profile_name}' updated successfully to: {clean_model}{RESET}")
         return 0
 
-    if not api_key:
-        print(f"{RED}[Error] Gemini API key not found for active profile '{active_profile}'. Please configure it first.{RESET}")
+    if not api_key and provider == "gemini":
+        print(f"{RED}[Error] Gemini API key not found for profile '{profile_name}'. Please configure it first.{RESET}")
         return 1
 
-    print(f"{BLUE}[*] Fetching available models from Gemini API...{RESET}")
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models?key={api_key}"
-    try:
-        response = requests.get(api_url)
-        if response.status_code != 200:
-            print(f"{RED}[Error {response.status_code}] Failed to fetch models: {response.text}{RESET}")
+    ttl = _model_cache_ttl(config)
+    force_refresh = "--refresh" in sys.argv
+    generation_models, is_stale = (None, True) if force_refresh else get_cached_models(profile_config, ttl)
+    if generation_models is not None and is_stale:
+        # Serve the stale catalog instantly and revalidate it for the next run
+        refresh_models_in_background(profile_name)
+    elif generation_models is None:
+        if provider == "local" and not ensure_local_server(profile_config):
             return 1
-        data = response.json()
-        models = data.get("models", [])
-        
-        generation_models = []
-        for m in models:
-            name = m.get("name", "")
-            if "generateContent" in m.get("supportedGenerationMethods", []):
-                short_name = name.replace("models/", "")
-                display_name = m.get("displayName", short_name)
-                desc = m.get("description", "No description available.")
-                generation_models.append({
-                    "name": short_name,
-                    "displayName": display_name,
-                    "description": desc
-                })
-
-        if not generation_models:
-            print(f"{YELLOW}[!] No text generation models returned from Gemini API.{RESET}")
-            return 0
+        print(f"{BLUE}[*] Fetching available models from {provider_label} API...{RESET}")
+        generation_models, error = load_model_catalog(profile_config, proxy=config.get("proxy", ""), ttl=ttl, force_refresh=True)
+        if generation_models is None:
+            print(f"{RED}[{error}] Failed to fetch models from {provider_label} API.{RESET}")
+            return 1
+        if error:
+            print(f"{YELLOW}[!] Could not refresh models ({error}). Showing cached list.{RESET}")
+
+    if not generation_models:
+        print(f"{YELLOW}[!] No text generation models returned from {provider_label} API.{RESET}")
+        return 0
 
-        print(f"\n{BLUE}🔍 Available Gemini Text Models:{RESET}")
-        for idx, m in enumerate(generation_models, 1):
+    query = ""
+    while True:
+        shown = fuzzy_filter_models(generation_models, query)
+        title = f"Models matching '{query}'" if query else f"Available {provider_label} Text Models"
+        print(f"\n{BLUE}🔍 {title}:{RESET}")
+        for idx, m in enumerate(shown, 1):
             is_current = f" {GREEN}(active){RESET}" if m["name"] == current_model else ""
-            print(f"  {CYAN}{idx}. {m['displayName']}{RESET} [{YELLOW}{m['name']}{RESET}]{is_current}")
-            print(f"     {m['description']}")
-            print()
+            if m["displayName"] != m["name"]:
+                print(f"  {CYAN}{idx}. {m['displayName']}{RESET} [{YELLOW}{m['name']}{RESET}]{is_current}")
+            else:
+                print(f"  {CYAN}{idx}. {m['name']}{RESET}{is_current}")
+            if m.get("description"):
+                print(f"     {m['description']}")
+            if provider == "gemini":
+                print()
+        if not shown:
+            print(f"  {YELLOW}No models match '{query}'.{RESET}")
+        total = len(generation_models)
+        if not query and total > len(shown):
+            print(f"  {YELLOW}... {total - len(shown)} more. Type part of a name to filter.{RESET}")
 
         try:
-            choice = input(f"Select a model number to set as active (or press Enter to cancel): ").strip()
-            if not choice:
-                print("Cancelled.")
-                return 0
-            choice_idx = int(choice) - 1
-            if 0 <= choice_idx < len(generation_models):
-                selected_model = generation_models[choice_idx]["name"]
-                config["profiles"][active_profile]["model_name"] = selected_model
-                with open(CONFIG_FILE, "w") as f:
-                    json.dump(config, f, indent=4)
-                print(f"{GREEN}[✓] Gemini model for profile '{active_profile}' successfully updated to: {selected_model}{RESET}")
-            else:
-                print(f"{RED}[!] Invalid choice.{RESET}")
-        except ValueError:
-            print(f"{RED}[!] Invalid number entered.{RESET}")
+            choice = input(f"\nSelect a model number, type text to filter (or press Enter to cancel): ").strip()
         except (KeyboardInterrupt, EOFError):
             print("\nCancelled.")
-            
+            return 0
+        if not choice:
+            print("Cancelled.")
+            return 0
+        if not choice.isdigit():
+            query = choice
+            continue
+        choice_idx = int(choice) - 1
+        if 0 <= choice_idx < len(shown):
+            selected_model = shown[choice_idx]["name"]
+            config["profiles"][profile_name]["model_name"] = selected_model
+            with open(CONFIG_FILE, "w") as f:
+                json.dump(config, f, indent=4)
+            print(f"{GREEN}[✓] Model for profile '{profile_name}' successfully updated to: {selected_model}{RESET}")
+        else:
+            print(f"{RED}[!] Invalid choice.{RESET}")
         return 0
-    except Exception as e:
-        print(f"{RED}[Connection Error] Failed to contact Gemini API: {e}{RESET}")
-        return 1
 
-def render_markdown(text):
-    """Renders basic Markdown beautifully in terminal using ANSI escape codes, with an optional rich-library fallback."""
-    if not sys.stdout.isatty():
-        return text
+def switch_chat_target(config, active_config, target_profile, command, value):
+    """
+    Handles the in-chat /profile and /model commands. Returns (active_config, target_profile) for the
+    new target, or None when nothing changed. The switch only lasts for the session; config.json is untouched.
+    History is provider-neutral, so the conversation carries over as-is.
+    """
+    if command == "/profile":
+        profiles = config.get("profiles", {})
+        if not value:
+            for name, p_config in profiles.items():
+                marker = "*" if name == target_profile else " "
+                print(f"  {marker} {CYAN}{name}{RESET} [{YELLOW}{p_config.get('provider', 'gemini')}{RESET}]")
+            return None
+        if value not in profiles:
+            print(f"{RED}[Error] Profile '{value}' not found in configuration.{RESET}")
+            return None
+        new_config = profiles[value]
+        if new_config.get("provider", "gemini") not in ["gemini", "openai", "local"]:
+            print(f"{RED}[Error] Invalid provider '{new_config.get('provider')}' in profile '{value}'.{RESET}")
+            return None
+        return new_config, value
 
-    # Try to use rich library if available
-    try:
-        from rich.console import Console
-        from rich.markdown import Markdown
-        import io
-        string_io = io.StringIO()
-        console = Console(file=string_io, force_terminal=True)
-        console.print(Markdown(text))
-        return string_io.getvalue().strip()
-    except ImportError:
-        pass
+    # /model: check the name against the cached catalog (no network), accepting it as-is when no catalog is cached
+    models, is_stale = get_cached_models(active_config, _model_cache_ttl(config))
+    if is_stale and can_refresh_models(active_config):
+        refresh_models_in_background(target_profile)
+    if not value:
+        provider = active_config.get("provider", "gemini")
+        print(f"  Current model: {CYAN}{active_config.get('model_name', DEFAULT_MODELS.get(provider, ''))}{RESET}")
+        if models:
+            print("  Available: " + ", ".join(m["name"] for m in models[:MODEL_PICK_LIMIT]))
+        return None
+    if models and value not in [m["name"] for m in models]:
+        matches = fuzzy_filter_models(models, value, limit=5)
+        if len(matches) != 1:
+            suggestions = ", ".join(m["name"] for m in matches) or "none"
+            print(f"{RED}[Error] Model '{value}' not found. Closest matches: {suggestions}{RESET}")
+            return None
+        value = matches[0]["name"]
+    return dict(active_config, model_name=value), target_profile
 
-    # High-fidelity custom ANSI renderer fallback
-    lines = text.split("\n")
-    rendered_lines = []
-    in_code_block = False
-    code_lang = ""
+class CodeHighlighter:
+    """
+    Line-at-a-time syntax highlighting for fenced code blocks. Each language's highlighter is created on
+    first use and cached: a pygments lexer when pygments is installed, otherwise built-in rules for
+    shell, Python and JSON. Lines are highlighted independently, so streamed code can be shown as it arrives.
+    """
+    BASE = "\033[93m"
+    RULES = {
+        "python": [
+            ("comment", r"#.*"),
+            ("string", r"[rbfu]{0,2}(?:'''|\"\"\"|'(?:\\.|[^'\\])*'|\"(?:\\.|[^\"\\])*\")"),
+            ("decorator", r"@[\w.]+"),
+            ("keyword", r"\b(?:def|class|return|if|elif|else|for|while|in|is|not|and|or|import|from|as|with|try|except|finally|raise|pass|break|continue|lambda|yield|async|await|global|nonlocal|del|assert)\b"),
+            ("constant", r"\b(?:None|True|False|self)\b"),
+            ("number", r"\b\d[\d_]*(?:\.\d+)?(?:[eE][+-]?\d+)?\b"),
+        ],
+        "shell": [
+            ("comment", r"(?<!\S)#.*"),
+            ("string", r"'[^']*'|\"(?:\\.|[^\"\\])*\""),
+            ("variable", r"\$\{[^}]*\}|\$(?:\w+|[@#?*!$-])"),
+            ("keyword", r"\b(?:if|then|else|elif|fi|for|while|until|do|done|case|esac|in|function|return|export|local|sudo)\b"),
+            ("option", r"(?<!\S)--?[\w][\w-]*"),
+            ("operator", r"\|\||&&|[|;&<>]"),
+        ],
+        "json": [
+            ("key", r"\"(?:\\.|[^\"\\])*\"(?=\s*:)"),
+            ("string", r"\"(?:\\.|[^\"\\])*\""),
+            ("number", r"-?\b\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b"),
+            ("constant", r"\b(?:true|false|null)\b"),
+        ],
+    }
+    COLORS = {
+        "comment": "\033[90m", "string": "\033[92m", "keyword": "\033[95m", "constant": "\033[96m",
+        "number": "\033[96m", "decorator": "\033[94m", "variable": "\033[94m", "key": "\033[94m",
+        "option": "\033[36m", "operator": "\033[95m"
+    }
+    ALIASES = {
+        "py": "python", "python3": "python", "py3": "python", "sh": "shell", "bash": "shell", "zsh": "shell",
+        "console": "shell", "shell-session": "shell", "jsonc": "json", "json5": "json"
+    }
 
-    for line in lines:
-        # 1. Handle Code Block boundaries
-        if line.strip().startswith("```"):
-            if not in_code_block:
-                in_code_block = True
-                code_lang = line.strip()[3:].strip()
-                lang_str = f" {code_lang.upper()} " if code_lang else " CODE "
-                border = f"\033[96m┌──────────────────{lang_str}──────────────────\033[0m"
-                rendered_lines.append(border)
-            else:
-                in_code_block = False
-                border = "\033[96m└───────────────────────────────────────────────\033[0m"
-                rendered_lines.append(border)
-            continue
+    def __init__(self):
+        self._highlighters = {}
+        self._pygments = None
 
-        # 2. Inside Code Block
-        if in_code_block:
-            rendered_lines.append(f"\033[93m{line}\033[0m")
-            continue
+    def highlight(self, line, lang):
+        """Returns the line with ANSI colors for `lang` (plain code color when the language is unknown)."""
+        return self._get(lang)[0](line)
 
-        # 3. Headers (# Header, ## Header, etc.)
-        if line.strip().startswith("#"):
-            stripped = line.strip()
-            header_text = stripped.lstrip("#").strip()
-            rendered_lines.append(f"\033[1;96m✦ {header_text}\033[0m")
-            continue
+    def highlight_block(self, lines, lang):
+        """Highlights a whole code block. pygments lexes it in one call, which is far cheaper than line by line."""
+        return self._get(lang)[1](lines)
 
-        # 4. Bullet Points (* item, - item, etc.)
-        stripped_line = line.lstrip()
-        indent = line[:len(line) - len(stripped_line)]
-        if stripped_line.startswith("* ") or stripped_line.startswith("- ") or stripped_line.startswith("+ "):
-            bullet_text = stripped_line[2:]
-            rendered_lines.append(f"{indent}\033[92m•\033[0m {bullet_text}")
-            continue
+    def _get(self, lang):
+        lang = (lang or "").lower()
+        highlighter = self._highlighters.get(lang)
+        if highlighter is None:
+            highlighter = self._highlighters[lang] = self._build(lang)
+        return highlighter
 
-        # 5. Inline formatting (Bold, Italic, Inline Code)
-        formatted_line = line
-        import re
-        formatted_line = re.sub(r'`([^`]+)`', r'\033[96m\1\033[0m', formatted_line)
-        formatted_line = re.sub(r'\*\*([^*]+)\*\*', r'\033[1m\1\033[22m', formatted_line)
-        formatted_line = re.sub(r'\*([^*]+)\*', r'\033[3m\1\033[23m', formatted_line)
+    def _build(self, lang):
+        """Returns (highlight_line, highlight_lines) functions for a language."""
+        if self._pygments is None:
+            try:
+                from pygments import highlight
+                from pygments.formatters import Terminal256Formatter
+                self._pygments = (highlight, Terminal256Formatter())
+            except ImportError:
+                self._pygments = False
+        if self._pygments and lang:
+            from pygments.lexers import get_lexer_by_name
+            from pygments.util import ClassNotFound
+            try:
+                lexer = get_lexer_by_name(lang, stripnl=False, ensurenl=False)
+            except ClassNotFound:
+                lexer = None
+            if lexer is not None:
+                highlight, formatter = self._pygments
+                highlight_line = lambda line: highlight(line, lexer, formatter).rstrip("\n")
 
-        rendered_lines.append(formatted_line)
+                def highlight_lines(lines):
+                    result = highlight("\n".join(lines), lexer, formatter).split("\n")
+                    return result if len(result) == len(lines) else [highlight_line(line) for line in lines]
+                return highlight_line, highlight_lines
 
-    return "\n".join(rendered_lines)
+        rules = self.RULES.get(self.ALIASES.get(lang, lang))
+        base = self.BASE
+        if rules:
+            pattern = re.compile("|".join(f"(?P<{name}>{regex})" for name, regex in rules))
+            colors = self.COLORS
+            paint = lambda m: f"{colors[m.lastgroup]}{m.group()}{base}"
+            highlight_line = lambda line: base + pattern.sub(paint, line)
+        else:
+            highlight_line = lambda line: base + line
+        return highlight_line, lambda lines: [highlight_line(line) for line in lines]
 
-def send_gemini_request(profile_config, user_input, debug_mode, proxy="", history=None, output_file=None):
-    api_key = profile_config.get("api_key")
-    model_name = profile_config.get("model_name", "gemini-2.5-flash")
-    system_instr = profile_config.get("system_instruction", "")
-    gen_config = profile_config.get("generation_config", {})
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
-    
-    payload_contents = history if history is not None else [{"parts": [{"text": user_input}]}]
-    payload = {
-        "contents": payload_contents,
-        "systemInstruction": {"parts": [{"text": system_instr}]},
-        "generationConfig": gen_config
-    }
-    if debug_mode: print(f"[Debug] Provider: Gemini | Model: {model_name} | Temp: {gen_config.get('temperature')} | Proxy: {proxy if proxy else 'None'}")
-    try:
-        proxies = {"http": proxy, "https": proxy} if proxy else None
-        response = requests.post(api_url, json=payload, proxies=proxies)
-        if debug_mode:
-            print(f"[Debug] Status: {response.status_code}")
-        if response.status_code != 200:
-            if response.status_code == 429:
+class MarkdownRenderer:
+    """
+    ANSI Markdown renderer used when rich isn't installed. Patterns are compiled once per process and
+    style strings are cached, so rendering is a single pass over the lines. Handles headers, bullet and
+    numbered lists, tables, fenced code blocks (syntax highlighted) and nested inline emphasis.
+    Whole documents go through render() or render_lines(); streamed text goes through feed() and finish().
+    Lines are not wrapped here: code, table and border lines come back as Verbatim and TerminalLayout
+    wraps the rest for the current width, so a resize only needs a re-wrap, not a re-render.
+    """
+    FENCE = re.compile(r"^\s*```\s*([\w+#.-]*)")
+    HEADER = re.compile(r"^\s*(#{1,6})\s+(.*?)\s*#*\s*$")
+    BULLET = re.compile(r"^(\s*)[*+-]\s+(.*)$")
+    NUMBERED = re.compile(r"^(\s*)(\d+)[.)]\s+(.*)$")
+    TABLE_ROW = re.compile(r"^\s*\|.*\|\s*$")
+    TABLE_SEPARATOR = re.compile(r"^\s*\|?(\s*:?-+:?\s*\|)+\s*(:?-+:?\s*)?\|?\s*$")
+    INLINE_CODE = re.compile(r"`([^`\n]+)`")
+    CODE_PLACEHOLDER = re.compile("\x00(\\d+)\x00")
+    BOLD_ITALIC = re.compile(r"\*\*\*(?=\S)(.+?)(?<=\S)\*\*\*")
+    BOLD = re.compile(r"\*\*(?=\S)(.+?)(?<=\S)\*\*")
+    BOLD_UNDERSCORE = re.compile(r"__(?=\S)(.+?)(?<=\S)__")
+    # Patterns start with the literal marker (lookbehind after it) so the regex engine can skip ahead quickly
+    ITALIC = re.compile(r"\*(?<![*\w]\*)(?=[^\s*])(.+?)(?<=[^\s*])\*(?![*\w])")
+    ITALIC_UNDERSCORE = re.compile(r"_(?<!\w_)(?=\S)(.+?)(?<=\S)_(?!\w)")
+    STRIKE = re.compile(r"~~(?=\S)(.+?)(?<=\S)~~")
+    ANSI = re.compile(r"\033\[[0-9;]*m")
+    # Cell separators: pipes that aren't escaped or inside a rendered code span (which ends with \033[39m)
+    CELL_SPLIT = re.compile(r"(?<!\\)\|(?![^\033]*\033\[39m)")
+
+    RESET = "\033[0m"
+    BORDER_STYLE = "\033[96m"
+
+    def __init__(self, highlight=True):
+        self._borders = {}
+        self.highlighter = CodeHighlighter() if highlight else None
+        self.reset()
+
+    def reset(self):
+        """Clears block state (open code fence, pending table rows, partial streamed line) before a new document."""
+        self.in_code_block = False
+        self.code_lang = ""
+        self.table_rows = []
+        self._pending = ""
+
+    def feed(self, chunk):
+        """Streaming: consumes a chunk of Markdown and returns the rendered lines it completed (possibly none)."""
+        self._pending += chunk
+        if "\n" not in chunk:
+            return []
+        lines = self._pending.split("\n")
+        self._pending = lines.pop()
+        out = []
+        for line in lines:
+            self.render_line(line, out)
+        return out
+
+    def finish(self):
+        """Streaming: renders the last partial line and any pending table, then resets for the next document."""
+        out = []
+        if self._pending:
+            self.render_line(self._pending, out)
+        self.flush(out)
+        self.reset()
+        return out
+
+    def render(self, text):
+        """Renders a whole Markdown document to an ANSI string (unwrapped)."""
+        return "\n".join(self.render_lines(text))
+
+    def render_lines(self, text):
+        """Renders a whole Markdown document to a list of ANSI lines."""
+        self.reset()
+        lines = text.split("\n")
+        # Inline formatting never spans lines, so it runs once over all prose lines together
+        # (code blocks excluded) instead of once per line
+        prose = []
+        code_blocks = {} # opening fence index -> closing fence index
+        opened = None
+        for index, line in enumerate(lines):
+            if line.lstrip().startswith("```"):
+                if opened is None:
+                    opened = index
+                else:
+                    code_blocks[opened] = index
+                    opened = None
+            elif opened is None:
+                prose.append(index)
+        if opened is not None:
+            code_blocks[opened] = len(lines)
+        if prose:
+            formatted = self.inline("\n".join([lines[i] for i in prose])).split("\n")
+            for index, line in zip(prose, formatted):
+                lines[index] = line
+        out = []
+        index = 0
+        while index < len(lines):
+            line = lines[index]
+            end = code_blocks.get(index)
+            if end is not None:
+                self.flush(out)
+                lang = self.FENCE.match(line).group(1)
+                out.append(self._border(lang))
+                code_lines = lines[index + 1:end]
+                if self.highlighter:
+                    code_lines = self.highlighter.highlight_block(code_lines, lang)
+                else:
+                    code_lines = [CodeHighlighter.BASE + code for code in code_lines]
+                out.extend(Verbatim(f"{code}{self.RESET}") for code in code_lines)
+                if end < len(lines):
+                    out.append(self._border(None))
+                index = end + 1
+                continue
+            first = line.lstrip()[:1]
+            # Plain prose needs no block handling
+            if self.table_rows or (first and (first in "`|#*+-" or first.isdigit())):
+                self.render_line(line, out, formatted=True)
+            else:
+                out.append(line)
+            index += 1
+        self.flush(out)
+        return out
+
+    @staticmethod
+    def _as_is(text):
+        return text
+
+    def render_line(self, line, out, formatted=False):
+        """
+        Renders one source line, appending zero or more output lines to `out` (table rows are held until
+        the table ends). `formatted` means inline formatting was already applied to the line.
+        """
+        inline = self._as_is if formatted else self.inline
+        stripped = line.lstrip()
+        # Dispatch on the first character so most lines skip the block patterns entirely
+        first = stripped[:1]
+        fence = self.FENCE.match(line) if first == "`" else None
+        if fence:
+            self.flush(out)
+            if not self.in_code_block:
+                self.in_code_block = True
+                self.code_lang = fence.group(1)
+                out.append(self._border(self.code_lang))
+            else:
+                self.in_code_block = False
+                out.append(self._border(None))
+            return
+        if self.in_code_block:
+            code = self.highlighter.highlight(line, self.code_lang) if self.highlighter else CodeHighlighter.BASE + line
+            out.append(Verbatim(f"{code}{self.RESET}"))
+            return
+
+        if first == "|" and self.TABLE_ROW.match(line):
+            self.table_rows.append(inline(line))
+            return
+        if self.table_rows:
+            self.flush(out)
+
+        if first == "#":
+            header = self.HEADER.match(line)
+            if header:
+                out.append(f"\033[1;96m✦ {inline(header.group(2))}{self.RESET}")
+                return
+        elif first in ("*", "-", "+"):
+            bullet = self.BULLET.match(line)
+            if bullet:
+                out.append(f"{bullet.group(1)}\033[92m•{self.RESET} {inline(bullet.group(2))}")
+                return
+        elif first.isdigit():
+            numbered = self.NUMBERED.match(line)
+            if numbered:
+                out.append(f"{numbered.group(1)}\033[92m{numbered.group(2)}.{self.RESET} {inline(numbered.group(3))}")
+                return
+        out.append(inline(line))
+
+    def flush(self, out):
+        """Emits any pending table."""
+        if self.table_rows:
+            out.extend(self._table(self.table_rows))
+            self.table_rows = []
+
+    def inline(self, text):
+        """Applies inline code, bold, italic and strikethrough. Emphasis may nest; code spans are left untouched."""
+        if "`" in text:
+            spans = []
+
+            def stash(match):
+                spans.append(match.group(1))
+                return f"\x00{len(spans) - 1}\x00"
+            text = self.INLINE_CODE.sub(stash, text)
+        else:
+            spans = None
+        if "*" in text:
+            if "***" in text:
+                text = self.BOLD_ITALIC.sub("\033[1;3m\\1\033[22;23m", text)
+            if "**" in text:
+                text = self.BOLD.sub("\033[1m\\1\033[22m", text)
+            if "*" in text:
+                text = self.ITALIC.sub("\033[3m\\1\033[23m", text)
+        if "_" in text:
+            if "__" in text:
+                text = self.BOLD_UNDERSCORE.sub("\033[1m\\1\033[22m", text)
+            text = self.ITALIC_UNDERSCORE.sub("\033[3m\\1\033[23m", text)
+        if "~~" in text:
+            text = self.STRIKE.sub("\033[9m\\1\033[29m", text)
+        if spans:
+            text = self.CODE_PLACEHOLDER.sub(lambda m: f"\033[96m{spans[int(m.group(1))]}\033[39m", text)
+        return text
+
+    def _border(self, lang):
+        """Code fence borders, cached per language (None = closing border)."""
+        border = self._borders.get(lang)
+        if border is None:
+            if lang is None:
+                border = f"{self.BORDER_STYLE}└───────────────────────────────────────────────{self.RESET}"
+            else:
+                label = f" {lang.upper()} " if lang else " CODE "
+                border = f"{self.BORDER_STYLE}┌──────────────────{label}──────────────────{self.RESET}"
+            border = self._borders[lang] = Verbatim(border)
+        return border
+
+    def _width(self, text):
+        """Visible terminal width of rendered text (ANSI codes excluded, wide characters count double)."""
+        if "\033" in text:
+            text = self.ANSI.sub("", text)
+        return len(text) if text.isascii() else visual_len(text)
+
+    def _table(self, rows):
+        """Renders buffered (already inline-formatted) table rows as a box-drawn grid with padded columns and a bold header row."""
+        cells = [[cell.strip().replace("\\|", "|") for cell in self.CELL_SPLIT.split(row.strip()[1:-1])] for row in rows if not self.TABLE_SEPARATOR.match(row)]
+        if not cells:
+            return []
+        columns = max(len(row) for row in cells)
+        for row in cells:
+            row.extend([""] * (columns - len(row)))
+        cell_widths = [[self._width(cell) for cell in row] for row in cells]
+        widths = [max(row[i] for row in cell_widths) for i in range(columns)]
+        b = self.BORDER_STYLE
+        lines = [f"{b}┌" + "┬".join("─" * (w + 2) for w in widths) + f"┐{self.RESET}"]
+        for index, row in enumerate(cells):
+            padded = []
+            for cell, cell_width, width in zip(row, cell_widths[index], widths):
+                pad = " " * (width - cell_width)
+                padded.append(f" \033[1m{cell}\033[22m{pad} " if index == 0 else f" {cell}{pad} ")
+            lines.append(f"{b}│{self.RESET}" + f"{b}│{self.RESET}".join(padded) + f"{b}│{self.RESET}")
+            if index == 0 and len(cells) > 1:
+                lines.append(f"{b}├" + "┼".join("─" * (w + 2) for w in widths) + f"┤{self.RESET}")
+        lines.append(f"{b}└" + "┴".join("─" * (w + 2) for w in widths) + f"┘{self.RESET}")
+        return [Verbatim(line) for line in lines]
+
+_MARKDOWN_RENDERER = None
+
+def _rich_available():
+    """True when the rich library is installed (render_markdown then prefers it over MarkdownRenderer)."""
+    import importlib.util
+    return importlib.util.find_spec("rich") is not None
+
+def render_markdown(text):
+    """Renders basic Markdown beautifully in terminal using ANSI escape codes, with an optional rich-library fallback."""
+    if not sys.stdout.isatty():
+        return text
+    return "\n".join(TERMINAL.wrap_lines(render_markdown_lines(text)))
+
+def render_markdown_lines(text):
+    """Renders Markdown to unwrapped lines for TerminalLayout (rich lays out its own output, so its lines are Verbatim)."""
+    global _MARKDOWN_RENDERER
+    # Try to use rich library if available
+    try:
+        from rich.console import Console
+        from rich.markdown import Markdown
+        import io
+        string_io = io.StringIO()
+        console = Console(file=string_io, force_terminal=True, width=TERMINAL.columns)
+        console.print(Markdown(text))
+        return [Verbatim(line) for line in string_io.getvalue().strip().split("\n")]
+    except ImportError:
+        pass
+
+    # High-fidelity custom ANSI renderer fallback
+    if _MARKDOWN_RENDERER is None:
+        _MARKDOWN_RENDERER = MarkdownRenderer()
+    return _MARKDOWN_RENDERER.render_lines(text)
+
+def compact_input(stream):
+    """
+    Log-aware preprocessing for piped input (--compact-input). Reads the stream line by line,
+    strips ANSI codes, normalizes timestamps, UUIDs, hex addresses and long numeric IDs, groups
+    stack traces with their continuation lines, and collapses repeated lines and near-identical
+    traces into their first occurrence with a repeat count. Only unique records are kept in memory.
+    Returns (compacted_text, stats).
+    """
+    ansi = re.compile(r"\x1b\[[0-9;?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\r")
+    substitutions = [
+        (re.compile(r"\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?"), "<TS>"),
+        (re.compile(r"\b(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) +\d{1,2} \d{2}:\d{2}:\d{2}\b"), "<TS>"),
+        (re.compile(r"\b\d{2}:\d{2}:\d{2}(?:[.,]\d+)?\b"), "<TS>"),
+        (re.compile(r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b"), "<UUID>"),
+        (re.compile(r"\b0x[0-9a-fA-F]+\b|\b(?=[0-9a-fA-F]*\d)(?=[0-9a-fA-F]*[a-fA-F])[0-9a-fA-F]{12,}\b"), "<HEX>"),
+        (re.compile(r"\b\d{6,}\b"), "<N>"),
+    ]
+    continuation = re.compile(r"^(?:\s|at |Caused by:|\.\.\. \d+ more)")
+    digits = re.compile(r"\d+")
+
+    records = {}
+    stats = {"bytes_in": 0, "lines_in": 0}
+    block = []
+
+    def flush():
+        if not block:
+            return
+        text = "\n".join(block)
+        # Near-identical traces differ only in line numbers and counters: fingerprint without digits
+        fingerprint = digits.sub("#", text) if len(block) > 1 else text
+        if fingerprint in records:
+            records[fingerprint][1] += 1
+        else:
+            records[fingerprint] = [text, 1]
+        block.clear()
+
+    for raw in stream:
+        stats["bytes_in"] += len(raw.encode("utf-8", "replace"))
+        stats["lines_in"] += 1
+        line = ansi.sub("", raw.rstrip("\n")).rstrip()
+        if not line.strip():
+            continue
+        for pattern, token in substitutions:
+            line = pattern.sub(token, line)
+        in_traceback = bool(block) and block[0].startswith("Traceback") and len(block) > 1
+        # A Python traceback ends with its first unindented line (the exception message)
+        is_traceback_tail = in_traceback and not line[0].isspace()
+        if block and (continuation.match(line) or is_traceback_tail):
+            block.append(line)
+            if is_traceback_tail:
+                flush()
+            continue
+        flush()
+        block.append(line)
+    flush()
+
+    out_lines = []
+    for text, count in records.values():
+        if count > 1:
+            first, _, rest = text.partition("\n")
+            text = f"{first}  [x{count}]" + (f"\n{rest}" if rest else "")
+        out_lines.append(text)
+    compacted = "\n".join(out_lines)
+    stats["bytes_out"] = len(compacted.encode("utf-8"))
+    stats["lines_out"] = compacted.count("\n") + 1 if compacted else 0
+    return compacted, stats
+
+def read_piped_input(compact=False, debug_mode=False):
+    """Reads piped stdin, optionally through compact_input, and reports the size reduction in debug mode."""
+    if not compact:
+        return sys.stdin.read().strip()
+    text, stats = compact_input(sys.stdin)
+    if debug_mode:
+        ratio = stats["bytes_in"] / stats["bytes_out"] if stats["bytes_out"] else 0
+        print(f"[Debug] Compacted input: {stats['bytes_in']} -> {stats['bytes_out']} bytes ({ratio:.1f}x), {stats['lines_in']} -> {stats['lines_out']} lines")
+    return text.strip()
+
+def _git_visible_files(root):
+    """Lists files under `root` that git does not ignore (tracked + untracked, honoring .gitignore), or None outside a repo."""
+    try:
+        result = subprocess.run(["git", "-C", str(root), "ls-files", "-z", "--cached", "--others", "--exclude-standard"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=15)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        return None
+    return [Path(root) / name for name in result.stdout.decode("utf-8", "replace").split("\0") if name]
+
+def _walk_context_files(root):
+    """
+    Walks `root` without git, applying .gitignore patterns found along the way (basic glob semantics).
+    termai's config directory is never entered: it holds API keys.
+    """
+    import fnmatch
+    root = Path(root)
+    config_dir = CONFIG_DIR.resolve()
+    rules = []  # (base_dir, pattern, dir_only, anchored)
+    for dirpath, dirnames, filenames in os.walk(root):
+        base = Path(dirpath)
+        gitignore = base / ".gitignore"
+        if gitignore.is_file():
+            try:
+                for raw in gitignore.read_text(errors="replace").splitlines():
+                    raw = raw.strip()
+                    if raw and not raw.startswith(("#", "!")):
+                        pattern = raw.strip("/")
+                        rules.append((base, pattern, raw.endswith("/"), raw.startswith("/") or "/" in pattern))
+            except OSError:
+                pass
+
+        def ignored(path, is_dir):
+            for rule_base, pattern, dir_only, anchored in rules:
+                if dir_only and not is_dir:
+                    continue
+                try:
+                    rel = path.relative_to(rule_base).as_posix()
+                except ValueError:
+                    continue
+                if fnmatch.fnmatch(rel, pattern) or (not anchored and fnmatch.fnmatch(path.name, pattern)):
+                    return True
+            return False
+
+        dirnames[:] = [d for d in dirnames if d not in CONTEXT_SKIP_DIRS and not ignored(base / d, True)
+                       and (base / d).resolve() != config_dir]
+        for name in filenames:
+            if not ignored(base / name, False):
+                yield base / name
+
+def _read_context_file(path):
+    """Reads a text file for context; returns None for binary, unreadable or oversized files. Binary files are detected from their first 8 KB, before the rest is read."""
+    try:
+        size = path.stat().st_size
+        if size == 0 or size > CONTEXT_MAX_FILE_BYTES:
+            return None
+        with open(path, "rb") as f:
+            head = f.read(8192)
+            if b"\0" in head:
+                return None
+            # Capped: a file that grew since stat() is not read past the limit
+            data = head + f.read(CONTEXT_MAX_FILE_BYTES - len(head))
+    except OSError:
+        return None
+    return data.decode("utf-8", "replace")
+
+def _lexical_tokens(text):
+    """Lowercased identifier/word tokens; snake_case and camelCase identifiers also contribute their parts."""
+    tokens = []
+    for word in re.findall(r"[A-Za-z][A-Za-z0-9_]*|\d+", text):
+        lower = word.lower()
+        tokens.append(lower)
+        parts = [p.lower() for p in re.findall(r"[A-Z]?[a-z0-9]+|[A-Z]+(?![a-z])", word.replace("_", " ")) if p]
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+def build_file_context(paths, question, budget_tokens=CONTEXT_TOKEN_BUDGET, debug_mode=False):
+    """
+    Builds prompt context from files and directories (--context). Files are discovered honoring
+    .gitignore, read in parallel (binary files skipped, sizes capped), split into
+    line chunks, ranked with BM25 against the question, and the best chunks are packed until the
+    token budget (estimated at 4 characters per token) is used. Returns (context_text, stats).
+    """
+    import math
+    from collections import Counter
+    from concurrent.futures import ThreadPoolExecutor
+
+    files = []
+    for raw_path in paths:
+        path = Path(raw_path).expanduser()
+        if path.is_file():
+            files.append(path)
+        elif path.is_dir():
+            visible = _git_visible_files(path)
+            files.extend(f for f in (visible if visible is not None else _walk_context_files(path)) if f.is_file())
+        else:
+            print(f"{YELLOW}[!] Context path not found: {raw_path}{RESET}")
+
+    with ThreadPoolExecutor(max_workers=min(16, (os.cpu_count() or 2) * 2)) as pool:
+        contents = list(pool.map(_read_context_file, files))
+
+    chunks = []  # (path, start_line, end_line, text)
+    for path, text in zip(files, contents):
+        if text is None:
+            continue
+        lines = text.splitlines()
+        for start in range(0, len(lines), CONTEXT_CHUNK_LINES):
+            body = "\n".join(lines[start:start + CONTEXT_CHUNK_LINES])
+            if body.strip():
+                chunks.append((path, start + 1, min(start + CONTEXT_CHUNK_LINES, len(lines)), body))
+
+    stats = {"files": sum(1 for c in contents if c is not None), "skipped": sum(1 for c in contents if c is None),
+             "chunks": len(chunks), "selected": 0, "tokens": 0}
+    if not chunks:
+        return "", stats
+
+    # BM25 over chunks; the file path is part of each chunk's document so file names count as evidence
+    k1, b = 1.2, 0.75
+    docs = [Counter(_lexical_tokens(f"{path.as_posix()} {body}")) for path, _, _, body in chunks]
+    lengths = [sum(doc.values()) for doc in docs]
+    avg_len = sum(lengths) / len(lengths) or 1
+    query_terms = set(_lexical_tokens(question))
+    df = Counter(term for doc in docs for term in query_terms if term in doc)
+    idf = {term: math.log(1 + (len(docs) - df[term] + 0.5) / (df[term] + 0.5)) for term in query_terms}
+    scores = []
+    for idx, (doc, length) in enumerate(zip(docs, lengths)):
+        score = 0.0
+        for term in query_terms:
+            tf = doc.get(term)
+            if tf:
+                score += idf[term] * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avg_len))
+        scores.append((score, idx))
+    scores.sort(key=lambda item: (-item[0], item[1]))
+
+    selected, used = [], 0
+    for score, idx in scores:
+        # Without query terms (e.g. chat with no question yet) chunks are packed in file order
+        if score <= 0 and query_terms and selected:
+            break
+        path, start, end, body = chunks[idx]
+        cost = (len(body) + len(str(path)) + 32) // 4
+        if used + cost > budget_tokens:
+            continue
+        selected.append(idx)
+        used += cost
+    stats["selected"], stats["tokens"] = len(selected), used
+    if debug_mode:
+        print(f"[Debug] Context: {stats['files']} files read, {stats['skipped']} skipped, {stats['chunks']} chunks, "
+              f"{stats['selected']} packed (~{used} tokens)")
+
+    # Present the chosen chunks in file order so the model sees coherent excerpts
+    parts = []
+    for idx in sorted(selected, key=lambda i: (str(chunks[i][0]), chunks[i][1])):
+        path, start, end, body = chunks[idx]
+        parts.append(f"### {path} (lines {start}-{end})\n```\n{body}\n```")
+    return "\n\n".join(parts), stats
+
+class Message:
+    """
+    One chat turn in provider-neutral form ("user" or "assistant" plus text). The Gemini and
+    OpenAI wire forms are built on first use and cached, so unchanged turns aren't rebuilt per request.
+    """
+    __slots__ = ("role", "text", "_gemini", "_openai")
+
+    def __init__(self, role, text):
+        self.role = role
+        self.text = text
+        self._gemini = None
+        self._openai = None
+
+    def encode(self, provider):
+        """Returns this turn in the provider's message format (local servers use the OpenAI format)."""
+        if provider == "gemini":
+            if self._gemini is None:
+                self._gemini = {"role": "model" if self.role == "assistant" else "user", "parts": [{"text": self.text}]}
+            return self._gemini
+        if self._openai is None:
+            self._openai = {"role": self.role, "content": self.text}
+        return self._openai
+
+class ChatHistory:
+    """Ordered chat turns, serialized lazily for whichever provider the next request goes to."""
+    __slots__ = ("messages",)
+
+    def __init__(self, messages=None):
+        self.messages = list(messages or [])
+
+    def add(self, role, text):
+        self.messages.append(Message(role, text))
+
+    def copy(self):
+        """Snapshot sharing the (immutable) Message objects and their cached encodings."""
+        return ChatHistory(self.messages)
+
+    def encode(self, provider):
+        return [m.encode(provider) for m in self.messages]
+
+    def char_count(self):
+        return sum(len(m.text) for m in self.messages)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+def normalize_usage(provider, data):
+    """Extracts prompt/completion/cached token counts from a provider response into one shape."""
+    if provider == "gemini":
+        usage = data.get("usageMetadata", {}) or {}
+        return {
+            "prompt_tokens": usage.get("promptTokenCount", 0),
+            "completion_tokens": usage.get("candidatesTokenCount", 0),
+            "cached_tokens": usage.get("cachedContentTokenCount", 0)
+        }
+    usage = data.get("usage", {}) or {}
+    details = usage.get("prompt_tokens_details") or {}
+    # llama.cpp reports prompt cache reuse in timings.cache_n instead of usage
+    cached = details.get("cached_tokens") or (data.get("timings") or {}).get("cache_n", 0)
+    return {
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0),
+        "cached_tokens": cached or 0
+    }
+
+def build_gemini_request(profile_config, user_input, history=None):
+    """Builds the Gemini generateContent (api_url, headers, payload) for a prompt or chat history."""
+    api_key = profile_config.get("api_key")
+    model_name = profile_config.get("model_name", "gemini-2.5-flash")
+    system_instr = profile_config.get("system_instruction", "")
+    gen_config = profile_config.get("generation_config", {})
+    api_url = f"{_gemini_api_root(profile_config)}/models/{model_name}:generateContent?key={api_key}"
+
+    payload_contents = history.encode("gemini") if history is not None else [{"parts": [{"text": user_input}]}]
+    payload = {
+        "contents": payload_contents,
+        "systemInstruction": {"parts": [{"text": system_instr}]},
+        "generationConfig": gen_config
+    }
+    return api_url, {}, payload
+
+def build_openai_request(profile_config, user_input, history=None):
+    """Builds the OpenAI chat completions (api_url, headers, payload) for a prompt or chat history."""
+    api_key = profile_config.get("api_key")
+    model_name = profile_config.get("model_name", "gpt-4o")
+    system_instr = profile_config.get("system_instruction", "")
+    temperature = profile_config.get("temperature", 0.7)
+    max_tokens = profile_config.get("max_tokens", 1024)
+    base_url = profile_config.get("base_url", "https://api.openai.com/v1")
+    # Form the completions endpoint URL robustly
+    if base_url.endswith("/"):
+        base_url = base_url[:-1]
+    
+    if base_url.endswith("/chat/completions"):
+        api_url = base_url
+    else:
+        api_url = f"{base_url}/chat/completions"
+        
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+    
+    if history is not None:
+        payload_messages = [{"role": "system", "content": system_instr}] + history.encode("openai")
+    else:
+        payload_messages = [
+            {"role": "system", "content": system_instr},
+            {"role": "user", "content": user_input}
+        ]
+
+    payload = {
+        "model": model_name,
+        "messages": payload_messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens
+    }
+    return api_url, headers, payload
+
+def send_gemini_request(profile_config, user_input, debug_mode, proxy="", history=None, output_file=None, meta=None):
+    import time
+    model_name = profile_config.get("model_name", "gemini-2.5-flash")
+    gen_config = profile_config.get("generation_config", {})
+    api_url, headers, payload = build_gemini_request(profile_config, user_input, history)
+    if debug_mode: print(f"[Debug] Provider: Gemini | Model: {model_name} | Temp: {gen_config.get('temperature')} | Proxy: {proxy if proxy else 'None'}")
+    try:
+        proxies = {"http": proxy, "https": proxy} if proxy else None
+        scheduler = RequestScheduler(profile_config)
+        scheduler.acquire(payload)
+        start = time.time()
+        try:
+            response = post_json(profile_config, api_url, payload, headers=headers, proxies=proxies)
+        finally:
+            scheduler.release()
+        if meta is not None:
+            meta["latency_ms"] = (time.time() - start) * 1000
+        if debug_mode:
+            print(f"[Debug] Status: {response.status_code}")
+        if response.status_code != 200:
+            if response.status_code == 429:
                 print(f"\n[Error 429] You have exceeded your Gemini API quota.")
                 print("Please check your usage and billing details at aistudio.google.com.")
             else:
-                print(f"\n[Error {response.status_code}]")
-                print(response.text)
-            return 1
-        data = response.json()
-        if "promptFeedback" in data and "blockReason" in data["promptFeedback"]:
-            print(f"[Blocked] Reason: {data['promptFeedback']['blockReason']}")
-            return 0
-        if "candidates" in data and data["candidates"]:
-            cand = data["candidates"][0]
-            if "content" in cand and "parts" in cand["content"] and cand["content"]["parts"]:
-                response_text = cand['content']['parts'][0]['text']
-                rendered_text = render_markdown(response_text)
-                print(rendered_text.strip())
-                if history is not None:
-                    history.append({"role": "model", "parts": [{"text": response_text}]})
-                if output_file and history is None:
-                    save_single_response(response_text, output_file)
+                print(f"\n[Error {response.status_code}]")
+                print(response.text)
+            return 1
+        data = decode_json(response.content)
+        if meta is not None:
+            meta["usage"] = normalize_usage("gemini", data)
+        if "promptFeedback" in data and "blockReason" in data["promptFeedback"]:
+            print(f"[Blocked] Reason: {data['promptFeedback']['blockReason']}")
+            return 0
+        if "candidates" in data and data["candidates"]:
+            cand = data["candidates"][0]
+            if meta is not None:
+                meta["finish_reason"] = cand.get("finishReason")
+            if "content" in cand and "parts" in cand["content"] and cand["content"]["parts"]:
+                response_text = cand['content']['parts'][0]['text']
+                rendered_text = render_markdown(response_text)
+                print(rendered_text.strip())
+                if meta is not None:
+                    meta["text"] = response_text
+                if history is not None:
+                    history.add("assistant", response_text)
+                if output_file and history is None:
+                    save_single_response(response_text, output_file)
+            else:
+                print("[No content returned]")
+                if debug_mode: print(data)
+        else:
+            print("[Error] Invalid response format from Gemini")
+            if debug_mode: print(data)
+        return 0
+    except Exception as e:
+        print(f"\n[Connection Error] {e}")
+        return 1
+
+def send_openai_request(profile_config, user_input, debug_mode, proxy="", history=None, output_file=None, meta=None):
+    import time
+    model_name = profile_config.get("model_name", "gpt-4o")
+    temperature = profile_config.get("temperature", 0.7)
+    api_url, headers, payload = build_openai_request(profile_config, user_input, history)
+    if debug_mode: print(f"[Debug] Provider: OpenAI | Model: {model_name} | Temp: {temperature} | Proxy: {proxy if proxy else 'None'}")
+    try:
+        proxies = {"http": proxy, "https": proxy} if proxy else None
+        scheduler = RequestScheduler(profile_config)
+        scheduler.acquire(payload)
+        start = time.time()
+        try:
+            response = post_json(profile_config, api_url, payload, headers=headers, proxies=proxies)
+        finally:
+            scheduler.release()
+        if meta is not None:
+            meta["latency_ms"] = (time.time() - start) * 1000
+        if debug_mode:
+            print(f"[Debug] Status: {response.status_code}")
+        if response.status_code != 200:
+            if response.status_code == 429:
+                print(f"\n[Error 429] You have exceeded your OpenAI API quota.")
+                print("Please check your usage and billing details at platform.openai.com.")
+            else:
+                print(f"\n[Error {response.status_code}]")
+                print(response.text)
+            return 1
+        data = decode_json(response.content)
+        if meta is not None:
+            meta["usage"] = normalize_usage("openai", data)
+        if "choices" in data and data["choices"]:
+            if meta is not None:
+                meta["finish_reason"] = data["choices"][0].get("finish_reason")
+            message = data["choices"][0].get("message", {})
+            content = message.get("content", "")
+            if content:
+                rendered_text = render_markdown(content)
+                print(rendered_text.strip())
+                if meta is not None:
+                    meta["text"] = content
+                if history is not None:
+                    history.add("assistant", content)
+                if output_file and history is None:
+                    save_single_response(content, output_file)
+            else:
+                print("[No content returned]")
+                if debug_mode: print(data)
+        else:
+            print("[Error] Invalid response format from OpenAI")
+            if debug_mode: print(data)
+        return 0
+    except Exception as e:
+        print(f"\n[Connection Error] {e}")
+        return 1
+
+class ProviderError(Exception):
+    """Raised by stream_completion when the provider answers with a non-200 status."""
+
+    def __init__(self, status_code, body):
+        super().__init__(f"[Error {status_code}] {body}")
+        self.status_code = status_code
+        self.body = body
+
+def estimate_tokens(text, provider="openai"):
+    """
+    Fast local token estimate without a tokenizer. Words cost about one token per 4 letters,
+    punctuation one token each, and non-Latin characters (CJK etc.) about one token each.
+    Digits are grouped in threes for OpenAI (tiktoken) and counted one by one for Gemini (SentencePiece).
+    """
+    tokens = 0
+    for piece in re.findall(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]", text):
+        if piece[0].isdigit():
+            tokens += len(piece) if provider == "gemini" else (len(piece) + 2) // 3
+        elif ord(piece[0]) < 128:
+            tokens += max(1, (len(piece) + 3) // 4) if piece[0].isalpha() else 1
+        else:
+            tokens += 1
+    return tokens
+
+def estimate_request_tokens(provider, payload):
+    """Estimates the input tokens of a built request payload, including per-message framing overhead and tool declarations."""
+    # Tool declarations are billed as input; their JSON is a fair proxy for the provider's rendering
+    tools = estimate_tokens(encode_json(payload["tools"]).decode("utf-8"), provider) if payload.get("tools") else 0
+    if provider == "gemini":
+        texts = [part.get("text", "") for content in payload.get("contents", []) for part in content.get("parts", [])]
+        texts += [part.get("text", "") for part in payload.get("systemInstruction", {}).get("parts", [])]
+        return sum(estimate_tokens(t, "gemini") for t in texts) + 3 * len(payload.get("contents", [])) + tools
+    messages = payload.get("messages", [])
+    return sum(estimate_tokens(m.get("content") or "", "openai") + 4 for m in messages) + 3 + tools
+
+def count_gemini_tokens(profile_config, payload, proxy=""):
+    """Asks Gemini's countTokens endpoint for the exact input token count of a generateContent payload."""
+    model_name = profile_config.get("model_name", "gemini-2.5-flash")
+    api_url = f"{_gemini_api_root(profile_config)}/models/{model_name}:countTokens?key={profile_config.get('api_key')}"
+    body = {"generateContentRequest": dict(payload, model=f"models/{model_name}")}
+    proxies = {"http": proxy, "https": proxy} if proxy else None
+    response = post_json(profile_config, api_url, body, proxies=proxies, timeout=30)
+    if response.status_code != 200:
+        raise ProviderError(response.status_code, response.text)
+    return decode_json(response.content).get("totalTokens", 0)
+
+def _model_pricing(profile_config):
+    """Returns (input, output) USD per 1M tokens for a profile: its own 'pricing' key, the built-in table, or None."""
+    pricing = profile_config.get("pricing")
+    if isinstance(pricing, dict) and "input" in pricing:
+        return float(pricing["input"]), float(pricing.get("output", 0))
+    if profile_config.get("provider") == "local":
+        return 0.0, 0.0
+    model_name = profile_config.get("model_name", "")
+    # Longest matching prefix wins, so gpt-4o-mini doesn't get gpt-4o pricing
+    for prefix in sorted(MODEL_PRICING, key=len, reverse=True):
+        if model_name.startswith(prefix):
+            return MODEL_PRICING[prefix]
+    return None
+
+def preview_request(profile_config, user_input, proxy="", count_remote=False, debug_mode=False, tools=False):
+    """
+    --dry-run / --count-tokens: builds the exact payload the request would send (with the tool declarations
+    when `tools` is set, the streaming request otherwise) and reports its byte size, estimated input tokens
+    (plus Gemini's countTokens with --count-tokens) and estimated cost, without sending it.
+    """
+    provider = profile_config.get("provider", "gemini")
+    if tools:
+        api_url, headers, payload = build_tools_request(profile_config, user_input)
+    else:
+        api_url, headers, payload = build_streaming_request(profile_config, user_input)
+    if provider == "gemini":
+        max_output = payload.get("generationConfig", {}).get("maxOutputTokens")
+    else:
+        max_output = payload.get("max_tokens")
+    body = encode_json(payload)
+    estimated = estimate_request_tokens(provider, payload)
+
+    print(f"{BLUE}[Dry Run] Nothing was sent.{RESET}")
+    print(f"  Provider: {provider.capitalize()} | Model: {profile_config.get('model_name', DEFAULT_MODELS.get(provider, ''))}")
+    print(f"  Endpoint: {api_url.split('?')[0]}")
+    if len(body) >= GZIP_MIN_BYTES and _accepts_gzip(profile_config):
+        import gzip
+        print(f"  Payload size: {len(body):,} bytes ({len(gzip.compress(body, compresslevel=6)):,} gzipped on the wire)")
+    else:
+        print(f"  Payload size: {len(body):,} bytes")
+    print(f"  Estimated input tokens: {estimated:,} (local estimate)")
+    input_tokens = estimated
+    if count_remote:
+        if provider == "gemini":
+            try:
+                input_tokens = count_gemini_tokens(profile_config, payload, proxy)
+                print(f"  Counted input tokens: {input_tokens:,} (Gemini countTokens)")
+            except Exception as e:
+                print(f"{YELLOW}  [!] countTokens failed: {e}{RESET}")
+        else:
+            print(f"{YELLOW}  [!] Exact counting is only available for Gemini; showing the estimate.{RESET}")
+    if max_output:
+        print(f"  Max output tokens: {max_output:,}")
+
+    pricing = _model_pricing(profile_config)
+    if pricing is None:
+        print("  Estimated cost: unknown (add \"pricing\": {\"input\": <usd_per_1M>, \"output\": <usd_per_1M>} to the profile)")
+    else:
+        input_cost = input_tokens * pricing[0] / 1000000
+        output_cost = (max_output or 0) * pricing[1] / 1000000
+        print(f"  Estimated cost: ${input_cost:.6f} input + up to ${output_cost:.6f} output")
+    if debug_mode:
+        print(json.dumps(payload, indent=2))
+    return 0
+
+def build_tools_request(profile_config, user_input, history=None):
+    """Builds the (api_url, headers, payload) of a --tools request: the provider's regular request with the tool registry attached."""
+    provider = profile_config.get("provider", "gemini")
+    if provider == "gemini":
+        api_url, headers, payload = build_gemini_request(profile_config, user_input, history)
+    else:
+        if provider == "local":
+            profile_config = dict(profile_config, base_url=_local_api_root(profile_config))
+            profile_config.setdefault("model_name", DEFAULT_MODELS["local"])
+        api_url, headers, payload = build_openai_request(profile_config, user_input, history)
+    payload["tools"] = tool_declarations(provider)
+    return api_url, headers, payload
+
+def build_streaming_request(profile_config, user_input, history=None):
+    """Builds the (api_url, headers, payload) for a server-sent-events streaming request."""
+    provider = profile_config.get("provider", "gemini")
+    if provider == "gemini":
+        api_url, headers, payload = build_gemini_request(profile_config, user_input, history)
+        api_url = api_url.replace(":generateContent?", ":streamGenerateContent?alt=sse&", 1)
+        return api_url, headers, payload
+    if provider == "local":
+        profile_config = dict(profile_config, base_url=_local_api_root(profile_config))
+        profile_config.setdefault("model_name", DEFAULT_MODELS["local"])
+    api_url, headers, payload = build_openai_request(profile_config, user_input, history)
+    payload["stream"] = True
+    # llama.cpp and Ollama accept it too; servers that ignore it get a chunk count instead (see stream_completion)
+    payload["stream_options"] = {"include_usage": True}
+    return api_url, headers, payload
+
+def stream_completion(profile_config, user_input, proxy="", history=None, meta=None, timeout=None, on_response=None, check_server=True):
+    """
+    Yields response text chunks as the provider generates them (SSE streaming for Gemini,
+    OpenAI and local servers). Fills `meta` with latency_ms, ttft_ms, finish_reason, usage
+    and the full text. Without usage from the server, completion tokens are counted as streamed
+    chunks and the usage is marked "estimated". The HTTP response is closed when the generator is closed or abandoned,
+    which stops generation on the provider side. `timeout` bounds the connect and each wait for data.
+    `on_response` is called with the open HTTP response, so another thread can abort_response() it.
+    `check_server=False` skips the local server health check, for callers that ran it once up front.
+    """
+    import time
+    provider = profile_config.get("provider", "gemini")
+    if provider == "local":
+        proxy = ""
+        if check_server and not ensure_local_server(profile_config):
+            raise ProviderError(503, "Local server is not available")
+    api_url, headers, payload = build_streaming_request(profile_config, user_input, history)
+    proxies = {"http": proxy, "https": proxy} if proxy else None
+    meta = meta if meta is not None else {}
+    scheduler = RequestScheduler(profile_config)
+    scheduler.acquire(payload)
+    start = time.time()
+    try:
+        response = post_json(profile_config, api_url, payload, headers=headers, proxies=proxies, stream=True, timeout=timeout)
+    except BaseException:
+        scheduler.release()
+        raise
+    text_parts = []
+    try:
+        if on_response:
+            on_response(response)
+        if response.status_code != 200:
+            raise ProviderError(response.status_code, response.text)
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                event = decode_json(data)
+            except ValueError:
+                continue
+            chunk = ""
+            if provider == "gemini":
+                for cand in event.get("candidates", [])[:1]:
+                    chunk = "".join(part.get("text", "") for part in cand.get("content", {}).get("parts", []))
+                    meta["finish_reason"] = cand.get("finishReason", meta.get("finish_reason"))
+                if "usageMetadata" in event:
+                    meta["usage"] = normalize_usage("gemini", event)
+            else:
+                for choice in event.get("choices", [])[:1]:
+                    chunk = (choice.get("delta") or {}).get("content") or ""
+                    meta["finish_reason"] = choice.get("finish_reason") or meta.get("finish_reason")
+                if event.get("usage") or event.get("timings"):
+                    meta["usage"] = normalize_usage("openai", event)
+            if chunk:
+                if "ttft_ms" not in meta:
+                    meta["ttft_ms"] = (time.time() - start) * 1000
+                text_parts.append(chunk)
+                yield chunk
+    finally:
+        # Partial text is kept when the stream is cut short
+        meta["text"] = "".join(text_parts)
+        usage = meta.get("usage") or {}
+        if text_parts and not usage.get("completion_tokens"):
+            meta["usage"] = dict(usage, prompt_tokens=usage.get("prompt_tokens") or estimate_request_tokens(provider, payload),
+                                 completion_tokens=len(text_parts), cached_tokens=usage.get("cached_tokens") or 0, estimated=True)
+        meta["latency_ms"] = (time.time() - start) * 1000
+        response.close()
+        scheduler.release(meta.get("usage"))
+
+def abort_response(response):
+    """
+    Unblocks a thread that is reading a streamed response by shutting its socket down; response.close()
+    from another thread would wait for the read to return. Responses without a socket (replays) are left alone.
+    """
+    import socket
+    sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def check_local_server(profile_config, timeout=1.0):
+    """Health check: returns True if the local inference server answers GET /models."""
+    headers = {"Authorization": f"Bearer {profile_config['api_key']}"} if profile_config.get("api_key") else {}
+    try:
+        response = get_http_session().get(f"{_local_api_root(profile_config)}/models", headers=headers, timeout=timeout)
+        return response.status_code == 200
+    except requests.RequestException:
+        return False
+
+def _local_server_pid_file(profile_config):
+    """Returns the pid file tracking an auto-started server for this profile's endpoint."""
+    import hashlib
+    digest = hashlib.sha256(_local_api_root(profile_config).encode("utf-8")).hexdigest()[:12]
+    return DATA_DIR / f"local-server-{digest}.pid"
+
+def _pid_is_running(pid_file):
+    """Returns True if the pid recorded in pid_file belongs to a live process."""
+    try:
+        pid = int(pid_file.read_text().strip())
+        os.kill(pid, 0)
+        return True
+    except (OSError, ValueError):
+        return False
+
+def ensure_local_server(profile_config, debug_mode=False):
+    """
+    Makes sure the local inference server is up. If the health check fails and the profile has a
+    server_command, the server is started detached so it keeps the model loaded between ai calls
+    (keep_alive is passed to Ollama via OLLAMA_KEEP_ALIVE), then polled until healthy.
+    """
+    import time
+    import shlex
+    if check_local_server(profile_config):
+        return True
+
+    endpoint = _local_api_root(profile_config)
+    command = profile_config.get("server_command", "")
+    if not command:
+        print(f"{RED}[Error] Local server at {endpoint} is not responding. Start it, or set 'server_command' in the profile to auto-start it.{RESET}")
+        return False
+
+    pid_file = _local_server_pid_file(profile_config)
+    # Another ai process may already be starting the server; wait for it instead of spawning twice
+    if not _pid_is_running(pid_file):
+        args = shlex.split(command) if isinstance(command, str) else list(command)
+        env = os.environ.copy()
+        if profile_config.get("keep_alive"):
+            env.setdefault("OLLAMA_KEEP_ALIVE", str(profile_config["keep_alive"]))
+        sys.stderr.write(f"{YELLOW}[*] Starting local server: {' '.join(args)}{RESET}\n")
+        try:
+            DATA_DIR.mkdir(parents=True, exist_ok=True)
+            with open(DATA_DIR / "local-server.log", "ab") as log:
+                process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                                           env=env, start_new_session=True)
+            pid_file.write_text(str(process.pid))
+        except OSError as e:
+            print(f"{RED}[Error] Failed to start local server '{command}': {e}{RESET}")
+            return False
+
+    timeout = float(profile_config.get("startup_timeout", 60))
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if check_local_server(profile_config, timeout=2.0):
+            if debug_mode: print(f"[Debug] Local server ready at {endpoint}")
+            return True
+        time.sleep(0.25)
+    print(f"{RED}[Error] Local server did not become ready within {timeout:g}s. See {DATA_DIR / 'local-server.log'}{RESET}")
+    return False
+
+def send_local_request(profile_config, user_input, debug_mode, proxy="", history=None, output_file=None, meta=None):
+    """Sends a request to a local OpenAI-compatible server (llama.cpp, Ollama), starting it first if needed."""
+    if not ensure_local_server(profile_config, debug_mode):
+        return 1
+    local_config = dict(profile_config, base_url=_local_api_root(profile_config))
+    local_config.setdefault("model_name", DEFAULT_MODELS["local"])
+    # Local traffic never goes through the configured proxy
+    return send_openai_request(local_config, user_input, debug_mode, proxy="", history=history, output_file=output_file, meta=meta)
+
+def send_request(profile_config, user_input, debug_mode, proxy="", history=None, output_file=None, meta=None):
+    """Dispatches a request to the sender for the profile's provider."""
+    provider = profile_config.get("provider", "gemini")
+    if provider == "gemini":
+        sender = send_gemini_request
+    elif provider == "local":
+        sender = send_local_request
+    else:
+        sender = send_openai_request
+    return sender(profile_config, user_input, debug_mode, proxy=proxy, history=history, output_file=output_file, meta=meta)
+
+class Pager:
+    """
+    Full-screen pager for answers taller than the terminal. Only the visible window of the rendered lines
+    is drawn, so scrolling costs the same for 50 or 50,000 lines, and lines can be appended from another
+    thread while it is open (streaming). Lines are kept unwrapped and re-wrapped when the terminal is
+    resized, keeping the top line in view. Keys: j/k or arrows, space/b or PgDn/PgUp, g/G, / search, n/N, q.
+    """
+    KEYS = {
+        b"q": "quit", b"Q": "quit", b"\x1b": "quit",
+        b"j": "down", b"\x1b[B": "down", b"\r": "down", b"\n": "down",
+        b"k": "up", b"\x1b[A": "up",
+        b" ": "page_down", b"f": "page_down", b"\x1b[6~": "page_down",
+        b"b": "page_up", b"\x1b[5~": "page_up",
+        b"g": "home", b"<": "home", b"\x1b[H": "home", b"\x1b[1~": "home",
+        b"G": "end", b">": "end", b"\x1b[F": "end", b"\x1b[4~": "end",
+        b"/": "search", b"n": "next", b"N": "previous"
+    }
+
+    def __init__(self, lines=None):
+        import threading
+        self.source = []  # unwrapped lines
+        self.lines = []   # terminal rows
+        self.starts = []  # first row of each source line
+        self.width = TERMINAL.width
+        self.generation = TERMINAL.generation
+        self.lock = threading.Lock()
+        self._add_rows(lines or [])
+        self.top = 0
+        self.query = ""
+        self.message = ""
+        self.streaming = False
+        self.closed = False
+        self._changed = threading.Event()
+
+    def append(self, lines):
+        """Adds rendered lines (thread-safe). The view follows new lines while it is scrolled to the bottom."""
+        with self.lock:
+            at_bottom = self.top >= self._max_top()
+            self._add_rows(lines)
+            if at_bottom:
+                self.top = self._max_top()
+        self._changed.set()
+
+    def finish(self):
+        """Marks the end of a stream feeding this pager."""
+        self.streaming = False
+        self._changed.set()
+
+    def _add_rows(self, lines):
+        for line in lines:
+            self.source.append(line)
+            self.starts.append(len(self.lines))
+            self.lines.extend(TERMINAL.wrap(line, self.width))
+
+    def _reflow(self):
+        """Re-wraps all lines for the new terminal width after a resize."""
+        import bisect
+        with self.lock:
+            anchor = bisect.bisect_right(self.starts, self.top) - 1
+            source = self.source
+            self.source, self.lines, self.starts = [], [], []
+            self.width, self.generation = TERMINAL.width, TERMINAL.generation
+            self._add_rows(source)
+            self.top = min(self.starts[anchor] if anchor >= 0 else 0, self._max_top())
+
+    def _rows(self):
+        return max(TERMINAL.lines - 1, 1)
+
+    def _max_top(self):
+        return max(len(self.lines) - self._rows(), 0)
+
+    def run(self):
+        """Shows the pager until the user quits. Keys are read from /dev/tty, so piped stdin doesn't matter."""
+        import select
+        import termios
+        import tty
+        with open("/dev/tty", "rb", buffering=0) as keyboard:
+            fd = keyboard.fileno()
+            saved = termios.tcgetattr(fd)
+            try:
+                tty.setcbreak(fd)
+                # Alternate screen, hidden cursor, no auto-wrap (long lines are clipped instead of shifting the window)
+                sys.stdout.write("\033[?1049h\033[?25l\033[?7l")
+                self._draw()
+                while not self.closed:
+                    if select.select([fd], [], [], 0.1)[0]:
+                        self._handle(self.KEYS.get(os.read(fd, 16)), fd)
+                        self._draw()
+                    elif self._changed.is_set() or self.generation != TERMINAL.generation:
+                        self._changed.clear()
+                        self._draw()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self.closed = True
+                sys.stdout.write("\033[?7h\033[?25h\033[?1049l")
+                sys.stdout.flush()
+                termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+
+    def _handle(self, action, fd):
+        rows = self._rows()
+        self.message = ""
+        if action == "quit":
+            self.closed = True
+        elif action == "down":
+            self.top += 1
+        elif action == "up":
+            self.top -= 1
+        elif action == "page_down":
+            self.top += rows
+        elif action == "page_up":
+            self.top -= rows
+        elif action == "home":
+            self.top = 0
+        elif action == "end":
+            self.top = self._max_top()
+        elif action == "search":
+            self.query = self._prompt(fd, "/") or self.query
+            self._jump(1, include_current=True)
+        elif action in ("next", "previous"):
+            self._jump(1 if action == "next" else -1)
+        with self.lock:
+            self.top = min(max(self.top, 0), self._max_top())
+
+    def _jump(self, direction, include_current=False):
+        """Scrolls to the next/previous line containing the search query (case-insensitive, ANSI codes ignored)."""
+        if not self.query:
+            return
+        query = self.query.lower()
+        with self.lock:
+            lines = self.lines
+            start = self.top if include_current else self.top + direction
+            order = range(start, len(lines)) if direction > 0 else range(start, -1, -1)
+            for index in order:
+                if query in MarkdownRenderer.ANSI.sub("", lines[index]).lower():
+                    self.top = index
+                    return
+        self.message = f"Pattern not found: {self.query}"
+
+    def _prompt(self, fd, label):
+        """Reads a line on the status row (Enter accepts, Esc cancels)."""
+        text = ""
+        while True:
+            sys.stdout.write(f"\033[{self._rows() + 1};1H\033[K{label}{text}")
+            sys.stdout.flush()
+            key = os.read(fd, 16)
+            if key in (b"\r", b"\n"):
+                return text
+            if key == b"\x1b":
+                return ""
+            if key in (b"\x7f", b"\x08"):
+                text = text[:-1]
+            else:
+                char = key.decode("utf-8", "ignore")
+                if char.isprintable():
+                    text += char
+
+    def _draw(self):
+        if self.generation != TERMINAL.generation:
+            self._reflow()
+        rows = self._rows()
+        with self.lock:
+            window = self.lines[self.top:self.top + rows]
+            total = len(self.lines)
+        frame = ["\033[H"]
+        for line in window:
+            frame.append(f"{line}\033[0m\033[K\r\n")
+        frame.append("\033[K\r\n" * (rows - len(window)))
+        last = min(self.top + rows, total)
+        state = " (streaming…)" if self.streaming else (" (END)" if last >= total else "")
+        status = self.message or f"lines {self.top + 1}-{last} of {total}{state}  q quit · / search · n/N next/prev"
+        frame.append(f"\033[7m {status} \033[0m\033[K")
+        sys.stdout.write("".join(frame))
+        sys.stdout.flush()
+
+def pager_enabled(config):
+    """The pager is used for single answers on an interactive terminal unless disabled with --no-pager or "pager": false."""
+    if "--no-pager" in sys.argv or not config.get("pager", True) or not sys.stdout.isatty():
+        return False
+    try:
+        import termios # noqa: F401 (not available on every platform)
+        with open("/dev/tty"):
+            return True
+    except (ImportError, OSError):
+        return False
+
+def page_or_print(text, use_pager=True):
+    """Renders a Markdown answer and prints it, opening the pager (if enabled) when it is taller than the terminal."""
+    if not use_pager:
+        print(render_markdown(text).strip())
+        return
+    lines = render_markdown_lines(text.strip())
+    rows = TERMINAL.wrap_lines(lines)
+    if len(rows) >= TERMINAL.lines:
+        Pager(lines).run()
+    else:
+        print("\n".join(rows))
+
+def reply_completed(meta):
+    """True if a reply ran to a normal stop: not cancelled, failed or cut short by the token limit."""
+    return not meta.get("cancelled") and str(meta.get("finish_reason")).lower() == "stop"
+
+def stream_reply(profile_config, user_input, debug_mode, proxy="", history=None, meta=None, show_progress=None, use_pager=False, on_finish=None):
+    """
+    Streams an answer to the terminal so Ctrl+C cancels only this reply. Closing the stream drops the
+    connection, so the provider stops generating, and in chat the partial answer is kept in history.
+    Without rich, the built-in renderer prints each line as soon as it is complete. With use_pager,
+    an answer taller than the terminal continues in the Pager while the rest streams in.
+    Returns 0 when the answer completed, 130 (with meta["cancelled"] set) when the user stopped it
+    with Ctrl+C or by quitting the pager early, and 1 on errors. `on_finish(meta)` is called as soon as
+    the stream has ended, before the answer is paged, so callers don't wait for the user to stop reading.
+    """
+    provider = profile_config.get("provider", "gemini")
+    meta = meta if meta is not None else {}
+    if show_progress is None:
+        show_progress = sys.stdout.isatty()
+    live = MarkdownRenderer() if show_progress and not _rich_available() else None
+    if live:
+        show_progress = False
+    if debug_mode: print(f"[Debug] Provider: {provider.capitalize()} | Model: {profile_config.get('model_name', DEFAULT_MODELS.get(provider, ''))} | Streaming | Proxy: {proxy if proxy else 'None'}")
+    responses = []
+    stream = stream_completion(profile_config, user_input, proxy=proxy, history=history, meta=meta, on_response=responses.append)
+    cancelled = paged = False
+    try:
+        received = 0
+        printed = []
+        printed_rows = 0
+        for chunk in stream:
+            received += len(chunk)
+            if live:
+                lines = live.feed(chunk)
+                if not lines:
+                    continue
+                # Wrapped at the width of the moment, so a resize mid-stream applies from the next line on
+                rows = TERMINAL.wrap_lines(lines)
+                if use_pager and printed_rows + len(rows) > TERMINAL.lines - 1:
+                    paged = True
+                    cancelled = _continue_in_pager(stream, live, printed + lines, responses, on_finish=(lambda: on_finish(meta)) if on_finish else None)
+                    break
+                for row in rows:
+                    print(row)
+                printed.extend(lines)
+                printed_rows += len(rows)
+            elif show_progress:
+                sys.stdout.write(f"\r{BLUE}… {received:,} chars (Ctrl+C to stop){RESET}")
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        cancelled = True
+    except ProviderError as e:
+        if show_progress: sys.stdout.write("\r\033[K")
+        if e.status_code == 429:
+            print(f"\n[Error 429] You have exceeded your {provider.capitalize()} API quota.")
+        else:
+            print(f"\n[Error {e.status_code}]")
+            print(e.body)
+        return 1
+    except requests.RequestException as e:
+        if show_progress: sys.stdout.write("\r\033[K")
+        print(f"\n[Connection Error] {e}")
+        return 1
+    finally:
+        if not paged:
+            stream.close() # the pager thread closes it otherwise
+    if show_progress:
+        sys.stdout.write("\r\033[K")
+    if cancelled:
+        meta["cancelled"] = True
+    if on_finish and not paged:
+        on_finish(meta)
+
+    text = meta.get("text", "")
+    if paged:
+        pass # the answer was shown in the pager
+    elif live:
+        for row in TERMINAL.wrap_lines(live.finish()):
+            print(row)
+    elif text:
+        page_or_print(text, use_pager)
+    if text and history is not None:
+        history.add("assistant", text)
+    if cancelled:
+        print(f"{YELLOW}[Cancelled] Generation stopped{'; the partial answer was kept' if history is not None else ''}.{RESET}")
+        return 130
+    if not text:
+        print(f"[No content returned] Finish reason: {meta.get('finish_reason') or 'unknown'}")
+    return 0
+
+def _continue_in_pager(stream, renderer, lines, responses, on_finish=None):
+    """
+    Moves a streaming answer into the Pager: a background thread keeps reading the stream and appends
+    rendered lines while the user scrolls, and calls on_finish() once the stream has ended.
+    Returns True if the user quit before the answer was complete. The thread has finished when this
+    returns; quitting early aborts the response it is reading.
+    """
+    import threading
+    pager = Pager(lines)
+    pager.streaming = True
+
+    def pump():
+        try:
+            for chunk in stream:
+                if pager.closed:
+                    break
+                pager.append(renderer.feed(chunk))
+            pager.append(renderer.finish())
+        except Exception as e:
+            pager.append([f"{RED}[Stream interrupted] {e}{RESET}"])
+        finally:
+            # Closing the generator from its own thread closes the HTTP response
+            stream.close()
+            pager.finish()
+            if on_finish:
+                on_finish()
+
+    worker = threading.Thread(target=pump, daemon=True)
+    worker.start()
+    try:
+        pager.run()
+    finally:
+        cancelled = pager.streaming
+        if cancelled:
+            for response in responses:
+                abort_response(response)
+        worker.join()
+    return cancelled
+
+def structured_result(profile_name, profile_config, meta):
+    """Builds the --output record for a finished request from its meta dict."""
+    provider = profile_config.get("provider", "gemini")
+    return {
+        "profile": profile_name,
+        "provider": provider,
+        "model": profile_config.get("model_name", DEFAULT_MODELS.get(provider, "")),
+        "text": meta.get("text", ""),
+        "finish_reason": meta.get("finish_reason"),
+        "usage": meta.get("usage"),
+        "latency_ms": round(meta.get("latency_ms", 0), 1),
+        "ttft_ms": round(meta["ttft_ms"], 1) if "ttft_ms" in meta else None
+    }
+
+def print_structured(record):
+    """Writes one JSON record per line and flushes, so consumers see ndjson chunks as they arrive."""
+    sys.stdout.write(encode_json(record).decode("utf-8") + "\n")
+    sys.stdout.flush()
+
+def emit_structured_output(profile_config, profile_name, user_input, output_format, proxy="", meta=None):
+    """
+    --output json|ndjson: runs the request over the streaming API and prints machine-readable records
+    instead of rendered Markdown. ndjson emits {"type": "chunk"} per streamed chunk and a final
+    {"type": "done"} record; json prints a single record. Failures are reported as an "error" record.
+    If the reader closes the pipe (`| head -1`), the request is stopped and 141 is returned, as for SIGPIPE.
+    """
+    meta = meta if meta is not None else {}
+    ndjson = output_format == "ndjson"
+    stream = stream_completion(profile_config, user_input, proxy=proxy, meta=meta)
+    try:
+        try:
+            for chunk in stream:
+                if ndjson:
+                    print_structured({"type": "chunk", "text": chunk})
+        except (ProviderError, requests.RequestException) as e:
+            error = {"status": getattr(e, "status_code", None), "message": getattr(e, "body", None) or str(e)}
+            result = dict(structured_result(profile_name, profile_config, meta), error=error)
+            print_structured(dict(result, type="error") if ndjson else result)
+            return 1
+        result = structured_result(profile_name, profile_config, meta)
+        print_structured(dict(result, type="done") if ndjson else result)
+        return 0
+    except BrokenPipeError:
+        stream.close()
+        meta["cancelled"] = True
+        # Later writes, including the interpreter's final flush, must not raise again
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return 141
+
+def _tool_path_allowed(path, recursive=False):
+    """
+    Tools may read anything the user can, except termai's own config directory (it holds API keys).
+    With `recursive`, the path is walked, so the config directory's parents are refused as well.
+    """
+    try:
+        resolved = Path(path).expanduser().resolve()
+    except (OSError, RuntimeError):
+        return False
+    config_dir = CONFIG_DIR.resolve()
+    if recursive and resolved in config_dir.parents:
+        return False
+    return resolved != config_dir and config_dir not in resolved.parents
+
+def _tool_reads_recursively(argv):
+    """True if the command walks directory trees: find, git grep, grep -r and ls -R."""
+    program, args = os.path.basename(argv[0]), argv[1:]
+    if program == "find" or (program == "git" and args[:1] == ["grep"]):
+        return True
+    flag = {"grep": r"-[^-]*[rR]|--(dereference-)?recursive$", "ls": r"-[^-]*R|--recursive$"}.get(program)
+    return bool(flag) and any(re.match(flag, arg) for arg in args)
+
+def _truncate_tool_output(text):
+    if len(text) <= TOOL_OUTPUT_MAX_CHARS:
+        return text
+    half = TOOL_OUTPUT_MAX_CHARS // 2
+    return f"{text[:half]}\n... [{len(text) - TOOL_OUTPUT_MAX_CHARS} characters truncated] ...\n{text[-half:]}"
+
+def tool_run_command(command, allowlist=None):
+    """Runs an allowlisted command without a shell (no pipes, redirects or expansion) and returns its exit code and output."""
+    import shlex
+    try:
+        argv = shlex.split(command)
+    except ValueError as e:
+        return f"Error: could not parse command: {e}"
+    if not argv:
+        return "Error: empty command"
+    allowlist = allowlist if allowlist is not None else DEFAULT_TOOL_ALLOWLIST
+    if not any(argv[:len(entry.split())] == entry.split() for entry in allowlist):
+        return f"Error: '{argv[0]}' is not in the tool allowlist. Allowed: {', '.join(allowlist)}"
+    denied = TOOL_DENIED_ARGS.get(os.path.basename(argv[0]))
+    refused = next((arg for arg in argv[1:] if denied and re.match(denied, arg)), None)
+    if refused:
+        return f"Error: '{refused}' is not allowed: tools may only read, not write files or run other programs"
+    recursive = _tool_reads_recursively(argv)
+    paths = [arg for arg in argv[1:] if "/" in arg or (not arg.startswith("-") and os.path.exists(arg))]
+    if recursive and not any(os.path.exists(os.path.expanduser(arg)) for arg in paths):
+        paths.append(".") # find, grep -r and friends walk the working directory by default
+    if not all(_tool_path_allowed(arg, recursive) for arg in paths):
+        return "Error: access to termai's configuration directory is not allowed"
+    try:
+        result = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, timeout=TOOL_COMMAND_TIMEOUT)
+    except FileNotFoundError:
+        return f"Error: command not found: {argv[0]}"
+    except subprocess.TimeoutExpired:
+        return f"Error: command timed out after {TOOL_COMMAND_TIMEOUT} seconds"
+    output = result.stdout.decode("utf-8", "replace")
+    return _truncate_tool_output(f"exit code: {result.returncode}\n{output}")
+
+def tool_read_file(path, start_line=1, end_line=None):
+    """Returns lines start_line..end_line (1-based, inclusive) of a text file."""
+    if not _tool_path_allowed(path):
+        return "Error: access to termai's configuration directory is not allowed"
+    text = _read_context_file(Path(path).expanduser())
+    if text is None:
+        return f"Error: cannot read '{path}' (missing, binary or too large)"
+    lines = text.splitlines()
+    start = max(int(start_line or 1), 1)
+    end = min(int(end_line or len(lines)), len(lines))
+    numbered = "\n".join(f"{n}: {lines[n - 1]}" for n in range(start, end + 1))
+    return _truncate_tool_output(f"{path} ({len(lines)} lines)\n{numbered}")
+
+def tool_grep(pattern, path=".", max_results=100):
+    """Searches files under `path` (skipping ignored and binary files) for a regex and returns path:line: text matches."""
+    if not _tool_path_allowed(path):
+        return "Error: access to termai's configuration directory is not allowed"
+    try:
+        regex = re.compile(pattern)
+    except re.error as e:
+        return f"Error: invalid regex: {e}"
+    root = Path(path).expanduser()
+    if root.is_file():
+        files = [root]
+    else:
+        visible = _git_visible_files(root)
+        # git may list files under the config directory (a dotfiles repo); the walk itself never enters it
+        files = [f for f in (visible if visible is not None else _walk_context_files(root)) if f.is_file() and _tool_path_allowed(f)]
+    max_results = int(max_results or 100)
+    matches = []
+    for file_path in files:
+        text = _read_context_file(file_path)
+        if text is None:
+            continue
+        for number, line in enumerate(text.splitlines(), 1):
+            if regex.search(line):
+                matches.append(f"{file_path}:{number}: {line.strip()[:300]}")
+                if len(matches) >= max_results:
+                    return "\n".join(matches) + f"\n[stopped after {max_results} matches]"
+    return "\n".join(matches) if matches else "No matches"
+
+# name -> (function, description, JSON schema of the arguments)
+TOOL_REGISTRY = {
+    "run_command": (tool_run_command, "Run a read-only diagnostic shell command (no pipes or redirects; only allowlisted programs) and get its exit code and output.", {
+        "type": "object",
+        "properties": {"command": {"type": "string", "description": "Command line, e.g. 'journalctl -u nginx -n 50'"}},
+        "required": ["command"]
+    }),
+    "read_file": (tool_read_file, "Read a text file, optionally only a range of lines. Lines are returned numbered.", {
+        "type": "object",
+        "properties": {
+            "path": {"type": "string"},
+            "start_line": {"type": "integer", "description": "First line (1-based)"},
+            "end_line": {"type": "integer", "description": "Last line (inclusive)"}
+        },
+        "required": ["path"]
+    }),
+    "grep": (tool_grep, "Search files under a directory (or one file) for a regular expression. Ignored and binary files are skipped.", {
+        "type": "object",
+        "properties": {
+            "pattern": {"type": "string", "description": "Python regular expression"},
+            "path": {"type": "string", "description": "File or directory (default: current directory)"},
+            "max_results": {"type": "integer"}
+        },
+        "required": ["pattern"]
+    })
+}
+
+def tool_declarations(provider):
+    """Returns the registry in the provider's request format (Gemini functionDeclarations or OpenAI tools)."""
+    functions = [{"name": name, "description": description, "parameters": schema} for name, (_, description, schema) in TOOL_REGISTRY.items()]
+    if provider == "gemini":
+        return [{"functionDeclarations": functions}]
+    return [{"type": "function", "function": f} for f in functions]
+
+def execute_tool_calls(calls, allowlist=None, debug_mode=False):
+    """Runs one model turn's tool calls [(name, args), ...] in a thread pool; returns their outputs in order."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(call):
+        name, args = call
+        sys.stderr.write(f"{BLUE}[tool] {name}({', '.join(f'{k}={v!r}' for k, v in args.items())}){RESET}\n")
+        if name not in TOOL_REGISTRY:
+            return f"Error: unknown tool '{name}'"
+        function = TOOL_REGISTRY[name][0]
+        try:
+            if name == "run_command":
+                return function(allowlist=allowlist, **args)
+            return function(**args)
+        except Exception as e:
+            if debug_mode: print(f"[Debug] Tool {name} failed: {e}")
+            return f"Error: {e}"
+
+    if not calls:
+        return []
+    with ThreadPoolExecutor(max_workers=min(TOOL_MAX_WORKERS, len(calls))) as pool:
+        return list(pool.map(run, calls))
+
+def run_with_tools(profile_config, user_input, debug_mode, proxy="", history=None, allowlist=None, meta=None):
+    """
+    --tools: sends the request with the tool registry attached, executes the tool calls the model asks for
+    (all calls of one turn in parallel), feeds the results back and repeats until the model answers in text.
+    Fills meta with the final text, accumulated usage, latency and the number of tool calls.
+    Raises ProviderError on a non-200 response.
+    """
+    import time
+    provider = profile_config.get("provider", "gemini")
+    meta = meta if meta is not None else {}
+    if provider == "local":
+        proxy = ""
+        if not ensure_local_server(profile_config, debug_mode):
+            raise ProviderError(503, "Local server is not available")
+        profile_config = dict(profile_config, base_url=_local_api_root(profile_config))
+    api_url, headers, payload = build_tools_request(profile_config, user_input, history)
+    turns = payload["contents"] if provider == "gemini" else payload["messages"]
+    proxies = {"http": proxy, "https": proxy} if proxy else None
+    usage = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+    meta["tool_calls"] = 0
+    start = time.time()
+
+    scheduler = RequestScheduler(profile_config)
+    for _ in range(TOOL_MAX_ROUNDS):
+        scheduler.acquire(payload)
+        try:
+            response = post_json(profile_config, api_url, payload, headers=headers, proxies=proxies)
+        finally:
+            scheduler.release()
+        if response.status_code != 200:
+            raise ProviderError(response.status_code, response.text)
+        data = decode_json(response.content)
+        for key, value in normalize_usage(provider, data).items():
+            usage[key] += value or 0
+
+        if provider == "gemini":
+            cand = (data.get("candidates") or [{}])[0]
+            content = cand.get("content") or {"role": "model", "parts": []}
+            meta["finish_reason"] = cand.get("finishReason")
+            calls = [(p["functionCall"]["name"], p["functionCall"].get("args") or {}) for p in content.get("parts", []) if "functionCall" in p]
+            text = "".join(p.get("text", "") for p in content.get("parts", []) if "functionCall" not in p)
+        else:
+            choice = (data.get("choices") or [{}])[0]
+            content = choice.get("message") or {"role": "assistant", "content": ""}
+            meta["finish_reason"] = choice.get("finish_reason")
+            tool_calls = content.get("tool_calls") or []
+            calls = []
+            for call in tool_calls:
+                try:
+                    args = decode_json(call["function"].get("arguments") or "{}")
+                except ValueError:
+                    args = {}
+                calls.append((call["function"]["name"], args if isinstance(args, dict) else {}))
+            text = content.get("content") or ""
+
+        if not calls:
+            meta.update(text=text, usage=usage, latency_ms=(time.time() - start) * 1000)
+            return text
+
+        # The model turn is sent back verbatim (Gemini may attach thought signatures to it)
+        turns.append(content)
+        outputs = execute_tool_calls(calls, allowlist, debug_mode)
+        meta["tool_calls"] += len(calls)
+        if provider == "gemini":
+            turns.append({"role": "user", "parts": [{"functionResponse": {"name": name, "response": {"output": output}}} for (name, _), output in zip(calls, outputs)]})
+        else:
+            turns.extend({"role": "tool", "tool_call_id": call["id"], "content": output} for call, output in zip(tool_calls, outputs))
+
+    meta.update(text="", usage=usage, latency_ms=(time.time() - start) * 1000)
+    raise ProviderError(None, f"Stopped after {TOOL_MAX_ROUNDS} tool rounds without a final answer")
+
+def tools_chat_reply(profile_config, history, debug_mode, proxy="", allowlist=None, meta=None):
+    """Chat turn for --tools: runs the tool loop on the history and keeps only the final answer in it. Ctrl+C cancels the turn."""
+    meta = meta if meta is not None else {}
+    try:
+        text = run_with_tools(profile_config, "", debug_mode, proxy=proxy, history=history, allowlist=allowlist, meta=meta)
+    except KeyboardInterrupt:
+        meta["cancelled"] = True
+        print(f"\n{YELLOW}[Cancelled] Tool run stopped.{RESET}")
+        return 130
+    except ProviderError as e:
+        if e.status_code:
+            print(f"\n[Error {e.status_code}]")
+        print(e.body)
+        return 1
+    except requests.RequestException as e:
+        print(f"\n[Connection Error] {e}")
+        return 1
+    if text:
+        print(render_markdown(text).strip())
+        history.add("assistant", text)
+    else:
+        print(f"[No content returned] Finish reason: {meta.get('finish_reason') or 'unknown'}")
+    return 0
+
+class TypeAheadReader:
+    """
+    Chat input for --type-ahead. A background thread keeps reading lines, so the next message can be
+    typed while an answer is still streaming. Lines typed during a reply are queued and sent in order.
+    """
+
+    def __init__(self):
+        import queue
+        import threading
+        self.lines = queue.Queue()
+        self.busy = False
+        self.typed_ahead = False
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        while True:
+            try:
+                line = input()
+            except (EOFError, OSError):
+                self.lines.put(None)
+                return
+            if self.busy and line.strip():
+                print(f"{BLUE}[queued] Sends after the current reply ({self.lines.qsize() + 1} waiting){RESET}")
+            self.lines.put((line, self.busy))
+
+    def pending(self):
+        return not self.lines.empty()
+
+    def get(self, prompt):
+        """Returns the next line, showing the prompt only when nothing is queued. Raises EOFError on Ctrl+D."""
+        import queue
+        if not self.pending():
+            sys.stdout.write(prompt)
+            sys.stdout.flush()
+        while True:
+            # Short timeouts keep the main thread responsive to Ctrl+C
+            try:
+                item = self.lines.get(timeout=0.2)
+                break
+            except queue.Empty:
+                continue
+        if item is None:
+            raise EOFError
+        line, self.typed_ahead = item
+        return line
+
+class ChatPrefetcher:
+    """
+    Opt-in speculative warm-up for chat mode (--prefetch or "prefetch": true in a profile).
+    While the user types the next message, a background thread re-opens the pooled connection
+    to the provider and, for providers with prompt caching, sends the accumulated history with a
+    1-token completion so the real request reuses a warm connection and a cached prefix.
+    """
+
+    def __init__(self, profile_config, proxy="", debug_mode=False):
+        self.provider = profile_config.get("provider", "gemini")
+        self.profile_config = profile_config
+        if self.provider == "local":
+            self.profile_config = dict(profile_config, base_url=_local_api_root(profile_config))
+        self.proxies = {"http": proxy, "https": proxy} if proxy and self.provider != "local" else None
+        self.debug_mode = debug_mode
+        self.turns = []
+        self._turn = None
+        self._primed_len = 0
+        self._min_ping_ms = None
+
+    def start(self, history):
+        """Starts warming up for the next turn in the background."""
+        import threading
+        import time
+        self._turn = {"started": time.time(), "ping_ms": None, "prime_ms": None, "done": False}
+        worker = threading.Thread(target=self._warm, args=(history.copy(), self._turn), daemon=True)
+        worker.start()
+
+    def _warm(self, history, turn):
+        import time
+        try:
+            start = time.time()
+            self._ping()
+            turn["ping_ms"] = (time.time() - start) * 1000
+            if self._min_ping_ms is None or turn["ping_ms"] < self._min_ping_ms:
+                self._min_ping_ms = turn["ping_ms"]
+            if self._should_prime(history):
+                start = time.time()
+                self._prime(history)
+                turn["prime_ms"] = (time.time() - start) * 1000
+        except Exception as e:
+            if self.debug_mode: print(f"\n[Debug] Prefetch failed: {e}")
+        turn["done"] = True
+
+    def _ping(self):
+        """Cheap authenticated GET that leaves a warm TCP/TLS connection in the session pool."""
+        if self.provider == "gemini":
+            api_url = f"{_gemini_api_root(self.profile_config)}/models?key={self.profile_config.get('api_key')}&pageSize=1"
+            headers = {}
+        else:
+            api_url = f"{_provider_api_root(self.profile_config)}/models"
+            headers = {"Authorization": f"Bearer {self.profile_config.get('api_key')}"}
+        get_http_session().get(api_url, headers=headers, proxies=self.proxies, timeout=10).close()
+
+    def _should_prime(self, history):
+        """Primes only new history, and only when the prefix is long enough for the provider to cache it."""
+        if not history or len(history) == self._primed_len:
+            return False
+        if self.provider == "local":
+            # llama.cpp/Ollama reuse the KV cache for any shared prefix
+            return True
+        chars = len(self.profile_config.get("system_instruction", "")) + history.char_count()
+        return chars // 4 >= PREFETCH_MIN_CACHE_TOKENS
+
+    def _prime(self, history):
+        """Sends system prompt + history + a placeholder turn with a 1-token budget to populate the prompt cache."""
+        primer = ChatHistory(history.messages + [Message("user", ".")])
+        if self.provider == "gemini":
+            api_url, headers, payload = build_gemini_request(self.profile_config, "", primer)
+            payload["generationConfig"] = dict(payload["generationConfig"], maxOutputTokens=1)
+        else:
+            api_url, headers, payload = build_openai_request(self.profile_config, "", primer)
+            payload["max_tokens"] = 1
+        # Speculative, so it never competes with the real requests for a slot
+        scheduler = RequestScheduler(self.profile_config)
+        scheduler.acquire(payload, priority="batch")
+        try:
+            post_json(self.profile_config, api_url, payload, headers=headers, proxies=self.proxies, timeout=60).close()
+        finally:
+            scheduler.release()
+        self._primed_len = len(history)
+
+    def record(self, meta):
+        """Prints the latency metrics for the turn that was just answered and keeps them for the summary."""
+        turn = self._turn or {}
+        usage = meta.get("usage", {})
+        cached, prompt_tokens = usage.get("cached_tokens", 0), usage.get("prompt_tokens", 0)
+        saved_ms = 0.0
+        if turn.get("done") and turn.get("ping_ms") is not None:
+            baseline = self._min_ping_ms or 0
+            # Cold-connection setup moved off the critical path: this ping minus the fastest (warm) ping seen
+            saved_ms += max(0.0, turn["ping_ms"] - baseline)
+            # Prefix processing moved off the critical path, in proportion to the tokens served from cache
+            if turn.get("prime_ms") and cached and prompt_tokens:
+                saved_ms += max(0.0, turn["prime_ms"] - baseline) * min(1.0, cached / prompt_tokens)
+        stats = {"request_ms": meta.get("latency_ms", 0.0), "ready": bool(turn.get("done")), "saved_ms": saved_ms,
+                 "cached_tokens": cached, "prompt_tokens": prompt_tokens}
+        self.turns.append(stats)
+
+        if not stats["ready"]:
+            detail = "warm-up still running at send"
+        else:
+            warm_ms = (turn.get("ping_ms") or 0) + (turn.get("prime_ms") or 0)
+            detail = f"warm-up {warm_ms:.0f} ms while typing"
+            if prompt_tokens:
+                detail += f" · cached {cached}/{prompt_tokens} tokens"
+        print(f"{BLUE}[prefetch] request {stats['request_ms']:.0f} ms · {detail} · est. saved {saved_ms:.0f} ms{RESET}")
+
+    def retarget(self, profile_config, proxy=""):
+        """Points the prefetcher at a new profile/model, keeping the metrics. The next warm-up primes the whole history on the new target."""
+        self.provider = profile_config.get("provider", "gemini")
+        self.profile_config = profile_config
+        if self.provider == "local":
+            self.profile_config = dict(profile_config, base_url=_local_api_root(profile_config))
+        self.proxies = {"http": proxy, "https": proxy} if proxy and self.provider != "local" else None
+        self._primed_len = 0
+        self._min_ping_ms = None
+
+    def print_summary(self):
+        """Prints the per-session totals when the chat ends."""
+        if not self.turns:
+            return
+        total = sum(t["saved_ms"] for t in self.turns)
+        ready = sum(1 for t in self.turns if t["ready"])
+        print(f"{BLUE}[prefetch] {len(self.turns)} turns, {ready} warmed in time, est. saved {total:.0f} ms total ({total / len(self.turns):.0f} ms/turn){RESET}")
+
+class StageOutput:
+    """
+    Thread-safe, append-only stream of text chunks produced by one pipeline stage.
+    Any number of consumers can iterate it while it is still being written.
+    """
+
+    def __init__(self, name):
+        import threading
+        self.name = name
+        self.chunks = []
+        self.closed = False
+        self.error = None
+        self._cond = threading.Condition()
+
+    def append(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def close(self, error=None):
+        with self._cond:
+            self.closed = True
+            self.error = error
+            self._cond.notify_all()
+
+    def iter_chunks(self):
+        """Yields chunks as they arrive until the stage finishes; raises if the stage failed."""
+        idx = 0
+        while True:
+            with self._cond:
+                while idx >= len(self.chunks) and not self.closed:
+                    self._cond.wait()
+                pending = self.chunks[idx:]
+                idx = len(self.chunks)
+                done = self.closed
+                error = self.error
+            for chunk in pending:
+                yield chunk
+            if done and idx >= len(self.chunks):
+                if error:
+                    raise RuntimeError(f"stage '{self.name}' failed: {error}")
+                return
+
+    def iter_lines(self):
+        """Yields complete lines (with newline) as the stage streams them."""
+        buffer = ""
+        for chunk in self.iter_chunks():
+            buffer += chunk
+            while "\n" in buffer:
+                line, buffer = buffer.split("\n", 1)
+                yield line + "\n"
+        if buffer:
+            yield buffer
+
+    def text(self):
+        """Blocks until the stage finishes and returns its full output."""
+        return "".join(self.iter_chunks())
+
+def load_pipeline(path):
+    """Loads a pipeline definition from YAML (requires PyYAML) or JSON and validates its stages."""
+    with open(path, "r") as f:
+        raw = f.read()
+    try:
+        import yaml
+        spec = yaml.safe_load(raw)
+    except ImportError:
+        try:
+            spec = json.loads(raw)
+        except ValueError:
+            raise ValueError("YAML pipelines need PyYAML (pip install pyyaml); JSON pipeline files work without it.")
+
+    if isinstance(spec, list):
+        spec = {"stages": spec}
+    if not isinstance(spec, dict) or not isinstance(spec.get("stages"), list) or not spec["stages"]:
+        raise ValueError("pipeline must define a non-empty 'stages' list")
+
+    seen = []
+    for idx, stage in enumerate(spec["stages"]):
+        if not isinstance(stage, dict) or not stage.get("prompt"):
+            raise ValueError(f"stage {idx + 1} needs a 'prompt'")
+        stage.setdefault("name", f"stage{idx + 1}")
+        if stage["name"] in seen or stage["name"] == "stdin":
+            raise ValueError(f"duplicate or reserved stage name '{stage['name']}'")
+        # Default wiring is a linear chain: stdin -> stage1 -> stage2 -> ...
+        inputs = stage.get("input", seen[-1] if seen else "stdin")
+        inputs = [inputs] if isinstance(inputs, str) else list(inputs or [])
+        for name in inputs:
+            if name != "stdin" and name not in seen:
+                raise ValueError(f"stage '{stage['name']}' reads from unknown or later stage '{name}'")
+        if stage.get("batch_lines") and len(inputs) != 1:
+            raise ValueError(f"stage '{stage['name']}' uses batch_lines and must have exactly one input")
+        stage["input"] = inputs
+        seen.append(stage["name"])
+
+    outputs = spec.get("output", seen[-1])
+    spec["output"] = [outputs] if isinstance(outputs, str) else list(outputs)
+    for name in spec["output"]:
+        if name not in seen:
+            raise ValueError(f"output refers to unknown stage '{name}'")
+    return spec
+
+def _request_key(profile_config, user_input):
+    """Content hash of everything that determines a request's answer (profile settings and prompt, not credentials)."""
+    import hashlib
+    material = {k: v for k, v in profile_config.items() if k not in ["api_key", "server_command"]}
+    material["input"] = user_input
+    return hashlib.sha256(json.dumps(material, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _cached_stream(profile_config, user_input, proxy, use_cache, debug_mode, label):
+    """Streams one stage request, serving it from PIPE_CACHE_DIR when the same content ran before."""
+    cache_file = PIPE_CACHE_DIR / f"{_request_key(profile_config, user_input)}.txt"
+    if use_cache and cache_file.exists():
+        if debug_mode: sys.stderr.write(f"[Debug] pipe: {label} served from cache\n")
+        yield cache_file.read_text()
+        return
+    meta = {}
+    for chunk in stream_completion(profile_config, user_input, proxy=proxy, meta=meta):
+        yield chunk
+    if debug_mode: sys.stderr.write(f"[Debug] pipe: {label} done in {meta.get('latency_ms', 0):.0f} ms\n")
+    if use_cache:
+        try:
+            PIPE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            tmp_file.write_text(meta.get("text", ""))
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+
+def _run_stage(stage, profile_config, channels, proxy, use_cache, debug_mode):
+    """Runs one stage in its own thread, writing its streamed answer into its output channel."""
+    out = channels[stage["name"]]
+    try:
+        if stage.get("batch_lines"):
+            # Streaming consumer: one request per batch of upstream lines, issued as soon as the batch is complete
+            batch, batch_no = [], 0
+            def flush(lines, number):
+                user_input = "".join(lines) + "\n" + stage["prompt"]
+                for chunk in _cached_stream(profile_config, user_input, proxy, use_cache, debug_mode, f"{stage['name']}#{number}"):
+                    out.append(chunk)
+                out.append("\n")
+            for line in channels[stage["input"][0]].iter_lines():
+                batch.append(line)
+                if len(batch) >= int(stage["batch_lines"]):
+                    batch_no += 1
+                    flush(batch, batch_no)
+                    batch = []
+            if batch:
+                flush(batch, batch_no + 1)
+        else:
+            texts = [(name, channels[name].text()) for name in stage["input"]]
+            if len(texts) == 1:
+                context = texts[0][1].strip()
+            else:
+                context = "\n\n".join(f"[{name}]\n{text.strip()}" for name, text in texts)
+            user_input = f"{context}\n{stage['prompt']}" if context else stage["prompt"]
+            for chunk in _cached_stream(profile_config, user_input, proxy, use_cache, debug_mode, stage["name"]):
+                out.append(chunk)
+        out.close()
+    except Exception as e:
+        out.close(error=e)
+
+def run_pipeline(config, pipeline_path, debug_mode=False, use_cache=True):
+    """
+    Runs a multi-stage prompt chain (ai pipe stages.yaml). Every stage runs in its own thread and
+    starts as soon as its inputs are available, so independent stages run concurrently. Stages
+    exchange streamed chunks in-process instead of buffering through shell pipes, and the output
+    stage streams straight to stdout.
+    """
+    import threading
+    try:
+        spec = load_pipeline(pipeline_path)
+    except (OSError, ValueError) as e:
+        print(f"{RED}[Error] Invalid pipeline '{pipeline_path}': {e}{RESET}")
+        return 1
+
+    profiles = config.get("profiles", {})
+    for stage in spec["stages"]:
+        profile_name = stage.get("profile", config.get("active_profile", ""))
+        if profile_name not in profiles:
+            print(f"{RED}[Error] Stage '{stage['name']}' uses unknown profile '{profile_name}'.{RESET}")
+            return 1
+        stage_config = copy.deepcopy(profiles[profile_name])
+        if stage.get("model"):
+            stage_config["model_name"] = stage["model"]
+        if stage.get("system_instruction"):
+            stage_config["system_instruction"] = stage["system_instruction"]
+        stage["_profile_config"] = stage_config
+
+    channels = {"stdin": StageOutput("stdin")}
+    for stage in spec["stages"]:
+        channels[stage["name"]] = StageOutput(stage["name"])
+
+    def read_stdin():
+        if not sys.stdin.isatty():
+            for line in sys.stdin:
+                channels["stdin"].append(line)
+        channels["stdin"].close()
+
+    threads = [threading.Thread(target=read_stdin, daemon=True)]
+    proxy = config.get("proxy", "")
+    for stage in spec["stages"]:
+        threads.append(threading.Thread(
+            target=_run_stage,
+            args=(stage, stage["_profile_config"], channels, proxy, use_cache, debug_mode),
+            daemon=True
+        ))
+    for thread in threads:
+        thread.start()
+
+    status = 0
+    for idx, name in enumerate(spec["output"]):
+        if idx:
+            sys.stdout.write("\n")
+        try:
+            for chunk in channels[name].iter_chunks():
+                sys.stdout.write(chunk)
+                sys.stdout.flush()
+        except RuntimeError as e:
+            print(f"\n{RED}[Error] Pipeline {e}{RESET}")
+            status = 1
+            break
+    sys.stdout.write("\n")
+    return status
+
+def embed_text(profile_config, text, embedding_model, proxy=""):
+    """Returns the embedding vector of `text` from the profile's provider (Gemini embedContent or an OpenAI-compatible /embeddings)."""
+    provider = profile_config.get("provider", "gemini")
+    proxies = {"http": proxy, "https": proxy} if proxy and provider != "local" else None
+    if provider == "gemini":
+        api_url = f"{_gemini_api_root(profile_config)}/models/{embedding_model}:embedContent?key={profile_config.get('api_key')}"
+        response = post_json(profile_config, api_url, {"content": {"parts": [{"text": text}]}}, proxies=proxies, timeout=30)
+        if response.status_code != 200:
+            raise ProviderError(response.status_code, response.text)
+        return decode_json(response.content)["embedding"]["values"]
+
+    headers = {"Authorization": f"Bearer {profile_config.get('api_key')}"}
+    api_url = f"{_provider_api_root(profile_config)}/embeddings"
+    response = post_json(profile_config, api_url, {"model": embedding_model, "input": text}, headers=headers, proxies=proxies, timeout=30)
+    if response.status_code != 200:
+        raise ProviderError(response.status_code, response.text)
+    return decode_json(response.content)["data"][0]["embedding"]
+
+class SingleFlight:
+    """
+    Cross-process single-flight for identical single-shot requests, keyed on the request hash. The first
+    process to lock the key's file under SINGLE_FLIGHT_DIR makes the API call; processes that start while
+    it is in flight wait on the lock and reuse the answer it publishes, so N identical concurrent calls
+    cost one. If the call fails, the next waiting process makes it instead. Needs fcntl (Unix).
+    """
+    def __init__(self, key, wait=SINGLE_FLIGHT_WAIT):
+        self.lock_file = SINGLE_FLIGHT_DIR / f"{key}.lock"
+        self.result_file = SINGLE_FLIGHT_DIR / f"{key}.json"
+        self.wait = wait
+        self._lock = None
+
+    def join(self):
+        """
+        Returns the answer meta of an identical request that was in flight when this one started, or None
+        if this process should make the call itself (it then holds the lock until release()).
+        """
+        import time
+        try:
+            import fcntl
+        except ImportError:
+            return None
+        try:
+            SINGLE_FLIGHT_DIR.mkdir(parents=True, exist_ok=True)
+            lock = open(self.lock_file, "a+")
+        except OSError:
+            return None
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Polled rather than blocking so a hung leader can't hold us past the deadline
+            start = time.time()
+            while True:
+                time.sleep(0.05)
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    if time.time() - start > self.wait:
+                        lock.close()
+                        return None
+            try:
+                shared = decode_json(self.result_file.read_bytes())
+            except (OSError, ValueError):
+                shared = None
+            if shared is not None:
+                lock.close()
+                shared["latency_ms"] = (time.time() - start) * 1000
+                return shared
+            # No answer was published (the leader failed): this process makes the call
+        self._lock = lock
+        try:
+            os.utime(self.lock_file)
+            if self.result_file.exists():
+                self.result_file.unlink() # an answer from an earlier flight, not one we waited for
+        except OSError:
+            pass
+        self._prune()
+        return None
+
+    def release(self, meta=None):
+        """Publishes a successful answer to the waiting processes and releases the lock."""
+        if self._lock is None:
+            return
+        try:
+            if meta and meta.get("text"):
+                tmp_file = self.result_file.with_suffix(f".{os.getpid()}.tmp")
+                tmp_file.write_bytes(encode_json(meta))
+                os.replace(tmp_file, self.result_file)
+        except (OSError, TypeError, ValueError):
+            pass
+        finally:
+            self._lock.close() # closing the file releases the flock
+            self._lock = None
+
+    @staticmethod
+    def _prune():
+        """Removes lock and answer files of flights that ended long ago."""
+        import time
+        cutoff = time.time() - SINGLE_FLIGHT_TTL
+        try:
+            for entry in os.scandir(SINGLE_FLIGHT_DIR):
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+        except OSError:
+            pass
+
+class RequestScheduler:
+    """
+    Cross-process admission control for profiles that set "max_inflight" (concurrent requests), "rpm"
+    (requests per minute) and/or "tpm" (tokens per minute). All ai processes using the same endpoint,
+    key and model share one state file under SCHEDULER_DIR, updated under flock: the requests in flight,
+    the waiting requests with their priority, and a one-minute ledger of admitted requests. The oldest
+    waiter of the best priority class is admitted as soon as the limits allow. Interactive requests (chat,
+    answers read on a terminal) outrank batch ones (scripts, `ai pipe`), and batch requests leave one
+    in-flight slot free for them. With "max_inflight": 1 there is no slot to spare: batch requests run
+    only while no interactive one is waiting or in flight, and one already running is not interrupted.
+    Profiles without limits skip all of this.
+    """
+    PRIORITIES = ("interactive", "batch")
+    priority = "interactive" # class of this process's requests, set from the command line
+
+    def __init__(self, profile_config):
+        self.provider = profile_config.get("provider", "gemini")
+        self.limits = {key: int(profile_config[key]) for key in ("max_inflight", "rpm", "tpm") if profile_config.get(key)}
+        self.ticket = None
+        self.waited_ms = 0.0
+        try:
+            import fcntl # noqa: F401 (no cross-process coordination without flock)
+        except ImportError:
+            self.limits = {}
+        if self.limits:
+            import hashlib
+            identity = "\0".join(str(profile_config.get(key, "")) for key in ("provider", "base_url", "socket_path", "api_key", "model_name"))
+            digest = hashlib.sha256(identity.encode("utf-8")).hexdigest()[:16]
+            self.state_file = SCHEDULER_DIR / f"{digest}.json"
+            self.lock_file = SCHEDULER_DIR / f"{digest}.lock"
+
+    def acquire(self, payload, priority=None):
+        """
+        Blocks until the request may be sent. Its tokens are estimated like the providers' rate limiters
+        do: the input plus the output budget. Raises ProviderError(429) after SCHEDULER_MAX_WAIT.
+        """
+        if not self.limits:
+            return
+        import time
+        import uuid
+        generation_config = payload.get("generationConfig") or {}
+        output_budget = payload.get("max_tokens") or generation_config.get("maxOutputTokens") or 0
+        entry = {"pid": os.getpid(), "priority": priority or self.priority, "since": time.time(),
+                 "tokens": estimate_request_tokens(self.provider, payload) + int(output_budget)}
+        ticket = uuid.uuid4().hex[:16]
+        try:
+            while not self._update(lambda state: self._admit(state, ticket, entry)):
+                if time.time() - entry["since"] > SCHEDULER_MAX_WAIT:
+                    limits = ", ".join(f"{key} {value}" for key, value in self.limits.items())
+                    raise ProviderError(429, f"No request slot became free within {SCHEDULER_MAX_WAIT}s under this profile's limits ({limits}).")
+                time.sleep(SCHEDULER_POLL)
+        except BaseException:
+            self._update(lambda state: state["waiting"].pop(ticket, None))
+            raise
+        self.ticket = ticket
+        self.waited_ms = (time.time() - entry["since"]) * 1000
+
+    def release(self, usage=None):
+        """Frees the in-flight slot. With the response's usage, the ledger keeps the real token count instead of the estimate."""
+        if self.ticket is None:
+            return
+        ticket, self.ticket = self.ticket, None
+        tokens = (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0) if usage else 0
+
+        def change(state):
+            state["inflight"].pop(ticket, None)
+            for item in state["ledger"]:
+                if item[2] == ticket and tokens:
+                    item[1] = tokens
+        self._update(change)
+
+    def _admit(self, state, ticket, entry):
+        """Admits the request if it is first in line and within every limit; otherwise (re)registers it as waiting."""
+        import time
+        waiting = state["waiting"]
+        waiting[ticket] = entry
+        first = min(waiting, key=lambda t: (self.PRIORITIES.index(waiting[t]["priority"]), waiting[t]["since"], t))
+        if first != ticket:
+            return False
+        max_inflight = self.limits.get("max_inflight")
+        if max_inflight:
+            busy = len(state["inflight"])
+            if entry["priority"] == "interactive":
+                full = busy >= max_inflight
+            elif max_inflight > 1:
+                full = busy >= max_inflight - 1 # one slot stays free for interactive requests
+            else:
+                # A single slot can't be held back: batch takes it only while no interactive request waits or runs
+                full = busy > 0 or any(item["priority"] == "interactive" for item in waiting.values())
+            if full:
+                return False
+        ledger = state["ledger"]
+        if self.limits.get("rpm") and len(ledger) >= self.limits["rpm"]:
+            return False
+        # A request larger than the whole budget still goes through once the minute is clear
+        if self.limits.get("tpm") and ledger and sum(item[1] for item in ledger) + entry["tokens"] > self.limits["tpm"]:
+            return False
+        del waiting[ticket]
+        state["inflight"][ticket] = {"pid": entry["pid"], "priority": entry["priority"]}
+        ledger.append([time.time(), entry["tokens"], ticket])
+        return True
+
+    def _update(self, change):
+        """Applies change(state) to the shared state under an exclusive lock and returns its result."""
+        import fcntl
+        import time
+        SCHEDULER_DIR.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_file, "a+") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = decode_json(self.state_file.read_bytes())
+            except (OSError, ValueError):
+                state = {}
+            # Forget requests of processes that exited without releasing them, and ledger entries past the minute
+            alive = {}
+            for section in ("inflight", "waiting"):
+                entries = state.get(section) or {}
+                for entry in entries.values():
+                    if entry["pid"] not in alive:
+                        try:
+                            os.kill(entry["pid"], 0)
+                            alive[entry["pid"]] = True
+                        except ProcessLookupError:
+                            alive[entry["pid"]] = False
+                        except OSError:
+                            alive[entry["pid"]] = True
+                state[section] = {ticket: entry for ticket, entry in entries.items() if alive[entry["pid"]]}
+            cutoff = time.time() - 60
+            state["ledger"] = [item for item in state.get("ledger") or [] if item[0] > cutoff]
+            result = change(state)
+            tmp_file = self.state_file.with_suffix(f".{os.getpid()}.tmp")
+            tmp_file.write_bytes(encode_json(state))
+            os.replace(tmp_file, self.state_file)
+        return result
+
+class SemanticCache:
+    """
+    Answers near-duplicate prompts locally. Prompts are embedded through the profile's provider
+    (or a local server), stored as unit-length float32 rows in an append-only file that is
+    memory-mapped for lookups, and compared with a single vectorized NumPy dot product
+    (cosine similarity). Whitespace/case-only differences hit an exact tier without embedding.
+    Requires NumPy; construction raises ImportError without it.
+    """
+
+    def __init__(self, profile_config, settings, proxy=""):
+        import hashlib
+        import numpy
+        self.np = numpy
+        self.profile_config = profile_config
+        self.proxy = proxy
+        provider = profile_config.get("provider", "gemini")
+        self.embedding_model = (settings.get("embedding_model") or profile_config.get("embedding_model")
+                                or DEFAULT_EMBEDDING_MODELS.get(provider) or profile_config.get("model_name", ""))
+        self.threshold = float(settings.get("threshold", 0.95))
+        self.max_entries = int(settings.get("max_entries", 5000))
+
+        # One store per embedding space; answers are namespaced per model + persona within it
+        space = f"{provider}|{_provider_api_root(profile_config) if provider != 'gemini' else ''}|{self.embedding_model}"
+        self.dir = SEMANTIC_CACHE_DIR / hashlib.sha256(space.encode("utf-8")).hexdigest()[:16]
+        answer_settings = {k: v for k, v in profile_config.items() if k not in ["api_key", "server_command", "prefetch"]}
+        self.namespace = hashlib.sha256(json.dumps(answer_settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        self.vectors_file = self.dir / "vectors.f32"
+        self.entries_file = self.dir / "entries.jsonl"
+        self._pending = None
+
+    @staticmethod
+    def _prompt_key(prompt):
+        import hashlib
+        normalized = " ".join(prompt.lower().split())
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def _read_entries(self):
+        entries = []
+        try:
+            with open(self.entries_file, "r") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        entries.append({})
+        except OSError:
+            pass
+        return entries
+
+    def _vectors(self, dim):
+        """Memory-maps the stored vectors; returns None when the store is empty or was built for another dimension."""
+        try:
+            size = self.vectors_file.stat().st_size
+        except OSError:
+            return None
+        rows = size // (dim * 4)
+        if rows == 0:
+            return None
+        return self.np.memmap(self.vectors_file, dtype=self.np.float32, mode="r", shape=(rows, dim))
+
+    def _embed(self, prompt):
+        if len(prompt) > SEMANTIC_EMBED_MAX_CHARS:
+            half = SEMANTIC_EMBED_MAX_CHARS // 2
+            prompt = prompt[:half] + "\n...\n" + prompt[-half:]
+        vector = self.np.asarray(embed_text(self.profile_config, prompt, self.embedding_model, self.proxy), dtype=self.np.float32)
+        norm = float(self.np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    def lookup(self, prompt):
+        """Returns (response, similarity) for the closest cached prompt above the threshold, else (None, best_similarity)."""
+        key = self._prompt_key(prompt)
+        entries = self._read_entries()
+        for entry in reversed(entries):
+            if entry.get("key") == key and entry.get("ns") == self.namespace:
+                return entry.get("response"), 1.0
+
+        vector = self._embed(prompt)
+        self._pending = (key, vector)
+        matrix = self._vectors(vector.shape[0])
+        if matrix is None:
+            return None, 0.0
+        rows = min(len(matrix), len(entries))
+        scores = matrix[:rows] @ vector
+        best = 0.0
+        for idx in self.np.argsort(scores)[::-1][:16]:
+            score = float(scores[idx])
+            best = max(best, score)
+            if score < self.threshold:
+                break
+            if entries[idx].get("ns") == self.namespace:
+                return entries[idx].get("response"), score
+        return None, best
+
+    def store(self, prompt, response):
+        """Appends a prompt vector and its answer; compacts the store past max_entries."""
+        key = self._prompt_key(prompt)
+        vector = self._pending[1] if self._pending and self._pending[0] == key else self._embed(prompt)
+        dim = vector.shape[0]
+        entry = {"key": key, "ns": self.namespace, "dim": dim, "response": response}
+        self.dir.mkdir(parents=True, exist_ok=True)
+        with open(self.dir / "lock", "w") as lock:
+            try:
+                import fcntl
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            except ImportError:
+                pass
+            entries = self._read_entries()
+            matrix = self._vectors(dim)
+            rows = len(matrix) if matrix is not None else 0
+            if rows != len(entries) or (entries and entries[-1].get("dim") != dim):
+                # Interrupted write or a new embedding dimension: start the store over
+                entries, rows, matrix = [], 0, None
+                open(self.vectors_file, "wb").close()
+                open(self.entries_file, "w").close()
+            if rows + 1 > self.max_entries and matrix is not None:
+                keep = max(0, self.max_entries - 1)
+                kept_vectors = self.np.array(matrix[rows - keep:]) if keep else self.np.zeros((0, dim), self.np.float32)
+                kept_entries = entries[len(entries) - keep:] if keep else []
+                del matrix
+                tmp_vectors = self.vectors_file.with_suffix(".tmp")
+                tmp_vectors.write_bytes(kept_vectors.astype(self.np.float32).tobytes())
+                with open(self.entries_file.with_suffix(".tmp"), "w") as f:
+                    f.writelines(json.dumps(e) + "\n" for e in kept_entries)
+                os.replace(tmp_vectors, self.vectors_file)
+                os.replace(self.entries_file.with_suffix(".tmp"), self.entries_file)
+            with open(self.vectors_file, "ab") as f:
+                f.write(vector.astype(self.np.float32).tobytes())
+            with open(self.entries_file, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+class MockProviderServer:
+    """
+    Local stand-in for the Gemini and OpenAI APIs (`ai mock-server`) for offline development, demos and
+    load tests. Gemini routes (generateContent, streamGenerateContent, countTokens, embedContent and the
+    model list) are recognised by their `:method` suffix or `key` parameter, OpenAI-compatible ones by
+    /chat/completions, /embeddings and /models under any prefix. Replies are deterministic filler text
+    paced by `latency` (seconds to the first token, a (min, max) range) and `token_rate` (tokens per
+    second, 0 = unpaced). `errors` maps an HTTP status, "timeout" (hold the connection, then drop it) or
+    "cut" (end the reply halfway) to the share of generation requests that get it, and generation
+    requests beyond `concurrency` in flight are rejected with 429. One thread per connection, keep-alive.
+    """
+    MODELS = ("mock-flash", "mock-pro")
+    EMBEDDING_MODEL = "mock-embedding"
+    WORDS = ("this", "is", "a", "mock", "reply", "streamed", "one", "token", "at", "a", "time", "so", "clients",
+             "can", "be", "tested", "without", "network", "access", "or", "api", "keys")
+    CHUNK_TOKENS = 4 # tokens per streamed event
+
+    def __init__(self, host="127.0.0.1", port=MOCK_SERVER_PORT, latency=(0.0, 0.0), token_rate=0.0, reply_tokens=64,
+                 errors=None, concurrency=0, hang=MOCK_SERVER_HANG, debug_mode=False):
+        import threading
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.errors = errors or {}
+        self.concurrency = concurrency
+        self.hang = hang
+        self.debug_mode = debug_mode
+        self.stats = {}
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def parse_latency(spec):
+        """Parses "200" or "100-400" (milliseconds) into a (min, max) range in seconds."""
+        low, _, high = spec.partition("-")
+        low = float(low) / 1000
+        high = float(high) / 1000 if high else low
+        if low < 0 or high < low:
+            raise ValueError(f"invalid latency range '{spec}'")
+        return low, high
+
+    @staticmethod
+    def parse_errors(spec):
+        """Parses an error injection spec like "429=0.05,500=0.01,timeout=0.01" into {outcome: rate}."""
+        errors = {}
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            name, _, rate = item.partition("=")
+            name = name.strip().lower()
+            if not (name.isdigit() and 400 <= int(name) < 600) and name not in ("timeout", "cut"):
+                raise ValueError(f"unknown error '{name}' (use a 4xx/5xx status, timeout or cut)")
+            errors[int(name) if name.isdigit() else name] = float(rate)
+        if sum(errors.values()) > 1:
+            raise ValueError("error rates add up to more than 1")
+        return errors
+
+    @staticmethod
+    def embedding(text):
+        """Deterministic bag-of-words vector, so texts sharing words come out similar (e.g. for --semantic-cache)."""
+        import math
+        import zlib
+        vector = [0.0] * MOCK_EMBEDDING_DIM
+        for word in re.findall(r"\w+", text.lower()):
+            vector[zlib.crc32(word.encode("utf-8")) % MOCK_EMBEDDING_DIM] += 1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def reply_pieces(self, prompt, limit=None):
+        """Returns the reply as one piece per token (word) and the finish reason ("stop" or "length")."""
+        words = ["Mock", "reply", "to:"] + prompt.split()[:8]
+        while len(words) < self.reply_tokens:
+            words.append(self.WORDS[len(words) % len(self.WORDS)])
+        words = words[:self.reply_tokens]
+        finish = "stop"
+        if limit and limit < len(words):
+            words, finish = words[:limit], "length"
+        return [word if i == 0 else " " + word for i, word in enumerate(words)], finish
+
+    def _count(self, outcome):
+        with self._lock:
+            self.stats[outcome] = self.stats.get(outcome, 0) + 1
+
+    def _pick_error(self):
+        import random
+        roll = random.random()
+        for outcome, rate in self.errors.items():
+            if roll < rate:
+                return outcome
+            roll -= rate
+        return None
+
+    @staticmethod
+    def _send_json(handler, status, obj, headers=None):
+        data = encode_json(obj)
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _send_error(self, handler, provider, status, message):
+        if provider == "gemini":
+            statuses = {400: "INVALID_ARGUMENT", 404: "NOT_FOUND", 429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE"}
+            body = {"error": {"code": status, "message": message, "status": statuses.get(status, "UNKNOWN")}}
+        else:
+            kind = "rate_limit_error" if status == 429 else "server_error" if status >= 500 else "invalid_request_error"
+            body = {"error": {"message": message, "type": kind, "code": None}}
+        self._send_json(handler, status, body, {"Retry-After": "1"} if status == 429 else None)
+
+    def handle(self, handler, method):
+        """Routes one request from the HTTP handler thread."""
+        from urllib.parse import parse_qs, urlsplit
+        url = urlsplit(handler.path)
+        path = url.path.rstrip("/")
+        name = path.rsplit("/", 1)[-1]
+        model, _, action = name.partition(":")
+        provider = "gemini" if action or "/v1beta" in path or "key" in parse_qs(url.query, keep_blank_values=True) else "openai"
+        body = {}
+        if method == "POST":
+            raw = handler.rfile.read(int(handler.headers.get("Content-Length") or 0))
+            try:
+                if handler.headers.get("Content-Encoding", "").lower() == "gzip":
+                    import gzip
+                    raw = gzip.decompress(raw)
+                body = decode_json(raw) if raw else {}
+            except (OSError, ValueError):
+                self._count("400")
+                return self._send_error(handler, provider, 400, "Request body is not valid JSON")
+
+        if method == "GET" and name == "models":
+            if provider == "gemini":
+                models = [{"name": f"models/{m}", "displayName": m.replace("-", " ").title(), "description": "Mock model served by ai mock-server",
+                           "supportedGenerationMethods": ["generateContent", "countTokens"]} for m in self.MODELS]
+                models.append({"name": f"models/{self.EMBEDDING_MODEL}", "displayName": "Mock Embedding", "supportedGenerationMethods": ["embedContent"]})
+                listing = {"models": models}
             else:
-                print("[No content returned]")
-                if debug_mode: print(data)
+                listing = {"object": "list", "data": [{"id": m, "object": "model", "created": 0, "owned_by": "termai-mock"}
+                                                      for m in self.MODELS + (self.EMBEDDING_MODEL,)]}
+            self._count("200")
+            return self._send_json(handler, 200, listing)
+        if method == "POST" and action in ("generateContent", "streamGenerateContent"):
+            return self._generate(handler, "gemini", model, body, stream=action == "streamGenerateContent")
+        if method == "POST" and name == "completions" and path.endswith("/chat/completions"):
+            return self._generate(handler, "openai", body.get("model", self.MODELS[0]), body, stream=bool(body.get("stream")))
+        if method == "POST" and action == "countTokens":
+            request = body.get("generateContentRequest", body)
+            self._count("200")
+            return self._send_json(handler, 200, {"totalTokens": estimate_request_tokens("gemini", request)})
+        if method == "POST" and action == "embedContent":
+            text = " ".join(part.get("text", "") for part in body.get("content", {}).get("parts", []))
+            self._count("200")
+            return self._send_json(handler, 200, {"embedding": {"values": self.embedding(text)}})
+        if method == "POST" and name == "embeddings":
+            inputs = body.get("input", "")
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            tokens = sum(estimate_tokens(text) for text in inputs)
+            self._count("200")
+            return self._send_json(handler, 200, {
+                "object": "list", "model": body.get("model", self.EMBEDDING_MODEL),
+                "data": [{"object": "embedding", "index": i, "embedding": self.embedding(text)} for i, text in enumerate(inputs)],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+            })
+        self._count("404")
+        self._send_error(handler, provider, 404, f"No mock route for {method} {url.path}")
+
+    def _generate(self, handler, provider, model, body, stream):
+        """Answers a generation request, applying the concurrency cap, error injection, latency and token pacing."""
+        import random
+        import time
+        with self._lock:
+            busy = self.concurrency and self.active >= self.concurrency
+            if not busy:
+                self.active += 1
+                self.peak = max(self.peak, self.active)
+        if busy:
+            self._count("429 (over concurrency)")
+            return self._send_error(handler, provider, 429, "Mock server is at its concurrency limit")
+        try:
+            outcome = self._pick_error()
+            if isinstance(outcome, int):
+                self._count(str(outcome))
+                return self._send_error(handler, provider, outcome, f"Injected {outcome} error")
+            if outcome == "timeout":
+                self._count("timeout")
+                time.sleep(self.hang)
+                handler.close_connection = True
+                return
+
+            if provider == "gemini":
+                texts = [[part.get("text", "") for part in content.get("parts", [])] for content in body.get("contents", [])]
+                limit = (body.get("generationConfig") or {}).get("maxOutputTokens")
+            else:
+                texts = []
+                for message in body.get("messages", []):
+                    content = message.get("content") or ""
+                    texts.append([content] if isinstance(content, str) else [part.get("text", "") for part in content])
+                limit = body.get("max_completion_tokens") or body.get("max_tokens")
+            prompt = " ".join(texts[-1]) if texts else ""
+            prompt_tokens = sum(estimate_tokens(text, provider) for parts in texts for text in parts)
+            pieces, finish = self.reply_pieces(prompt, limit)
+            cut = outcome == "cut"
+
+            time.sleep(random.uniform(*self.latency))
+            if stream:
+                self._stream(handler, provider, model, body, pieces, finish, prompt_tokens, cut)
+            else:
+                self._complete(handler, provider, model, pieces, finish, prompt_tokens, cut)
+            self._count("cut" if cut else "200")
+        except (BrokenPipeError, ConnectionResetError):
+            self._count("client disconnected")
+            handler.close_connection = True
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    @staticmethod
+    def _usage(provider, prompt_tokens, completion_tokens):
+        if provider == "gemini":
+            return {"usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": completion_tokens,
+                                      "totalTokenCount": prompt_tokens + completion_tokens}}
+        return {"usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens}}
+
+    def _complete(self, handler, provider, model, pieces, finish, prompt_tokens, cut):
+        import time
+        if self.token_rate:
+            time.sleep(len(pieces) / self.token_rate)
+        text = "".join(pieces)
+        if provider == "gemini":
+            data = {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "index": 0,
+                                    "finishReason": "MAX_TOKENS" if finish == "length" else "STOP"}], "modelVersion": model}
         else:
-            print("[Error] Invalid response format from Gemini")
-            if debug_mode: print(data)
+            data = {"id": f"chatcmpl-mock-{id(handler):x}", "object": "chat.completion", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish}]}
+        data.update(self._usage(provider, prompt_tokens, len(pieces)))
+        if not cut:
+            return self._send_json(handler, 200, data)
+        # Promise the whole body, send half of it and drop the connection
+        payload = encode_json(data)
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload[:len(payload) // 2])
+        handler.close_connection = True
+
+    def _stream(self, handler, provider, model, body, pieces, finish, prompt_tokens, cut):
+        import time
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+
+        def send(event):
+            data = b"data: " + (event if isinstance(event, bytes) else encode_json(event)) + b"\n\n"
+            handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            handler.wfile.flush()
+
+        groups = ["".join(pieces[i:i + self.CHUNK_TOKENS]) for i in range(0, len(pieces), self.CHUNK_TOKENS)]
+        if cut:
+            groups = groups[:max(1, len(groups) // 2)]
+        delay = self.CHUNK_TOKENS / self.token_rate if self.token_rate else 0
+        chunk_id = f"chatcmpl-mock-{id(handler):x}"
+        created = int(time.time())
+        for idx, text in enumerate(groups):
+            if idx and delay:
+                time.sleep(delay)
+            if provider == "gemini":
+                event = {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}], "modelVersion": model}
+                if idx == len(groups) - 1 and not cut:
+                    event["candidates"][0]["finishReason"] = "MAX_TOKENS" if finish == "length" else "STOP"
+                    event.update(self._usage(provider, prompt_tokens, len(pieces)))
+            else:
+                delta = {"role": "assistant", "content": text} if idx == 0 else {"content": text}
+                event = {"id": chunk_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                         "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            send(event)
+        if cut:
+            # No terminating chunk: the client sees the connection drop mid-stream
+            handler.close_connection = True
+            return
+        if provider == "openai":
+            send({"id": chunk_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                  "choices": [{"index": 0, "delta": {}, "finish_reason": finish}]})
+            if (body.get("stream_options") or {}).get("include_usage"):
+                send(dict({"id": chunk_id, "object": "chat.completion.chunk", "created": created, "model": model, "choices": []},
+                          **self._usage(provider, prompt_tokens, len(pieces))))
+            send(b"[DONE]")
+        handler.wfile.write(b"0\r\n\r\n")
+
+    def serve(self):
+        """Serves until interrupted, then prints a summary of the requests handled. Returns an exit status."""
+        import time
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive, so load tests reuse their connections
+            disable_nagle_algorithm = True # streamed events leave as soon as they are written
+
+            def do_GET(self):
+                mock.handle(self, "GET")
+
+            def do_POST(self):
+                mock.handle(self, "POST")
+
+            def log_message(self, format, *args):
+                if mock.debug_mode:
+                    sys.stderr.write(f"[Debug] {self.address_string()} {format % args}\n")
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+            request_queue_size = 1024 # bursts of new connections wait in the backlog instead of being refused
+
+            def handle_error(self, request, client_address):
+                # Clients hanging up (cancelled streams, load test shutdown) are routine, not worth a traceback
+                if mock.debug_mode or not isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+                    super().handle_error(request, client_address)
+
+        try:
+            server = Server((self.host, self.port), Handler)
+        except OSError as e:
+            print(f"{RED}[Error] Cannot listen on {self.host}:{self.port}: {e}{RESET}")
+            return 1
+        root = f"http://{self.host}:{server.server_address[1]}"
+        print(f"{GREEN}Mock provider server listening on {root}{RESET}")
+        print(f"  Gemini profiles: \"base_url\": \"{root}/v1beta\"")
+        print(f"  OpenAI profiles: \"base_url\": \"{root}/v1\"")
+        print("Press Ctrl+C to stop.", flush=True)
+        start = time.time()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        elapsed = max(time.time() - start, 1e-9)
+        total = sum(self.stats.values())
+        print(f"\n{CYAN}Served {total} requests in {elapsed:.1f}s ({total * 60 / elapsed:.0f}/min), peak concurrency {self.peak}{RESET}")
+        for outcome, count in sorted(self.stats.items(), key=lambda item: -item[1]):
+            print(f"  {outcome}: {count}")
         return 0
-    except Exception as e:
-        print(f"\n[Connection Error] {e}")
+
+def handle_mock_server(args):
+    """Parses `ai mock-server` options and serves until Ctrl+C."""
+    options = {"--host": "127.0.0.1", "--port": str(MOCK_SERVER_PORT), "--latency": "0", "--token-rate": "0",
+               "--reply-tokens": "64", "--errors": "", "--concurrency": "0", "--hang": str(MOCK_SERVER_HANG)}
+    idx = 0
+    while idx < len(args):
+        if args[idx] in options and idx + 1 < len(args):
+            options[args[idx]] = args[idx + 1]
+            idx += 2
+        elif args[idx] == "--debug":
+            idx += 1
+        else:
+            print(f"{RED}[Error] Unknown mock-server option: {args[idx]}{RESET}")
+            print("Usage: ai mock-server [--host H] [--port N] [--latency MS|MIN-MAX] [--token-rate N] [--reply-tokens N]")
+            print("                      [--errors 429=0.05,500=0.01,timeout=0.01,cut=0.01] [--concurrency N] [--hang S] [--debug]")
+            return 1
+    try:
+        server = MockProviderServer(
+            host=options["--host"],
+            port=int(options["--port"]),
+            latency=MockProviderServer.parse_latency(options["--latency"]),
+            token_rate=float(options["--token-rate"]),
+            reply_tokens=max(1, int(options["--reply-tokens"])),
+            errors=MockProviderServer.parse_errors(options["--errors"]),
+            concurrency=int(options["--concurrency"]),
+            hang=float(options["--hang"]),
+            debug_mode="--debug" in args
+        )
+    except ValueError as e:
+        print(f"{RED}[Error] Invalid mock-server option: {e}{RESET}")
         return 1
+    return server.serve()
 
-def send_openai_request(profile_config, user_input, debug_mode, proxy="", history=None, output_file=None):
-    api_key = profile_config.get("api_key")
-    model_name = profile_config.get("model_name", "gpt-4o")
-    system_instr = profile_config.get("system_instruction", "")
-    temperature = profile_config.get("temperature", 0.7)
-    max_tokens = profile_config.get("max_tokens", 1024)
-    base_url = profile_config.get("base_url", "https://api.openai.com/v1")
-    # Form the completions endpoint URL robustly
-    if base_url.endswith("/"):
-        base_url = base_url[:-1]
-    
-    if base_url.endswith("/chat/completions"):
-        api_url = base_url
-    else:
-        api_url = f"{base_url}/chat/completions"
-        
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
-    
-    if history is not None:
-        payload_messages = [{"role": "system", "content": system_instr}] + history
-    else:
-        payload_messages = [
-            {"role": "system", "content": system_instr},
-            {"role": "user", "content": user_input}
-        ]
+def _percentile(values, pct):
+    """Nearest-rank percentile of an ascending list (None when it is empty)."""
+    import math
+    if not values:
+        return None
+    return values[min(len(values), max(1, math.ceil(pct / 100 * len(values)))) - 1]
 
-    payload = {
-        "model": model_name,
-        "messages": payload_messages,
-        "temperature": temperature,
-        "max_tokens": max_tokens
-    }
-    if debug_mode: print(f"[Debug] Provider: OpenAI | Model: {model_name} | Temp: {temperature} | Proxy: {proxy if proxy else 'None'}")
+def run_load_test(profile_config, prompts, rps, duration, concurrency=LOADTEST_CONCURRENCY, timeout=LOADTEST_TIMEOUT, proxy="", show_progress=False):
+    """
+    Open-loop load test: starts requests at `rps` for `duration` seconds through stream_completion, so they
+    take the same path as real queries (scheduler limits, compression, --record/--replay). At most
+    `concurrency` run at once and later ones wait for a free worker. Latency and time to first token are
+    measured from each request's scheduled start, so that wait shows up in the numbers instead of hiding a
+    saturated client or server. Ctrl+C stops starting new requests and lets those in flight finish.
+    A local server is not health-checked per request: the caller checks it once before the run.
+    Returns (results, elapsed_seconds, peak_in_flight).
+    """
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor, wait
+    from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+
+    # One pooled keep-alive connection per worker instead of a new connection for most requests
+    for adapter in set(get_http_session().adapters.values()):
+        if isinstance(adapter, HTTPAdapter):
+            adapter.init_poolmanager(DEFAULT_POOLSIZE, concurrency)
+
+    results = []
+    state = {"in_flight": 0, "peak": 0}
+    lock = threading.Lock()
+
+    def run_one(idx, scheduled):
+        with lock:
+            state["in_flight"] += 1
+            state["peak"] = max(state["peak"], state["in_flight"])
+        meta = {}
+        result = {"error": None, "ttft_ms": None}
+        try:
+            for _ in stream_completion(profile_config, prompts[idx % len(prompts)], proxy=proxy, meta=meta, timeout=timeout, check_server=False):
+                if result["ttft_ms"] is None:
+                    result["ttft_ms"] = (time.time() - scheduled) * 1000
+            if not meta.get("finish_reason"):
+                result["error"] = "stream ended early"
+        except ProviderError as e:
+            result["error"] = f"HTTP {e.status_code}"
+        except requests.exceptions.Timeout:
+            result["error"] = "timeout"
+        except requests.exceptions.ChunkedEncodingError:
+            result["error"] = "stream cut"
+        except requests.exceptions.ConnectionError as e:
+            # A read timeout in the middle of a stream surfaces as a ConnectionError
+            result["error"] = "timeout" if "timed out" in str(e) else "connection error"
+        except Exception as e:
+            result["error"] = type(e).__name__
+        result["latency_ms"] = (time.time() - scheduled) * 1000
+        result["completion_tokens"] = (meta.get("usage") or {}).get("completion_tokens", 0)
+        with lock:
+            state["in_flight"] -= 1
+            results.append(result)
+
+    def progress(scheduled):
+        if show_progress:
+            failed = sum(1 for r in results if r["error"])
+            sys.stderr.write(f"\r\033[K[loadtest] {time.time() - start:4.0f}s  scheduled {scheduled}  done {len(results)}  "
+                             f"failed {failed}  in flight {state['in_flight']}")
+            sys.stderr.flush()
+
+    total = max(1, int(rps * duration))
+    futures = []
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    start = last_report = time.time()
     try:
-        proxies = {"http": proxy, "https": proxy} if proxy else None
-        response = requests.post(api_url, headers=headers, json=payload, proxies=proxies)
-        if debug_mode:
-            print(f"[Debug] Status: {response.status_code}")
-        if response.status_code != 200:
-            if response.status_code == 429:
-                print(f"\n[Error 429] You have exceeded your OpenAI API quota.")
-                print("Please check your usage and billing details at platform.openai.com.")
-            else:
-                print(f"\n[Error {response.status_code}]")
-                print(response.text)
+        for idx in range(total):
+            scheduled = start + idx / rps
+            while True:
+                now = time.time()
+                if now - last_report >= 1:
+                    progress(len(futures))
+                    last_report = now
+                if now >= scheduled:
+                    break
+                time.sleep(min(scheduled - now, 0.25))
+            futures.append(pool.submit(run_one, idx, scheduled))
+        while wait(futures, timeout=1).not_done:
+            progress(len(futures))
+    except KeyboardInterrupt:
+        cancelled = sum(1 for f in futures if f.cancel())
+        if show_progress:
+            sys.stderr.write(f"\r\033[K{YELLOW}[loadtest] Stopped: {cancelled} queued requests skipped, waiting for those in flight...{RESET}\n")
+    pool.shutdown(wait=True)
+    elapsed = time.time() - start
+    if show_progress:
+        sys.stderr.write("\r\033[K")
+    return results, elapsed, state["peak"]
+
+def summarize_load_test(results, elapsed):
+    """Builds the loadtest report: outcome counts, throughput, and latency/TTFT percentiles of successful requests."""
+    ok = [r for r in results if not r["error"]]
+    errors = {}
+    for r in results:
+        if r["error"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    elapsed = max(elapsed, 1e-9)
+
+    def stats(values):
+        values = sorted(round(v, 1) for v in values)
+        return {
+            "p50": _percentile(values, 50), "p95": _percentile(values, 95), "p99": _percentile(values, 99),
+            "max": values[-1] if values else None, "mean": round(sum(values) / len(values), 1) if values else None
+        }
+
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "failed": len(results) - len(ok),
+        "elapsed_s": round(elapsed, 2),
+        "achieved_rps": round(len(ok) / elapsed, 2),
+        "output_tokens_per_s": round(sum(r["completion_tokens"] for r in ok) / elapsed, 1),
+        "latency_ms": stats(r["latency_ms"] for r in ok),
+        "ttft_ms": stats(r["ttft_ms"] for r in ok if r["ttft_ms"] is not None),
+        "errors": dict(sorted(errors.items(), key=lambda item: -item[1]))
+    }
+
+def handle_loadtest(config, args):
+    """Parses `ai loadtest` options, runs the load test and prints its report."""
+    options = {"--rps": "1", "--duration": "10", "--concurrency": str(LOADTEST_CONCURRENCY), "--timeout": str(LOADTEST_TIMEOUT),
+               "--prompt-file": "", "--profile": config.get("active_profile", ""), "--model": "", "--output": "", "--priority": "batch"}
+    aliases = {"-p": "--profile", "-m": "--model"}
+    prompt_words = []
+    idx = 0
+    while idx < len(args):
+        arg = aliases.get(args[idx], args[idx])
+        if arg in options and idx + 1 < len(args):
+            options[arg] = args[idx + 1]
+            idx += 2
+        elif arg in ["--record", "--replay", "--replay-speed"]:
+            idx += 2 # handled globally before dispatch
+        elif arg == "--debug":
+            idx += 1
+        elif arg.startswith("-"):
+            print(f"{RED}[Error] Unknown loadtest option: {arg}{RESET}")
+            print("Usage: ai loadtest [-p PROFILE] [-m MODEL] [--rps N] [--duration S] [--prompt-file FILE | \"PROMPT\"]")
+            print("                   [--concurrency N] [--timeout S] [--priority interactive|batch] [--output json]")
             return 1
-        data = response.json()
-        if "choices" in data and data["choices"]:
-            message = data["choices"][0].get("message", {})
-            content = message.get("content", "")
-            if content:
-                rendered_text = render_markdown(content)
-                print(rendered_text.strip())
-                if history is not None:
-                    history.append({"role": "assistant", "content": content})
-                if output_file and history is None:
-                    save_single_response(content, output_file)
-            else:
-                print("[No content returned]")
-                if debug_mode: print(data)
         else:
-            print("[Error] Invalid response format from OpenAI")
-            if debug_mode: print(data)
-        return 0
-    except Exception as e:
-        print(f"\n[Connection Error] {e}")
+            prompt_words.append(arg)
+            idx += 1
+
+    profile_name = options["--profile"]
+    profile_config = config.get("profiles", {}).get(profile_name)
+    if not profile_config:
+        print(f"{RED}[Error] Profile '{profile_name}' not found in configuration.{RESET}")
+        return 1
+    if options["--model"]:
+        profile_config = dict(profile_config, model_name=options["--model"])
+    if options["--output"] not in ["", "json"]:
+        print(f"{RED}[Error] loadtest supports --output json only.{RESET}")
+        return 1
+    if options["--priority"] not in RequestScheduler.PRIORITIES:
+        print(f"{RED}[Error] --priority must be 'interactive' or 'batch'.{RESET}")
+        return 1
+    RequestScheduler.priority = options["--priority"]
+    try:
+        rps = float(options["--rps"])
+        duration = float(options["--duration"])
+        concurrency = int(options["--concurrency"])
+        timeout = float(options["--timeout"])
+        if rps <= 0 or duration <= 0 or concurrency < 1 or timeout <= 0:
+            raise ValueError
+    except ValueError:
+        print(f"{RED}[Error] --rps, --duration, --concurrency and --timeout need positive numbers.{RESET}")
         return 1
 
+    if options["--prompt-file"]:
+        try:
+            with open(options["--prompt-file"], encoding="utf-8") as f:
+                prompts = [line.strip() for line in f if line.strip()]
+        except OSError as e:
+            print(f"{RED}[Error] Can't read prompt file: {e}{RESET}")
+            return 1
+        if not prompts:
+            print(f"{RED}[Error] The prompt file has no prompts (one per line).{RESET}")
+            return 1
+    else:
+        prompts = [" ".join(prompt_words) or "Reply with one short sentence."]
+
+    provider = profile_config.get("provider", "gemini")
+    model_name = profile_config.get("model_name", DEFAULT_MODELS.get(provider, ""))
+    if provider == "local" and not ensure_local_server(profile_config):
+        return 1
+    sys.stderr.write(f"{CYAN}[loadtest] {rps:g} req/s for {duration:g}s against '{profile_name}' ({provider}, {model_name}), "
+                     f"up to {concurrency} in flight, {len(prompts)} prompt(s){RESET}\n")
+    results, elapsed, peak = run_load_test(profile_config, prompts, rps, duration, concurrency=concurrency, timeout=timeout,
+                                           proxy=config.get("proxy", "") if provider != "local" else "",
+                                           show_progress=sys.stderr.isatty())
+    report = summarize_load_test(results, elapsed)
+    report.update({"profile": profile_name, "provider": provider, "model": model_name, "target_rps": rps,
+                   "duration_s": duration, "concurrency": concurrency, "peak_in_flight": peak})
+
+    if options["--output"] == "json":
+        print_structured(report)
+    else:
+        def row(label, stats):
+            if stats["p50"] is None:
+                return f"  {label:<12} -"
+            return (f"  {label:<12} p50 {stats['p50']:.0f}  p95 {stats['p95']:.0f}  p99 {stats['p99']:.0f}  "
+                    f"max {stats['max']:.0f}  mean {stats['mean']:.0f}")
+        failed_share = report["failed"] * 100 / report["requests"] if report["requests"] else 0
+        print(f"\n{GREEN}Load test results{RESET} ({profile_name}: {provider}, {model_name})")
+        print(f"  {'Requests':<12} {report['requests']} sent, {report['succeeded']} succeeded, {report['failed']} failed ({failed_share:.1f}%)")
+        print(f"  {'Throughput':<12} {report['achieved_rps']:g} req/s achieved of {rps:g} targeted, "
+              f"{report['output_tokens_per_s']:g} output tokens/s over {report['elapsed_s']:g}s")
+        print(row("Latency ms", report["latency_ms"]))
+        print(row("TTFT ms", report["ttft_ms"]))
+        if report["errors"]:
+            print(f"  {'Errors':<12} " + ", ".join(f"{name} × {count}" for name, count in report["errors"].items()))
+        if peak >= concurrency:
+            print(f"{YELLOW}[!] All {concurrency} workers were busy at times, so some requests started late and their "
+                  f"latency includes that wait. Raise --concurrency to push harder.{RESET}")
+    return 0 if report["succeeded"] else 1
+
 def cli_entry_point():
+    # Local mock provider server: needs no config, so it runs before first-time setup
+    if len(sys.argv) > 1 and sys.argv[1] == "mock-server":
+        return handle_mock_server(sys.argv[2:])
+
     # Handle --reinstall flag first
     if "--reinstall" in sys.argv:
         if CONFIG_FILE.exists():
@@ -901,11 +4785,47 @@ def cli_entry_point():
     
     if "--complete" in sys.argv:
         return handle_completion(config)
+
+    # Internal: background model catalog refresh spawned by --model listing and shell completion
+    if "--refresh-models" in sys.argv:
+        idx = sys.argv.index("--refresh-models")
+        profile_name = sys.argv[idx + 1] if idx + 1 < len(sys.argv) else ""
+        profile_config = (config or {}).get("profiles", {}).get(profile_name)
+        if not profile_config:
+            return 1
+        models, error = load_model_catalog(profile_config, proxy=config.get("proxy", ""), force_refresh=True)
+        return 1 if error else 0
     
     if "--reinstall" in sys.argv:
         print(f"[{APP_NAME}] Reinstall complete.")
         return 0
 
+    if sys.stdout.isatty():
+        TERMINAL.listen()
+
+    # Record provider traffic to a directory, or replay it offline (--record/--replay <dir>)
+    if "--record" in sys.argv or "--replay" in sys.argv:
+        mode = "--replay" if "--replay" in sys.argv else "--record"
+        idx = sys.argv.index(mode)
+        directory = sys.argv[idx + 1] if idx + 1 < len(sys.argv) and not sys.argv[idx + 1].startswith("-") else ""
+        if not directory or ("--record" in sys.argv and "--replay" in sys.argv):
+            print(f"{RED}[Error] Use either --record <dir> or --replay <dir>.{RESET}")
+            return 1
+        speed = 1.0
+        if "--replay-speed" in sys.argv:
+            idx = sys.argv.index("--replay-speed")
+            try:
+                speed = float(sys.argv[idx + 1])
+            except (IndexError, ValueError):
+                print(f"{RED}[Error] --replay-speed needs a number (1 = original timing, 0 = no delays).{RESET}")
+                return 1
+        try:
+            enable_traffic_capture(record_dir=directory if mode == "--record" else None,
+                                   replay_dir=directory if mode == "--replay" else None, speed=speed)
+        except (OSError, ValueError) as e:
+            print(f"{RED}[Error] Can't read recordings from {directory}: {e}{RESET}")
+            return 1
+
     # Handle --debug-config flag
     if "--debug-config" in sys.argv:
         if not config:
@@ -999,6 +4919,17 @@ compdef _ai_completion ai""")
             print(f"{RED}[Error] Unsupported shell '{shell}'. Supported: bash, zsh.{RESET}")
             return 1
 
+    # Handle 'pipe' subcommand (multi-stage prompt chains)
+    if len(sys.argv) > 1 and sys.argv[1] == "pipe":
+        if len(sys.argv) < 3 or sys.argv[2].startswith("-"):
+            print(f"{RED}[Error] Please provide a pipeline file: ai pipe <stages.yaml>{RESET}")
+            return 1
+        RequestScheduler.priority = "batch"
+        return run_pipeline(config, sys.argv[2], debug_mode="--debug" in sys.argv, use_cache="--no-cache" not in sys.argv)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "loadtest":
+        return handle_loadtest(config, sys.argv[2:])
+
     if "--help" in sys.argv or "-h" in sys.argv:
         return print_help()
 
@@ -1035,11 +4966,19 @@ compdef _ai_completion ai""")
 
     debug_mode = "--debug" in sys.argv
     chat_mode = any(x in sys.argv for x in ["--chat", "-i", "chat"])
+    prefetch_mode = "--prefetch" in sys.argv
+    type_ahead_mode = "--type-ahead" in sys.argv
+    tools_mode = "--tools" in sys.argv
+    compact_mode = "--compact-input" in sys.argv
     
     chat_flags = ["--chat", "-i", "chat"]
     profile_flags = ["--profile", "-p"]
     model_flags = ["--model", "-m"]
     save_flags = ["--save", "-o"]
+    context_flags = ["--context", "--context-budget"]
+    output_flags = ["--output"]
+    priority_flags = ["--priority"]
+    traffic_flags = ["--record", "--replay", "--replay-speed"]
     
     output_file = None
     for flag in save_flags:
@@ -1049,6 +4988,39 @@ compdef _ai_completion ai""")
                 output_file = sys.argv[idx + 1].strip()
                 break
 
+    # File/directory context (--context may be repeated)
+    context_paths = [sys.argv[i + 1] for i, arg in enumerate(sys.argv[:-1]) if arg == "--context" and not sys.argv[i + 1].startswith("-")]
+    context_budget = CONTEXT_TOKEN_BUDGET
+    if "--context-budget" in sys.argv:
+        idx = sys.argv.index("--context-budget")
+        try:
+            context_budget = int(sys.argv[idx + 1])
+        except (IndexError, ValueError):
+            print(f"{RED}[Error] --context-budget needs a number of tokens.{RESET}")
+            return 1
+
+    # Structured output for scripts (--output json|ndjson)
+    output_format = None
+    if "--output" in sys.argv:
+        idx = sys.argv.index("--output")
+        output_format = sys.argv[idx + 1] if idx + 1 < len(sys.argv) else ""
+        if output_format not in ["json", "ndjson"]:
+            print(f"{RED}[Error] --output must be 'json' or 'ndjson'.{RESET}")
+            return 1
+        if chat_mode or output_file:
+            print(f"{RED}[Error] --output works with single queries only and can't be combined with --save (redirect stdout instead).{RESET}")
+            return 1
+
+    # Scheduler priority (profiles with max_inflight/rpm/tpm): someone reading a terminal outranks scripts
+    RequestScheduler.priority = "interactive" if chat_mode or sys.stdout.isatty() else "batch"
+    if "--priority" in sys.argv:
+        idx = sys.argv.index("--priority")
+        priority = sys.argv[idx + 1] if idx + 1 < len(sys.argv) else ""
+        if priority not in RequestScheduler.PRIORITIES:
+            print(f"{RED}[Error] --priority must be 'interactive' or 'batch'.{RESET}")
+            return 1
+        RequestScheduler.priority = priority
+
     # Check if a custom profile is temporarily chosen
     target_profile = config.get("active_profile", "")
     temp_profile = None
@@ -1099,11 +5071,11 @@ compdef _ai_completion ai""")
         if skip:
             skip = False
             continue
-        if arg in model_flags + profile_flags + save_flags:
+        if arg in model_flags + profile_flags + save_flags + context_flags + output_flags + priority_flags + traffic_flags:
             if idx + 2 < len(sys.argv) and not sys.argv[idx + 2].startswith("-"):
                 skip = True
             continue
-        if arg in ["--debug", "--config", "--help", "-h", "--reinstall", "--debug-config", "--profiles", "--use", "--profile-add", "--profile-remove"] + chat_flags:
+        if arg in ["--debug", "--config", "--help", "-h", "--reinstall", "--debug-config", "--profiles", "--use", "--profile-add", "--profile-remove", "--prefetch", "--type-ahead", "--tools", "--no-pager", "--semantic-cache", "--no-semantic-cache", "--no-single-flight", "--compact-input", "--dry-run", "--count-tokens"] + chat_flags:
             continue
         filtered_args.append(arg)
     args = filtered_args
@@ -1113,15 +5085,12 @@ compdef _ai_completion ai""")
         active_config = config["profiles"][target_profile]
         provider = active_config.get("provider", "gemini")
         proxy = config.get("proxy", "")
-        if provider == "gemini":
-            model_name = active_config.get("model_name", "gemini-2.5-flash")
-        else:
-            model_name = active_config.get("model_name", "gpt-4o")
+        model_name = active_config.get("model_name", DEFAULT_MODELS.get(provider, "gpt-4o"))
             
         # Read piped content if stdin is not a TTY (before we redirect it)
         piped_content = ""
         if not sys.stdin.isatty():
-            piped_content = sys.stdin.read().strip()
+            piped_content = read_piped_input(compact_mode, debug_mode)
             # Redirect stdin back to the interactive terminal (/dev/tty) so input() works
             try:
                 sys.stdin = open('/dev/tty')
@@ -1130,7 +5099,10 @@ compdef _ai_completion ai""")
 
         print_header_block(target_profile, provider, model_name)
         
-        history = []
+        history = ChatHistory()
+        prefetcher = None
+        if prefetch_mode or active_config.get("prefetch"):
+            prefetcher = ChatPrefetcher(active_config, proxy=proxy, debug_mode=debug_mode)
         initial_prompt = ""
         display_prompt = ""
         
@@ -1146,35 +5118,50 @@ compdef _ai_completion ai""")
             initial_prompt = " ".join(args)
             display_prompt = initial_prompt
 
+        if context_paths:
+            user_question = " ".join(args)
+            file_context, context_stats = build_file_context(context_paths, user_question, context_budget, debug_mode)
+            if file_context:
+                request = f"Question: {user_question}" if user_question else "Please acknowledge receipt of these files, briefly summarize them, and wait for my questions about them."
+                initial_prompt = f"Context from files:\n\n{file_context}\n\n{initial_prompt if piped_content else request}"
+                display_prompt = f"[{context_stats['selected']} file excerpts] " + (display_prompt or "(Awaiting your questions)")
+
+        reader = TypeAheadReader() if type_ahead_mode else None
+
         if initial_prompt:
             print_user_message(" You >>> ", display_prompt)
-            if provider == "gemini":
-                history.append({"role": "user", "parts": [{"text": initial_prompt}]})
-                status = send_gemini_request(active_config, "", debug_mode, proxy=proxy, history=history)
+            history.add("user", initial_prompt)
+            if reader:
+                reader.busy = True
+            if tools_mode:
+                status = tools_chat_reply(active_config, history, debug_mode, proxy=proxy, allowlist=config.get("tool_allowlist"))
             else:
-                history.append({"role": "user", "content": initial_prompt})
-                status = send_openai_request(active_config, "", debug_mode, proxy=proxy, history=history)
+                status = stream_reply(active_config, "", debug_mode, proxy=proxy, history=history, show_progress=False if reader else None)
+            if reader:
+                reader.busy = False
             
-            if status != 0:
+            if status not in (0, 130):
                 print(f"{RED}[Error] Failed to get response. Continuing session...{RESET}")
                 
+        # Warm up at the start and after each request or target switch, not on empty lines and commands
+        warm_next = True
         while True:
             try:
                 prompt = f"\n You >>> "
-                user_input = input(prompt)
+                if prefetcher and warm_next and not (reader and reader.pending()):
+                    prefetcher.start(history)
+                warm_next = False
+                user_input = reader.get(prompt) if reader else input(prompt)
                 user_input = user_input.strip()
                 if not user_input:
                     continue
                 
                 # Rewrite typed text with beautiful full-width purple background block
-                if BG_USER:
-                    import shutil
+                # (lines typed ahead during a reply are no longer right above the cursor)
+                if BG_USER and not (reader and reader.typed_ahead):
                     import math
-                    try:
-                        cols = shutil.get_terminal_size().columns
-                    except Exception:
-                        cols = 80
-                    total_len = len(prompt) + len(user_input)
+                    cols = TERMINAL.columns
+                    total_len = len(prompt) + visual_len(user_input)
                     n_lines = math.ceil(total_len / cols) if cols else 1
                     sys.stdout.write(f"\033[{n_lines}A\r\033[J")
                     sys.stdout.flush()
@@ -1193,20 +5180,46 @@ compdef _ai_completion ai""")
                     else:
                         print(f"{RED}[Error] Please provide a filename: save <filename>{RESET}")
                     continue
+
+                command, _, value = user_input.partition(" ")
+                if command.lower() in ["/profile", "/model"]:
+                    switched = switch_chat_target(config, active_config, target_profile, command.lower(), value.strip())
+                    if switched:
+                        active_config, target_profile = switched
+                        provider = active_config.get("provider", "gemini")
+                        model_name = active_config.get("model_name", DEFAULT_MODELS.get(provider, "gpt-4o"))
+                        if prefetcher:
+                            prefetcher.retarget(active_config, proxy=proxy)
+                            warm_next = True
+                        print(f"{GREEN}[✓] Now using profile '{target_profile}' | Provider: {provider.capitalize()} | Model: {model_name} ({len(history)} messages carried over){RESET}")
+                    continue
                 
-                if provider == "gemini":
-                    history.append({"role": "user", "parts": [{"text": user_input}]})
-                    status = send_gemini_request(active_config, "", debug_mode, proxy=proxy, history=history)
-                else:
-                    history.append({"role": "user", "content": user_input})
-                    status = send_openai_request(active_config, "", debug_mode, proxy=proxy, history=history)
+                history.add("user", user_input)
+                meta = {}
+                warm_next = True
+                if reader:
+                    reader.busy = True
+                try:
+                    # The \r progress line would overwrite text being typed ahead
+                    if tools_mode:
+                        status = tools_chat_reply(active_config, history, debug_mode, proxy=proxy, allowlist=config.get("tool_allowlist"), meta=meta)
+                    else:
+                        status = stream_reply(active_config, "", debug_mode, proxy=proxy, history=history, meta=meta, show_progress=False if reader else None)
+                finally:
+                    if reader:
+                        reader.busy = False
+                if prefetcher and status == 0:
+                    prefetcher.record(meta)
                     
-                if status != 0:
+                if status not in (0, 130): # 130: cancelled with Ctrl+C
                     print(f"{RED}[Error] Failed to get response. Continuing session...{RESET}")
             except (KeyboardInterrupt, EOFError):
                 print(f"\n{YELLOW}Goodbye!{RESET}")
                 break
 
+        if prefetcher:
+            prefetcher.print_summary()
+
         # Auto-save history on exit if output_file is set
         if output_file and history:
             save_chat_history(history, output_file, provider, target_profile, model_name)
@@ -1214,25 +5227,116 @@ compdef _ai_completion ai""")
 
     user_input = ""
     if not sys.stdin.isatty():
-        user_input = sys.stdin.read().strip()
+        user_input = read_piped_input(compact_mode, debug_mode)
         if args: user_input += "\n" + " ".join(args)
     elif args:
         user_input = " ".join(args)
     else:
         return print_help()
 
+    if context_paths:
+        file_context, _ = build_file_context(context_paths, " ".join(args) or user_input, context_budget, debug_mode)
+        if file_context:
+            user_input = f"Context from files:\n\n{file_context}\n\nQuestion: {user_input}"
+
     active_config = config["profiles"][target_profile]
     provider = active_config.get("provider", "gemini")
     proxy = config.get("proxy", "")
     
-    if provider == "gemini":
-        return send_gemini_request(active_config, user_input, debug_mode, proxy=proxy, output_file=output_file)
-    elif provider == "openai":
-        return send_openai_request(active_config, user_input, debug_mode, proxy=proxy, output_file=output_file)
-    else:
-        print(f"[Error] Invalid provider '{provider}' in profile '{target_profile}'. Use 'gemini' or 'openai'.")
+    if provider not in ["gemini", "openai", "local"]:
+        print(f"[Error] Invalid provider '{provider}' in profile '{target_profile}'. Use 'gemini', 'openai' or 'local'.")
         return 1
 
+    if "--dry-run" in sys.argv or "--count-tokens" in sys.argv:
+        return preview_request(active_config, user_input, proxy=proxy, count_remote="--count-tokens" in sys.argv, debug_mode=debug_mode, tools=tools_mode)
+
+    # Tool runs depend on local state, so they bypass the semantic cache
+    if tools_mode:
+        meta = {}
+        try:
+            run_with_tools(active_config, user_input, debug_mode, proxy=proxy, allowlist=config.get("tool_allowlist"), meta=meta)
+        except (ProviderError, requests.RequestException) as e:
+            if output_format:
+                error = {"status": getattr(e, "status_code", None), "message": getattr(e, "body", None) or str(e)}
+                result = dict(structured_result(target_profile, active_config, meta), error=error)
+                print_structured(dict(result, type="error") if output_format == "ndjson" else result)
+            else:
+                print(f"\n{RED}[Error] {getattr(e, 'body', None) or e}{RESET}")
+            return 1
+        if output_format:
+            result = dict(structured_result(target_profile, active_config, meta), tool_calls=meta["tool_calls"])
+            print_structured(dict(result, type="done") if output_format == "ndjson" else result)
+            return 0
+        page_or_print(meta["text"], pager_enabled(config))
+        if output_file:
+            save_single_response(meta["text"], output_file)
+        return 0
+
+    # Optional semantic cache: near-duplicate prompts are answered locally
+    reused = None # (meta, label) of an answer obtained without calling the API
+    semantic_cache = None
+    cache_settings = config.get("semantic_cache") or {}
+    if ("--semantic-cache" in sys.argv or cache_settings.get("enabled")) and "--no-semantic-cache" not in sys.argv:
+        try:
+            semantic_cache = SemanticCache(active_config, cache_settings, proxy=proxy)
+        except ImportError:
+            print(f"{YELLOW}[!] The semantic cache needs NumPy (pip install numpy). Continuing without it.{RESET}")
+    if semantic_cache:
+        try:
+            cached_text, similarity = semantic_cache.lookup(user_input)
+        except Exception as e:
+            if debug_mode: print(f"[Debug] Semantic cache lookup failed: {e}")
+            semantic_cache, cached_text = None, None
+        if cached_text is not None:
+            if debug_mode: print(f"[Debug] Semantic cache hit (similarity {similarity:.3f})")
+            reused = ({"text": cached_text, "latency_ms": 0}, "cached")
+        elif debug_mode and semantic_cache: print(f"[Debug] Semantic cache miss (best similarity {similarity:.3f})")
+
+    # Single-flight: an identical request already in flight in another process answers this one too
+    flight = None
+    if reused is None and config.get("single_flight", True) and "--no-single-flight" not in sys.argv:
+        flight = SingleFlight(_request_key(active_config, user_input))
+        shared = flight.join()
+        if shared is not None:
+            if debug_mode: print(f"[Debug] Single-flight: reused the answer of an identical concurrent request (waited {shared['latency_ms']:.0f} ms)")
+            reused = (shared, "shared")
+
+    if reused:
+        reused_meta, label = reused
+        if output_format:
+            result = structured_result(target_profile, active_config, reused_meta)
+            result[label] = True
+            print_structured(dict(result, type="done") if output_format == "ndjson" else result)
+            return 0
+        page_or_print(reused_meta["text"], pager_enabled(config))
+        if output_file:
+            save_single_response(reused_meta["text"], output_file)
+        return 0
+
+    meta = {}
+    status = 1
+    try:
+        if output_format:
+            status = emit_structured_output(active_config, target_profile, user_input, output_format, proxy=proxy, meta=meta)
+        elif pager_enabled(config):
+            # The flight is released when the stream ends, so waiters don't stall while the answer is being read
+            on_finish = (lambda done: flight.release(done if reply_completed(done) else None)) if flight else None
+            status = stream_reply(active_config, user_input, debug_mode, proxy=proxy, meta=meta, use_pager=True, on_finish=on_finish)
+            if status == 0 and output_file and meta.get("text"):
+                save_single_response(meta["text"], output_file)
+        else:
+            status = send_request(active_config, user_input, debug_mode, proxy=proxy, output_file=output_file, meta=meta)
+    finally:
+        if flight:
+            flight.release(meta if status == 0 and reply_completed(meta) else None) # no-op if already released
+    # Only complete answers are cached: a cancelled or length-cut reply would be served to every similar prompt
+    if semantic_cache and status == 0 and meta.get("text") and reply_completed(meta):
+        try:
+            semantic_cache.store(user_input, meta["text"])
+        except Exception as e:
+            if debug_mode: print(f"[Debug] Semantic cache store failed: {e}")
+    return status
+
 def main():
     try:
         sys.exit(cli_entry_point())
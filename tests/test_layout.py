@@ -0,0 +1,30 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from termai_pkg import TERMINAL, TerminalLayout, Verbatim, visual_len
+
+
+def test_wide_characters_are_wrapped_by_columns():
+    rows = TERMINAL.wrap("中" * 50, 80)
+    assert [visual_len(row) for row in rows] == [80, 20]
+    assert "".join(rows) == "中" * 50
+
+
+def test_wide_words_break_between_words():
+    line = " ".join(["日本語のテキスト"] * 10) # 16 columns per word
+    rows = TERMINAL.wrap(line, 40)
+    assert all(visual_len(row) <= 40 for row in rows)
+    assert " ".join(rows) == line
+
+
+def test_emoji_rows_fit_the_width():
+    rows = TerminalLayout().wrap_lines(["🙂" * 30], 21)
+    assert all(visual_len(row) <= 21 for row in rows)
+    assert "".join(rows) == "🙂" * 30
+
+
+def test_ascii_and_verbatim_lines_are_kept():
+    assert TERMINAL.wrap("short line", 80) == ["short line"]
+    code = Verbatim("x" * 200)
+    assert TERMINAL.wrap(code, 80) == [code]
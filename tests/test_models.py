@@ -0,0 +1,34 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import termai_pkg
+from termai_pkg import switch_chat_target
+
+
+def record_refreshes(monkeypatch, tmp_path):
+    monkeypatch.setattr(termai_pkg, "MODEL_CACHE_DIR", tmp_path)
+    monkeypatch.setattr(termai_pkg, "_MODEL_REFRESHES_STARTED", set())
+    started = []
+    monkeypatch.setattr(termai_pkg.subprocess, "Popen", lambda argv, **kwargs: started.append(argv[-1]))
+    return started
+
+
+def test_chat_model_command_skips_refresh_without_key(monkeypatch, tmp_path):
+    started = record_refreshes(monkeypatch, tmp_path)
+    profile = {"provider": "openai", "base_url": "https://api.example.com/v1", "model_name": "m"}
+    config = {"profiles": {"keyless": profile}}
+    for _ in range(3):
+        switch_chat_target(config, profile, "keyless", "/model", "")
+    assert started == []
+
+
+def test_chat_model_command_refreshes_once_per_profile(monkeypatch, tmp_path):
+    started = record_refreshes(monkeypatch, tmp_path)
+    keyed = {"provider": "openai", "base_url": "https://api.example.com/v1", "api_key": "k", "model_name": "m"}
+    local = {"provider": "local", "base_url": "http://127.0.0.1:1/v1", "model_name": "m"}
+    config = {"profiles": {"keyed": keyed, "local": local}}
+    for _ in range(3):
+        switch_chat_target(config, keyed, "keyed", "/model", "")
+        switch_chat_target(config, local, "local", "/model", "other")
+    assert started == ["keyed", "local"]
@@ -0,0 +1,41 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import termai_pkg
+from termai_pkg import RequestScheduler
+
+
+def make_scheduler(monkeypatch, tmp_path, **limits):
+    monkeypatch.setattr(termai_pkg, "SCHEDULER_DIR", tmp_path)
+    return RequestScheduler(dict({"provider": "openai", "model_name": "m"}, **limits))
+
+
+def entry(priority, since=0.0):
+    return {"pid": os.getpid(), "priority": priority, "since": since, "tokens": 10}
+
+
+def test_single_slot_batch_waits_for_interactive(monkeypatch, tmp_path):
+    scheduler = make_scheduler(monkeypatch, tmp_path, max_inflight=1)
+    state = {"inflight": {}, "waiting": {}, "ledger": []}
+    assert scheduler._admit(state, "chat", entry("interactive"))
+    assert not scheduler._admit(state, "job", entry("batch"))
+    state["inflight"].clear()
+    # An interactive request queued behind the running one still goes before the batch job
+    state["waiting"]["chat2"] = entry("interactive", since=5.0)
+    assert not scheduler._admit(state, "job", entry("batch"))
+    assert scheduler._admit(state, "chat2", entry("interactive", since=5.0))
+    state["inflight"].clear()
+    assert scheduler._admit(state, "job", entry("batch"))
+    # A running batch request holds the only slot until it is released
+    assert not scheduler._admit(state, "chat3", entry("interactive", since=6.0))
+
+
+def test_batch_leaves_one_slot_free(monkeypatch, tmp_path):
+    scheduler = make_scheduler(monkeypatch, tmp_path, max_inflight=3)
+    state = {"inflight": {}, "waiting": {}, "ledger": []}
+    assert scheduler._admit(state, "a", entry("batch", since=1.0))
+    assert scheduler._admit(state, "b", entry("batch", since=2.0))
+    assert not scheduler._admit(state, "c", entry("batch", since=3.0))
+    del state["waiting"]["c"]
+    assert scheduler._admit(state, "chat", entry("interactive", since=4.0))
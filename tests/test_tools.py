@@ -0,0 +1,74 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import termai_pkg
+from termai_pkg import tool_grep, tool_run_command
+
+
+def test_find_write_and_exec_actions_are_refused(tmp_path):
+    victim = tmp_path / "victim"
+    victim.write_text("keep me")
+    for action in (["-delete"], ["-exec", "touch", str(tmp_path / "pwned"), ";"], ["-execdir", "rm", "{}", ";"],
+                   ["-ok", "rm", "{}", ";"], ["-okdir", "rm", "{}", ";"], ["-fprint", str(tmp_path / "out")],
+                   ["-fprint0", str(tmp_path / "out")], ["-fprintf", str(tmp_path / "out"), "%p"], ["-fls", str(tmp_path / "out")]):
+        command = " ".join(["find", str(tmp_path), "-name", "victim"] + [f"'{arg}'" for arg in action])
+        assert tool_run_command(command).startswith("Error:"), action
+    assert victim.exists()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["victim"]
+
+
+def test_git_output_and_external_programs_are_refused(tmp_path):
+    target = tmp_path / "written"
+    for command in (f"git diff --output={target}", f"git log --output {target}", f"git show --output={target} HEAD",
+                    f"git diff -o {target}", "git diff --ext-diff", "git log -p --textconv"):
+        assert tool_run_command(command).startswith("Error:"), command
+    assert not target.exists()
+
+
+def test_other_write_options_are_refused():
+    assert tool_run_command("file -C -m magic").startswith("Error:")
+    assert tool_run_command("file -zC -m magic").startswith("Error:")
+    assert tool_run_command("journalctl --vacuum-time=1s").startswith("Error:")
+
+
+def test_read_only_arguments_still_run(tmp_path):
+    (tmp_path / "notes.txt").write_text("hello")
+    result = tool_run_command(f"find {tmp_path} -name notes.txt -type f")
+    assert result.startswith("exit code: 0")
+    assert "notes.txt" in result
+    assert tool_run_command("git log --oneline -1").startswith("exit code:")
+
+
+def make_config_dir(monkeypatch, tmp_path):
+    config_dir = tmp_path / ".config" / "termai"
+    config_dir.mkdir(parents=True)
+    (config_dir / "config.json").write_text('{"api_key":"SECRET-KEY-123"}')
+    (tmp_path / ".config" / "other.conf").write_text("api_key = harmless")
+    monkeypatch.setattr(termai_pkg, "CONFIG_DIR", config_dir)
+    return config_dir
+
+
+def test_grep_skips_config_dir_under_searched_parent(monkeypatch, tmp_path):
+    config_dir = make_config_dir(monkeypatch, tmp_path)
+    for root in (tmp_path / ".config", tmp_path):
+        result = tool_grep("api_key", str(root))
+        assert "SECRET-KEY-123" not in result
+        assert "harmless" in result
+    assert tool_grep("api_key", str(config_dir)).startswith("Error:")
+
+
+def test_recursive_commands_refuse_config_dir_parent(monkeypatch, tmp_path):
+    make_config_dir(monkeypatch, tmp_path)
+    parent = tmp_path / ".config"
+    for command in (f"grep -r api_key {parent}", f"grep -rn api_key {tmp_path}", f"grep --recursive api_key {parent}",
+                    f"find {parent}", f"ls -lR {parent}"):
+        result = tool_run_command(command)
+        assert result.startswith("Error:"), command
+        assert "SECRET-KEY-123" not in result
+    monkeypatch.chdir(parent)
+    assert tool_run_command("grep -r api_key").startswith("Error:")
+    assert tool_run_command("find -name config.json").startswith("Error:")
+    # Reading a file next to the config directory, or listing its parent, is still fine
+    assert "harmless" in tool_run_command(f"grep api_key {parent / 'other.conf'}")
+    assert "termai" in tool_run_command(f"ls {parent}")